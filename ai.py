@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# A computer player.  It tries every (column, rotation) for its next piece
+# on a copy of the playfield, lets the physics settle, and scores the
+# result: how close its own tower is to the goal against how close the
+# opponent's is, less the pieces it lost.  The best few are then searched
+# one move deeper, against every reply the opponent could make with the
+# piece it is holding, and the move whose worst reply leaves it best off
+# wins.
+#
+# The work is shared out over a process pool and runs asynchronously, so
+# the game loop only ever polls for the answer.  Both plies stop when the
+# time budget runs out: placements the first didn't get to, and moves the
+# second didn't finish, are left out of the decision.
+
+import signal, multiprocessing
+
+import sim, net
+
+OTHER = {'Server': 'Client', 'Client': 'Server'}
+WIN = 1000000
+
+def placements(piece, width=sim.WIDTH):
+    rtn = []
+    seen = set()
+    for rotation, shape in enumerate(piece.shape.rotations):
+        if shape in seen: continue # Symmetric pieces
+        seen.add(shape)
+        left, right, top = shape.extents
+        rtn.extend((column, rotation) for column in xrange(-left, width - right))
+    return rtn
+
+# Returns the settled playfield after dropping piece, and the winner if any
+def try_drop(playfield, piece, column, rotation):
+    playfield = playfield.copy()
+    winner = piece.copy().drop(playfield, column, rotation)
+    playfield.tick()
+    return playfield, winner
+
+# How much better off role is than its opponent, in rows.  Pieces that fell
+# count against the side they fell from.
+def value(playfield, role, lost=0):
+    heights = playfield.column_heights
+    half = playfield.width/2
+    left = playfield.height - min(heights[:half])
+    right = playfield.height - min(heights[half:])
+    if role == 'Server':
+        return 10*(left - right) - 3*lost
+    return 10*(right - left) - 3*lost
+
+def pieces_lost(playfield, role):
+    lost = 0
+    for piece in playfield.collapsed:
+        if (piece.x < playfield.width/2) == (role == 'Server'): lost += 1
+        else: lost -= 1
+    return lost
+
+# Pool tasks.  Both return how many placements they evaluated, for the
+# benchmark.
+
+# [(score, lost, move)] for moves in order, as far as it gets before the
+# deadline (but always the first)
+def first_ply(playfield, piece, role, moves, deadline=None):
+    rtn = []
+    for column, rotation in moves:
+        if rtn and deadline is not None and net.monotonic() > deadline:
+            break
+        after, winner = try_drop(playfield, piece, column, rotation)
+        if winner:
+            score, lost = (WIN if winner == role else -WIN), 0
+        else:
+            lost = pieces_lost(after, role)
+            score = value(after, role, lost)
+        rtn.append((score, lost, (column, rotation)))
+    return rtn, len(rtn)
+
+# The score of move after the opponent's best reply with reply_piece, or
+# None if the deadline passed first.
+def second_ply(playfield, piece, reply_piece, role, move, lost, deadline):
+    after, winner = try_drop(playfield, piece, *move)
+    worst = WIN
+    count = 1
+    for column, rotation in placements(reply_piece, playfield.width):
+        if net.monotonic() > deadline:
+            return None, count
+        reply, winner = try_drop(after, reply_piece, column, rotation)
+        count += 1
+        if winner:
+            score = WIN if winner == role else -WIN
+        else:
+            score = value(reply, role, lost + pieces_lost(reply, role))
+        worst = min(worst, score)
+        if worst == -WIN: break
+    return worst, count
+
+def call(args):
+    return args[0](*args[1:])
+
+# Ctrl-C, or a SIGTERM to the game's process group, reaches the workers
+# too; it is for the game to handle, which closes the pool.  A worker killed
+# while waiting for a task dies holding the pool's queue lock, and then
+# nothing can shut the pool down, so the workers only ever stop by running
+# out of tasks (see Player.close).
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+# moves in at most parts chunks, one per pool task
+def split(moves, parts):
+    size = (len(moves) + parts - 1) / parts
+    return [moves[i:i+size] for i in xrange(0, len(moves), size)]
+
+# One move's worth of searching.  With a pool, poll() never blocks: it
+# returns None until there is an answer.  Without one the whole search
+# runs inside the first poll().
+class Search:
+    def __init__(self, match, role, budget, lookahead=8, pool=None, processes=1):
+        self.role = role
+        # Copied, as the pool pickles them in the background while the
+        # game goes on
+        self.piece = match.next_piece[role].copy()
+        self.reply_piece = match.next_piece[OTHER[role]].copy()
+        self.playfield = match.playfield.copy()
+        self.deadline = net.monotonic() + budget
+        self.lookahead = lookahead
+        self.pool = pool
+        self.evaluated = 0
+        self.depth = 0
+        self.move = None
+        self.jobs = [(first_ply, self.playfield, self.piece, role, moves, self.deadline)
+                     for moves in split(placements(self.piece, self.playfield.width), processes)]
+        self.results = self.start(self.jobs)
+
+    def start(self, jobs):
+        if self.pool:
+            return [self.pool.apply_async(call, (job,)) for job in jobs]
+        return [call(job) for job in jobs]
+
+    # None until every task has finished.  The tasks watch the deadline
+    # themselves, so this doesn't wait long past it.
+    def collect(self):
+        if not self.pool:
+            return self.results
+        if not all(r.ready() for r in self.results):
+            return None
+        return [r.get() for r in self.results]
+
+    def poll(self):
+        if self.move: return self.move
+        results = self.collect()
+        if results is None: return None
+        # The first ply may not have got to every placement, but there is
+        # always at least one from each task.
+        if self.depth == 0:
+            self.first = []
+            for moves, count in results:
+                self.first.extend(moves)
+                self.evaluated += count
+            self.first.sort(reverse=True)
+            self.depth = 1
+            if self.first[0][0] >= WIN or net.monotonic() > self.deadline:
+                self.move = self.first[0][2]
+                return self.move
+            self.jobs = [(second_ply, self.playfield, self.piece, self.reply_piece,
+                          self.role, move, lost, self.deadline)
+                         for score, lost, move in self.first[:self.lookahead]]
+            self.results = self.start(self.jobs)
+            return self.poll()
+        second = []
+        for job, (score, count) in zip(self.jobs, results):
+            self.evaluated += count
+            if score is not None: second.append((score, job[5]))
+        if second:
+            self.depth = 2
+            self.move = max(second)[1]
+        else:
+            self.move = self.first[0][2]
+        return self.move
+
+    # Block until there is an answer
+    def wait(self):
+        while not self.poll():
+            if self.pool:
+                for r in self.results:
+                    r.wait()
+        return self.move
+
+def search(match, role, budget, lookahead=8, pool=None, processes=1):
+    return Search(match, role, budget, lookahead, pool, processes).wait()
+
+# Plays role in a live match, at most once every interval frames.
+class Player:
+    def __init__(self, role, budget=0.2, interval=40, processes=None):
+        self.role = role
+        self.budget = budget
+        self.interval = interval
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.processes, init_worker)
+        self.search = None
+        self.next_move = 0
+
+    # The (column, rotation) to drop at, or None if not ready yet
+    def poll(self, match, frameno):
+        if self.search is None:
+            if frameno < self.next_move: return None
+            self.search = Search(match, self.role, self.budget,
+                                 pool=self.pool, processes=self.processes)
+            self.moves = match.movecount[self.role]
+        move = self.search.poll()
+        if move is None: return None
+        piece = match.next_piece[self.role]
+        current = self.moves == match.movecount[self.role] and piece.shape is self.search.piece.shape
+        self.search = None
+        if not current: return None # Dropped or reset meanwhile; think again
+        self.next_move = frameno + self.interval
+        return move
+
+    # Any search still going is left to run out its budget; the workers
+    # then exit.
+    def close(self):
+        self.pool.close()
+        self.pool.join()
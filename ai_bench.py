@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# How fast does the computer player think?  Takes one of bench.py's loaded
+# boards, then times every placement of a piece (copy, drop, settle, score)
+# in this process, the same spread over a process pool, and whole searches
+# with lookahead under the time budget, reporting placements evaluated per
+# second.
+
+import sys, time, multiprocessing
+from optparse import OptionParser
+
+import sim, ai, protocol, bench
+
+option_parser = OptionParser()
+option_parser.add_option('--board', action='store', type='choice', choices=['half', 'tall'], dest='board', default='half', help='Which of bench.py\'s boards to think about (half or tall)')
+option_parser.add_option('--repeat', action='store', type='int', dest='repeat', default=20, help='Times to evaluate every placement')
+option_parser.add_option('--processes', action='store', type='int', dest='processes', default=multiprocessing.cpu_count(), help='Size of the process pool')
+option_parser.add_option('--budget', action='store', type='int', dest='budget', default=200, help='Time budget per search (ms)')
+option_parser.add_option('--searches', action='store', type='int', dest='searches', default=10, help='Searches to time')
+option_parser.add_option('--seed', action='store', type='int', dest='seed', default=1)
+options, args = option_parser.parse_args()
+
+match = bench.boards(options.seed)[options.board]
+print '%d pieces on the board' % len(match.playfield.pieces)
+
+role = 'Server'
+piece = match.next_piece[role]
+moves = ai.placements(piece)
+print '%d placements per move' % len(moves)
+
+start = time.time()
+for i in xrange(options.repeat):
+    ai.first_ply(match.playfield, piece, role, moves)
+elapsed = time.time() - start
+serial = options.repeat * len(moves) / elapsed
+print 'one process       %8.0f placements/s' % serial
+
+pool = multiprocessing.Pool(options.processes, ai.init_worker)
+pool.map(ai.call, [(ai.first_ply, match.playfield, piece, role, moves[:1])] * options.processes)
+start = time.time()
+jobs = [(ai.first_ply, match.playfield, piece, role, part)
+        for part in ai.split(moves, options.processes)] * options.repeat
+count = sum(n for scores, n in pool.map(ai.call, jobs))
+elapsed = time.time() - start
+print '%2d processes      %8.0f placements/s  (%.1fx)' % \
+    (options.processes, count / elapsed, count / elapsed / serial)
+
+budget = options.budget / 1000.
+for name, p in (('one process', None), ('%d processes' % options.processes, pool)):
+    evaluated = depth = 0
+    start = time.time()
+    for i in xrange(options.searches):
+        search = ai.Search(match, role, budget, pool=p, processes=options.processes if p else 1)
+        search.wait()
+        evaluated += search.evaluated
+        depth += search.depth
+    elapsed = time.time() - start
+    print 'search, %-12s %5.0f ms per move, %6.0f placements/s, %3.0f%% looked ahead' % \
+        (name + ':', 1000 * elapsed / options.searches, evaluated / elapsed,
+         100. * (depth - options.searches) / options.searches)
+pool.close()
+pool.join()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# The benchmark suite: times the hot paths (physics, dealing, dropping and
+# destroying pieces, drawing, publishing to a render process, decoding
+# network input, sending the whole match state and logging) on boards
+# built from a fixed seed, so that two runs on one machine can be
+# compared.
+#
+#     bench.py [--save FILE] [--compare FILE] [--only TEXT]
+#
+# The boards are
+#   empty       a new match
+#   half        filled level to about half way up
+#   tall        a tower on each side reaching nearly to the goal rows
+#   cascade     tall, plus the drop that brings down the most pieces
+#
+# Each result is the best of --repeat runs, in microseconds per call.
+# --save writes them as JSON; --compare reads a saved run and flags every
+# result more than --tolerance percent slower, exiting with status 1 if
+# there were any.  rollback_bench.py and ai_bench.py cover the rest.
+
+import os, sys, gc, time, random, json, platform
+from optparse import OptionParser
+
+import sim, ai, net, protocol, state, display, ringlog
+from sim import WIDTH, HEIGHT
+
+option_parser = OptionParser()
+option_parser.add_option('--save', action='store', type='string', dest='save', default=None, help='Write the results to this JSON file')
+option_parser.add_option('--compare', action='store', type='string', dest='compare', default=None, help='Compare with the results saved in this JSON file')
+option_parser.add_option('--tolerance', action='store', type='float', dest='tolerance', default=20, help='Percent slower than the baseline that counts as a regression')
+option_parser.add_option('--repeat', action='store', type='int', dest='repeat', default=5, help='Runs of each benchmark; the best is kept')
+option_parser.add_option('--only', action='store', type='string', dest='only', default=None, help='Only run benchmarks whose names contain this')
+option_parser.add_option('--no-render', action='store_false', dest='render', default=True, help="Skip the drawing benchmarks (they need pygame)")
+option_parser.add_option('--seed', action='store', type='int', dest='seed', default=1)
+
+# Boards
+
+# Drop pieces that don't bring anything down until done(playfield) says
+# to stop.  pick chooses among the candidates, given as (top row on that
+# side afterwards, move).
+def build(match, done, pick, rng, tries=40, limit=400):
+    role = 'Server'
+    for i in xrange(limit):
+        if done(match.playfield): break
+        role = ai.OTHER[role]
+        piece = match.next_piece[role]
+        half = (WIDTH/2) * (role == 'Client')
+        candidates = []
+        for column, rotation in rng.sample(ai.placements(piece), tries):
+            left, right, top = piece.shape.rotations[rotation].extents
+            if not (half <= column + left and column + right < half + WIDTH/2): continue
+            after, winner = ai.try_drop(match.playfield, piece, column, rotation)
+            if winner or after.collapsed: continue
+            heights = after.column_heights[half:half+WIDTH/2]
+            if min(heights) < 8: continue
+            candidates.append((min(heights), (column, rotation)))
+        if candidates:
+            match.step([protocol.Drop(role, *pick(candidates)[1])])
+    match.step()
+    return match
+
+def boards(seed):
+    rng = random.Random(seed)
+    rtn = {'empty': sim.Match(seed)}
+    # Fill from the bottom up
+    rtn['half'] = build(sim.Match(seed), lambda pf: sum(pf.column_heights) <= WIDTH * HEIGHT / 2,
+                        lambda c: max(c), rng)
+    # Build as high as possible
+    rtn['tall'] = build(sim.Match(seed), lambda pf: max(pf.column_heights[:WIDTH/2]) <= 12 and
+                        max(pf.column_heights[WIDTH/2:]) <= 12, lambda c: min(c), rng)
+    # The move that does the most damage
+    tall = rtn['tall']
+    worst = (0, None)
+    for role in ('Server', 'Client'):
+        piece = tall.next_piece[role]
+        for move in ai.placements(piece):
+            after, winner = ai.try_drop(tall.playfield, piece, *move)
+            if not winner:
+                worst = max(worst, (len(after.collapsed), (role, ) + move))
+    rtn['cascade'] = tall, worst[1], worst[0]
+    return rtn
+
+# Timing.  Each benchmark is (name, run, prepare, number, per): run is
+# called number times in a row, with the arguments from a call to prepare
+# if there is one (made before the clock starts), and the time is divided
+# by per as well.
+
+def timed(run, prepare=None, number=100, per=1, repeat=5):
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for r in xrange(repeat):
+            args = [prepare() for i in xrange(number)] if prepare else [()] * number
+            start = time.time()
+            for a in args:
+                run(*a)
+            elapsed = time.time() - start
+            if best is None or elapsed < best: best = elapsed
+    finally:
+        if enabled: gc.enable()
+    return best * 1e6 / number / per
+
+def physics_benchmarks(match):
+    pf = match.playfield
+    piece = match.next_piece['Server']
+    column = WIDTH/4 - piece.shape.extents[0]
+    def drop_prepare():
+        return piece.copy(), pf.copy()
+    def tick_prepare():
+        p, f = drop_prepare()
+        p.drop(f, column, 0)
+        return f,
+    yield 'copy', pf.copy, None, 100, 1
+    yield 'drop', lambda p, f: p.drop(f, column, 0), drop_prepare, 100, 1
+    yield 'tick idle', pf.copy().tick, None, 1000, 1
+    yield 'tick after drop', sim.Playfield.tick, tick_prepare, 100, 1
+    if pf.pieces:
+        # The bottom of the tallest tower, or failing that the lowest piece:
+        # the most is resting on it
+        x = pf.column_heights.index(min(pf.column_heights))
+        victim = pf.at(x, HEIGHT-1) or max(pf.pieces.values(), key=lambda p: pf.order[p])
+        def destroy_prepare():
+            return victim, pf.copy()
+        def settle_prepare():
+            v, f = destroy_prepare()
+            v.destroy(f)
+            return f,
+        yield 'destroy', sim.Piece.destroy, destroy_prepare, 100, 1
+        yield 'tick after destroy', sim.Playfield.tick, settle_prepare, 100, 1
+
+# The whole match, as sent to a client joining a game under way
+def state_benchmarks(match):
+    data = state.encode(match)
+    yield 'encode state', lambda: state.encode(match), None, 20, 1
+    yield 'decode state', lambda: state.decode(data), None, 20, 1
+
+# Handing the board over to a render process (see display.py): after the
+# pieces have changed, when they haven't, and reading it on the other side
+def display_benchmarks(match):
+    snapshot = display.Snapshot(match.board)
+    def publish(changed):
+        if changed: snapshot.shown = (None, 0, [])
+        snapshot.publish(match, 'Server', [], (None, 0, 0), 0., 1.)
+    publish(True)
+    publish(True)
+    yield 'publish', lambda: publish(True), None, 100, 1
+    yield 'publish idle', lambda: publish(False), None, 1000, 1
+    yield 'read', lambda: snapshot.read(None), None, 100, 1
+
+# Dealing a new piece (after the first, which loads the library)
+def piece_benchmarks():
+    rng = random.Random(0)
+    sim.Piece(0, rng)
+    yield 'spawn', lambda: sim.Piece(0, rng), None, 1000, 1
+
+def cascade_benchmarks(match, move):
+    role, column, rotation = move
+    piece = match.next_piece[role]
+    def prepare():
+        p, f = piece.copy(), match.playfield.copy()
+        p.drop(f, column, rotation)
+        return f,
+    yield 'tick after drop', sim.Playfield.tick, prepare, 50, 1
+
+def render_benchmarks(match):
+    import world
+    def setup():
+        world.match = match
+        world.frameno = match.frameno
+    def full():
+        setup()
+        world.shown_streaks = []
+        world.shown_screen = None
+        world.render_frame()
+    def idle():
+        if world.match is not match:
+            full()
+        world.render_frame()
+    piece = match.next_piece['Server']
+    def sprite():
+        world.sprites.clear()
+        world.piece_sprite(piece.oriented(), 5, piece._color)
+    yield 'render full', full, None, 20, 1
+    yield 'render idle', idle, None, 200, 1
+    yield 'render sprite', sprite, None, 200, 1
+
+# Reading 1000 frames of input through a Stream, as run_events does, and
+# writing it; per event.
+def network_benchmarks():
+    rng = random.Random(0)
+    frames = []
+    for frame in xrange(1000):
+        frames.append((frame, [protocol.Drop(rng.choice(protocol.ROLES), rng.randrange(WIDTH), rng.randrange(4))
+                               for i in xrange(4)]))
+    events = sum(len(evs) for frame, evs in frames)
+    for name, codec in sorted(protocol.codecs.items()):
+        data = ''.join(codec.encode(frame, evs) for frame, evs in frames)
+        stream = net.Stream(0)
+        def decode(codec=codec, data=data):
+            stream.inbuf, stream.inpos = bytearray(data), 0
+            while stream.read(codec): pass
+        def encode(codec=codec):
+            for frame, evs in frames:
+                codec.encode(frame, evs)
+        yield 'decode %s' % name, decode, None, 5, events
+        yield 'encode %s' % name, encode, None, 5, events
+
+# Logging a message at --trace, as the game does, and writing it out as
+# text and as a binary trace, as the writer thread does; per message
+def log_benchmarks():
+    log = ringlog.Log(os.devnull, 5)
+    log.close() # Run the writer's side here instead
+    kwargs = {'scancode': 0, 'key': 113, 'unicode': u'q', 'mod': 0}
+    def reset():
+        log.tail = log.head
+        return ()
+    def write(binary):
+        log.binary = binary
+        log.ring[:1000] = [(1, 0., 5, 'PygameEvent', 'KeyDown', kwargs)] * 1000
+        log.tail, log.head = 0, 1000
+        log.drain()
+    yield 'message', lambda: log.record(1, 5, 'PygameEvent', 'KeyDown', kwargs), reset, 1000, 1
+    yield 'write text', lambda: write(False), None, 10, 1000
+    yield 'write trace', lambda: write(True), None, 10, 1000
+
+def run(options):
+    results = {}
+    def record(suffix, benchmarks):
+        for name, func, prepare, number, per in benchmarks:
+            name = '%s/%s' % (name, suffix)
+            if options.only and options.only not in name: continue
+            results[name] = timed(func, prepare, number, per, options.repeat)
+            print '%-32s %10.2f us' % (name, results[name])
+    print 'Building boards'
+    built = boards(options.seed)
+    for board in ('empty', 'half', 'tall'):
+        heights = built[board].playfield.column_heights
+        print '%-8s %3d pieces, top rows %d/%d' % (board, len(built[board].playfield.pieces),
+                                                   min(heights[:WIDTH/2]), min(heights[WIDTH/2:]))
+    match, move, collapsed = built['cascade']
+    print 'cascade  %3d pieces come down' % collapsed
+    print
+    for board in ('empty', 'half', 'tall'):
+        record(board, physics_benchmarks(built[board]))
+        record(board, state_benchmarks(built[board]))
+        record(board, display_benchmarks(built[board]))
+    record('cascade', cascade_benchmarks(match, move))
+    record('piece', piece_benchmarks())
+    if options.render:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        import pygame, world
+        pygame.init()
+        parser = OptionParser()
+        world.add_options(parser)
+        render_options, args = parser.parse_args([])
+        world.init_display(render_options)
+        for board in ('empty', 'half', 'tall'):
+            record(board, render_benchmarks(built[board]))
+    record('event', network_benchmarks())
+    record('log', log_benchmarks())
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print
+    print '%-32s %10s %10s %8s' % ('', 'baseline', 'now', 'change')
+    for name in sorted(results):
+        if name not in baseline: continue
+        change = 100. * (results[name] - baseline[name]) / baseline[name]
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-32s %10.2f %10.2f %+7.1f%%%s' % (name, baseline[name], results[name], change, flag)
+    return regressions
+
+if __name__ == '__main__':
+    options, args = option_parser.parse_args()
+    baseline = None
+    if options.compare:
+        baseline = json.load(open(options.compare))['results']
+    results = run(options)
+    if options.save:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                   'seed': options.seed, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'units': 'microseconds per call', 'results': results},
+                  open(options.save, 'w'), indent=1, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print '%d regressions' % len(regressions)
+            sys.exit(1)
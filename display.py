@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Drawing in a process of its own (towerwars.py --render-process), so that
+# a slow frame on the screen never holds up the game, and the two can use
+# a core each.
+#
+# The game process keeps everything else, and after each tick publishes
+# what there is to draw to a Snapshot in shared memory: the streaks, the
+# falling piece, and, when they have changed, the grid and the table of
+# pieces on the board (and the debris, see world.tick).  The render process
+# opens the window, copies the latest snapshot into a match of its own
+# whenever there is a new one, draws it with world.render_frame as often as
+# --render-fps says, and sends its input back over a pipe, to be handled
+# as if it had come from pygame in the game process.  Moving the view
+# (world.view_key) is handled in the render process, as only it has one.
+#
+# A Snapshot has two buffers.  The game writes to the one not published,
+# then publishes it, so it never waits for the renderer.  Each buffer
+# starts with a count that is odd while it is being written, which the
+# renderer checks before and after reading; if it changed (the game has
+# published twice while the renderer was reading), the renderer reads
+# again, a few times at most before drawing what it had instead, so that
+# a game that died part way through publishing can't hold it up.
+#
+# A buffer is, in native byte order:
+#     count (uint32)
+#     frame (uint32)  next tick, tick length (double)  version (uint32)
+#     screen, last winner, role, moved (uint8)  x before the tick (int32)
+#     opacity before the tick (uint8)
+#     streaks: row (uint16) for each column, then colour (uint8)
+#     the falling piece
+#     pieces, debris, chunks in the grid (uint32)
+#     each chunk's (x, y) (uint16), then its cells as in Playfield.chunks
+#     the pieces on the board, then the debris
+# and each piece is
+#     id (uint32)  x y (int32)  opacity colour (uint8)
+#     cells count (uint8), (x, y) for each (int8), the rest zero
+# as placed, so rotated as shown.  version goes up whenever the pieces do
+# (or the debris) change; the tables after it are only written to a buffer
+# that doesn't have them yet, and only read by a renderer that doesn't.
+# moved is set if the falling piece is the one that was falling before
+# the last tick, which was at x and opacity then (see world.render_frame).
+
+import time, signal, struct, ctypes, traceback, multiprocessing
+from array import array
+
+import pygame
+from pygame.locals import *
+
+import sim, net, world
+
+count = struct.Struct('=I')
+header = struct.Struct('=IddIBBBBiB')
+counts = struct.Struct('=III')
+
+SCREENS = ['Game', 'GameOver']
+WINNERS = [None, 'Server', 'Client']
+ROLES = ['Server', 'Client']
+COLOR_INDEX = dict((c, i) for i, c in enumerate(sim.COLORS))
+
+CHUNK_BYTES = sim.CHUNK * sim.CHUNK * sim.EMPTY_CHUNK.itemsize
+
+READ_TRIES = 20
+READ_RETRY = 0.0002     # seconds between tries, for the game to finish
+
+class Snapshot:
+    def __init__(self, board):
+        width, height, goal = self.board = board
+        if sim.library.shapes is None: sim.library.load()
+        self.cells = sim.library.size
+        self.piece = struct.Struct('=IiiBBB%db' % (2*self.cells))
+        self.max_chunks = (((width + sim.CHUNK_MASK) >> sim.CHUNK_BITS) *
+                           ((height + sim.CHUNK_MASK) >> sim.CHUNK_BITS))
+        # Room for a full board, and as much again of debris
+        self.capacity = 2*width*height/self.cells + 16
+        self.streaks_at = count.size + header.size
+        self.next_at = self.streaks_at + 3*width
+        self.counts_at = self.next_at + self.piece.size
+        self.keys_at = self.counts_at + counts.size
+        self.chunks_at = self.keys_at + 4*self.max_chunks
+        self.table_at = self.chunks_at + CHUNK_BYTES*self.max_chunks
+        self.size = self.table_at + self.piece.size*self.capacity
+        self.raw = multiprocessing.RawArray('c', 2*self.size)
+        self.address = ctypes.addressof(self.raw)
+        self.published = multiprocessing.RawValue('i', 0)
+        # The game's side
+        self.version = 0
+        self.shown = (None, 0, [])      # pieces dict, changes and debris last published
+        self.packed = {}                # piece -> its entry in the table
+        self.written = [None, None]     # version each buffer holds
+
+    def pack(self, piece):
+        cells = [v for cell in piece.oriented().cells for v in cell]
+        return self.piece.pack(piece.id or 0, piece.x, piece.y, piece.opacity,
+                               COLOR_INDEX[piece._color], len(cells)/2,
+                               *(cells + [0] * (2*self.cells - len(cells))))
+
+    def unpack(self, entry):
+        values = self.piece.unpack(entry)
+        id, x, y, opacity, color, n = values[:6]
+        piece = sim.Piece.__new__(sim.Piece)
+        piece.id = id or None
+        piece.x, piece.y, piece.rotation = x, y, 0
+        piece.opacity = opacity
+        piece._color = sim.COLORS[color]
+        piece.dropFrame = None
+        cells = values[6:6 + 2*n]
+        piece.shape = sim.shape(zip(cells[0::2], cells[1::2]))
+        return piece
+
+    # Called by the game, once a tick.  last_position is world's.
+    def publish(self, match, role, debris, last_position, next_tick, tick_length):
+        pf = match.playfield
+        if pf.pieces is not self.shown[0] or pf.changes != self.shown[1] or debris != self.shown[2]:
+            self.version += 1
+            self.shown = (pf.pieces, pf.changes, list(debris))
+        b = 1 - self.published.value
+        base = b * self.size
+        n, = count.unpack_from(self.raw, base)
+        count.pack_into(self.raw, base, n + 1)
+
+        piece = match.next_piece[role]
+        last, x, opacity = last_position
+        header.pack_into(self.raw, base + count.size, match.frameno, next_tick, tick_length,
+                         self.version, SCREENS.index(match.screen), WINNERS.index(match.last_winner),
+                         ROLES.index(role), last is piece, x, opacity)
+        rows, colors = zip(*pf.streaks)
+        struct.pack_into('=%dH%dB' % (len(rows), len(colors)), self.raw, base + self.streaks_at,
+                         *(rows + colors))
+        ctypes.memmove(self.address + base + self.next_at, self.pack(piece), self.piece.size)
+
+        if self.written[b] != self.version:
+            pieces = pf.pieces.values()[:self.capacity]
+            table = pieces + debris[:self.capacity - len(pieces)]
+            packed = dict((p, self.packed.get(p) or self.pack(p)) for p in table)
+            self.packed = packed
+            data = ''.join(packed[p] for p in table)
+            ctypes.memmove(self.address + base + self.table_at, data, len(data))
+            keys = sorted(pf.chunks)
+            counts.pack_into(self.raw, base + self.counts_at, len(pieces), len(table) - len(pieces),
+                             len(keys))
+            struct.pack_into('=%dH' % (2*len(keys)), self.raw, base + self.keys_at,
+                             *[v for key in keys for v in key])
+            at = self.address + base + self.chunks_at
+            for key in keys:
+                ctypes.memmove(at, pf.chunks[key].buffer_info()[0], CHUNK_BYTES)
+                at += CHUNK_BYTES
+            self.written[b] = self.version
+
+        count.pack_into(self.raw, base, n + 2)
+        self.published.value = b
+
+    # Called by the renderer: the latest snapshot, as (header, streaks,
+    # falling piece, tables), where tables is None if known is its version,
+    # or None if the game was in the middle of publishing every time.
+    def read(self, known):
+        for i in xrange(READ_TRIES):
+            if i: time.sleep(READ_RETRY)
+            base = self.address + self.published.value * self.size
+            n, = count.unpack(ctypes.string_at(base, count.size))
+            if n & 1: continue
+            data = ctypes.string_at(base, self.counts_at)
+            fields = header.unpack_from(data, count.size)
+            tables = None
+            if fields[3] != known:
+                pieces, debris, chunks = counts.unpack(ctypes.string_at(base + self.counts_at, counts.size))
+                tables = (pieces, debris,
+                          struct.unpack('=%dH' % (2*chunks), ctypes.string_at(base + self.keys_at, 4*chunks)),
+                          ctypes.string_at(base + self.chunks_at, CHUNK_BYTES*chunks),
+                          ctypes.string_at(base + self.table_at, self.piece.size*(pieces + debris)))
+            if count.unpack(ctypes.string_at(base, count.size))[0] == n:
+                break
+        else:
+            return None
+        width = self.board[0]
+        streaks = struct.unpack_from('=%dH%dB' % (width, width), data, self.streaks_at)
+        return fields, zip(streaks[:width], streaks[width:]), data[self.next_at:], tables
+
+# The render process's copy of the match, kept up to date from a Snapshot
+class Mirror:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.version = None
+        self.pieces = {}    # entry in the table -> piece
+        self.frame = None
+        self.next_tick = 0
+        self.tick_length = 1
+        self.match = world.match = sim.Match(0, *snapshot.board)
+
+    # Whether there is anything to draw yet
+    def update(self):
+        snapshot = self.snapshot.read(self.version)
+        if snapshot is None: return self.frame is not None
+        fields, streaks, next_piece, tables = snapshot
+        frame, self.next_tick, self.tick_length, version, screen, winner, role, moved, x, opacity = fields
+        if not version: return False
+        if frame == self.frame: return True
+        self.frame = frame
+        match = self.match
+        pf = match.playfield
+        if tables:
+            self.version = version
+            pieces, debris, keys, chunks, table = tables
+            size = self.snapshot.piece.size
+            entries = [table[i:i+size] for i in xrange(0, len(table), size)]
+            self.pieces = dict((e, self.pieces.get(e) or self.snapshot.unpack(e)) for e in entries)
+            pf.pieces = dict((p.id, p) for p in (self.pieces[e] for e in entries[:pieces]))
+            pf.changes = version
+            world.debris[:] = [self.pieces[e] for e in entries[pieces:]]
+            pf.chunks = dict(((keys[2*i], keys[2*i+1]), array('i', chunks[i*CHUNK_BYTES:(i+1)*CHUNK_BYTES]))
+                             for i in xrange(len(keys)/2))
+        pf.streaks = streaks
+        pf.column_heights = [h for h, c in streaks]
+        match.frameno = world.frameno = frame
+        match.screen = SCREENS[screen]
+        match.last_winner = WINNERS[winner]
+        if ROLES[role] != world.role:
+            world.set_role(ROLES[role])
+        piece = self.snapshot.unpack(next_piece)
+        match.next_piece[world.role] = piece
+        world.last_position = (piece if moved else None, x, opacity)
+        return True
+
+# The game's end: starts the render process, and passes on what it sends
+class Renderer:
+    def __init__(self, options):
+        self.snapshot = Snapshot((options.board_width, options.board_height, options.goal_row))
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.run, args=(options, child))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.closed = False
+
+    def publish(self, next_tick, tick_length):
+        self.snapshot.publish(world.match, world.role, world.debris, world.last_position,
+                              next_tick, tick_length)
+
+    # The input since last time, as pygame events.  If the render process
+    # has gone, as if its window had been closed.
+    def events(self):
+        rtn = []
+        try:
+            while self.conn.poll():
+                type, fields = self.conn.recv()
+                rtn.append(pygame.event.Event(type, fields))
+        except (EOFError, IOError):
+            if not self.closed:
+                self.closed = True
+                rtn.append(pygame.event.Event(QUIT))
+        return rtn
+
+    def close(self):
+        self.conn.close()
+        self.process.join(1.)
+
+    # The render process.  It stops when the game closes its end of the
+    # pipe (or sends anything on it); Ctrl-C is for the game to handle.
+    def run(self, options, conn):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.conn.close()
+        pygame.init()
+        world.init_display(options)
+        forward = set(type for type in xrange(pygame.NUMEVENTS)
+                      if hasattr(world, 'H_PYGAME_%s' % pygame.event.event_name(type)))
+        mirror = Mirror(self.snapshot)
+        render_interval = 1./options.render_fps if options.render_fps > 0 else 0
+        next_render = net.monotonic()
+        while True:
+            for ev in pygame.event.get():
+                if ev.type == KEYDOWN:
+                    world.view_key(ev.key)
+                if ev.type in forward:
+                    conn.send((ev.type, ev.dict))
+            now = net.monotonic()
+            try:
+                if mirror.update():
+                    progress = min(max(1 - (mirror.next_tick - now) / mirror.tick_length, 0), 1)
+                    world.render_frame(progress)
+            except Exception, e:
+                traceback.print_exc()
+            next_render = max(next_render + render_interval, now)
+            world.collect_garbage(next_render - net.monotonic())
+            if conn.poll(max(next_render - net.monotonic(), 0)):
+                break
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Non-blocking I/O.  Everything the main loop waits on (the log, the
+# listening socket, the peer connection) is a transport registered with a
+# Reactor.  The reactor keeps the kernel's interest set up to date as
+# transports start and stop wanting to write, instead of rebuilding fd lists
+# on every wait, and uses epoll or poll where the platform has them.
+
+import os, sys, errno, select, socket, time, math
+
+READ = 1
+WRITE = 4
+
+# Seconds on a clock that only ever goes forwards, for pacing and timing:
+# time.time() jumps whenever the system clock is set.  Python 2 has no
+# monotonic clock of its own, so on Linux this asks the C library for it;
+# elsewhere it falls back to time.time().
+def _clock():
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        if not sys.platform.startswith('linux'): return time.time
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) != 0: return time.time
+    except (ImportError, OSError, AttributeError):
+        return time.time
+    # A timespec of its own for each call, so that any thread can read the
+    # clock (ringlog.py runs one beside the game)
+    def monotonic():
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ts)
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _clock()
+
+class Reactor:
+    def __init__(self):
+        self.transports = {}    # fd -> transport
+        self.masks = {}         # fd -> interest mask
+        self.polled = set()     # fds currently registered with the poller
+        self.files = set()      # fds the poller refuses (regular files)
+        self.profiler = None    # see profiler.py
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+        elif hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+
+    def register(self, transport):
+        fd = transport.fileno()
+        self.transports[fd] = transport
+        self.masks[fd] = 0
+        transport.reactor = self
+        self.update(transport)
+
+    def unregister(self, transport):
+        fd = transport.fileno()
+        del self.transports[fd], self.masks[fd]
+        self.files.discard(fd)
+        if fd in self.polled:
+            self.polled.remove(fd)
+            self.poller.unregister(fd)
+        transport.reactor = None
+
+    # Transports call this when what they want to do changes.  Idle fds are
+    # taken out of the poller altogether, as it reports hangups regardless.
+    def update(self, transport):
+        fd = transport.fileno()
+        mask = transport.interest()
+        if fd not in self.masks or (self.masks[fd] == mask and fd in self.polled): return
+        self.masks[fd] = mask
+        if not self.poller or fd in self.files: return
+        if not mask:
+            if fd in self.polled:
+                self.polled.remove(fd)
+                self.poller.unregister(fd)
+        elif fd in self.polled:
+            self.poller.modify(fd, mask)
+        else:
+            try:
+                self.poller.register(fd, mask)
+                self.polled.add(fd)
+            except (IOError, OSError), e:
+                if e.errno != errno.EPERM: raise
+                self.files.add(fd) # Always ready; see wait()
+
+    def wait(self, timeout):
+        ready = [(fd, self.masks[fd]) for fd in self.files if self.masks[fd]]
+        if ready:
+            timeout = 0
+        # A signal that is caught (pygame catches SIGINT and SIGTERM) cuts
+        # the wait short, which just means nothing is ready yet.  epoll
+        # rounds its timeout down to a millisecond, so it is rounded up here
+        # as poll's is, rather than waking up just before the next tick.
+        try:
+            if self.poller is None:
+                rd = [fd for fd, m in self.masks.iteritems() if m & READ]
+                wr = [fd for fd, m in self.masks.iteritems() if m & WRITE]
+                if rd or wr:
+                    rd, wr, ex = select.select(rd, wr, [], timeout)
+                    ready += [(fd, READ) for fd in rd] + [(fd, WRITE) for fd in wr]
+                else:
+                    time.sleep(timeout)
+            elif not self.polled:
+                time.sleep(timeout)
+            elif isinstance(self.poller, select.epoll):
+                ready += self.poller.poll(math.ceil(timeout*1000)/1000.)
+            else:
+                ready += self.poller.poll(int(math.ceil(timeout*1000)))
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR: raise
+        if self.profiler: self.profiler.mark('idle')
+        for fd, events in ready:
+            transport = self.transports.get(fd)
+            if transport is None: continue
+            if events & WRITE:
+                transport.on_writable()
+            if events & ~WRITE and self.masks.get(fd, 0) & READ:
+                transport.on_readable()
+        if self.profiler: self.profiler.mark('io')
+
+
+# A byte stream over a file descriptor with its own input and output
+# buffers.  Output is appended to a bytearray and written from an offset,
+# so partial writes never copy what is left; input is decoded in place by a
+# protocol codec and compacted once it has been consumed.
+class Stream:
+    def __init__(self, file):
+        self.inbuf  = bytearray()
+        self.inpos  = 0
+        self.outbuf = bytearray()
+        self.outpos = 0
+        self.open = True
+        self.fileobj = None
+        self.reactor = None
+        self.last_read = 0  # monotonic() time of the last data received
+        if isinstance(file, int):
+            self.fd = file
+        elif hasattr(file, 'fileno'):
+            self.fd = file.fileno()
+            self.fileobj = file
+        else:
+            self.fd = os.open(file, os.O_WRONLY | os.O_APPEND)
+
+    def fileno(self):
+        return self.fd
+
+    def interest(self):
+        return (READ if self.open and self.readable() else 0) | (WRITE if self.rts() else 0)
+
+    def readable(self):
+        return True
+
+    def write(self, data):
+        idle = not self.rts()
+        self.outbuf += data
+        if idle and self.reactor: self.reactor.update(self)
+
+    def on_writable(self):
+        try:
+            self.outpos += os.write(self.fd, buffer(self.outbuf, self.outpos))
+        except OSError, e:
+            if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                self.open = False # Nobody left to send to
+                self.outpos = len(self.outbuf)
+            elif e.errno not in (errno.EAGAIN, errno.EINTR): raise
+        if self.outpos == len(self.outbuf):
+            del self.outbuf[:]
+            self.outpos = 0
+            if self.reactor: self.reactor.update(self)
+        elif self.outpos > 65536:
+            del self.outbuf[:self.outpos]
+            self.outpos = 0
+
+    send = on_writable
+
+    # Block until everything buffered has been written
+    def flush(self):
+        while self.rts():
+            select.select([], [self.fd], [])
+            self.on_writable()
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+            self.inbuf += data
+            self.last_read = monotonic()
+            if not data: self.open = False # EOF
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR): return
+            self.open = False
+        if not self.open and self.reactor: self.reactor.update(self)
+
+    recv = on_readable
+
+    # Decode the next message from the input buffer with codec (see
+    # protocol.py); returns [] when there isn't a whole one yet.
+    def read(self, codec):
+        messages, self.inpos = codec.decode(self.inbuf, self.inpos)
+        if self.inpos == len(self.inbuf) or self.inpos > 65536:
+            del self.inbuf[:self.inpos]
+            self.inpos = 0
+        return messages
+
+    def rts(self):
+        return len(self.outbuf) - self.outpos
+
+    def rtr(self):
+        return self.open
+
+# An output-only stream: the log, recordings
+class Writer(Stream):
+    def readable(self):
+        return False
+
+# A connected TCP socket
+class Connection(Stream):
+    def __init__(self, sock):
+        Stream.__init__(self, sock)
+        sock.setblocking(0)
+
+# A listening socket; accept(sock, addr) is called for each new connection
+class Listener:
+    def __init__(self, sock, accept):
+        self.socket = sock
+        self.accept = accept
+        self.reactor = None
+        sock.setblocking(0)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def interest(self):
+        return READ
+
+    def on_readable(self):
+        try:
+            sock, addr = self.socket.accept()
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR): return
+            raise
+        self.accept(sock, addr)
+
+    def on_writable(self):
+        pass
+
+# A socket connecting to address without blocking.  error is None while it
+# is on its way, or what the connect came back with if that was straight
+# away (0 if it got through).  Once registered, the reactor says when it is
+# writable, which is when the connect is over one way or the other: then
+# it takes itself out, and calls connected(sock) or failed(error).
+class Connector:
+    def __init__(self, sock, address, connected, failed):
+        self.socket = sock
+        self.connected = connected
+        self.failed = failed
+        self.reactor = None
+        sock.setblocking(0)
+        self.error = sock.connect_ex(address)
+        if self.error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR):
+            self.error = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def interest(self):
+        return WRITE
+
+    def on_readable(self):
+        pass
+
+    def on_writable(self):
+        self.finish(self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
+
+    def finish(self, error):
+        if self.reactor: self.reactor.unregister(self)
+        if error:
+            self.socket.close()
+            self.failed(error)
+        else:
+            self.connected(self.socket)
+
+    # Give up on it
+    def close(self):
+        if self.reactor: self.reactor.unregister(self)
+        self.socket.close()
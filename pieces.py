@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Builds the piece library, pieces.dat (see sim.Library).
+#
+#     pieces.py [--samples N] [--seed N] [--out FILE]
+#
+# Pieces used to be grown as they were needed, by a random walk from a
+# single cell.  This grows --samples of them the same way and keeps every
+# distinct shape that came up, weighted by how often it did, so the game
+# deals out much the same mix as before.  A shape counts as the same in
+# any rotation, and is stored turned and shifted to a canonical position,
+# with the cell nearest its centre of gravity at (0, 0), as pieces rotate
+# about that cell.
+#
+# The file is
+#     towerwars-pieces <version> <cells per piece> <shapes>\n
+# then, zlib compressed, each shape's weight as a little endian uint32,
+# followed by each shape's cells as (x, y) pairs of signed bytes.  Both
+# sides of a game have to have the same one; peers compare a checksum of
+# it when they connect.
+
+import sys, random, zlib
+from array import array
+from optparse import OptionParser
+
+import sim
+
+option_parser = OptionParser()
+option_parser.add_option('--samples', action='store', type='int', dest='samples', default=1000000, help='Pieces to grow')
+option_parser.add_option('--seed', action='store', type='int', dest='seed', default=1)
+option_parser.add_option('--size', action='store', type='int', dest='size', default=sim.PIECE_SIZE, help='Cells per piece')
+option_parser.add_option('--out', action='store', type='string', dest='out', default=sim.LIBRARY_PATH, help='File to write')
+
+# The old generator
+def grow(rng, size):
+    cells = set([(0,0)])
+    while len(cells) < size:
+        rx, ry = rng.choice(list(cells))
+        candidate_cells = set([(rx, ry+1), (rx, ry-1), (rx+1, ry), (rx-1,ry)]) - cells
+        if len(candidate_cells) < 2: continue
+        cells.add(rng.choice(list(candidate_cells)))
+    return cells
+
+# The least, as a sorted tuple, of the shape's rotations about each of the
+# cells nearest its centre of gravity; the same for every rotation of it.
+def canonical(cells):
+    n = len(cells)
+    sx = sum(x for x, y in cells)
+    sy = sum(y for x, y in cells)
+    distance = dict(((x, y), (n*x - sx)**2 + (n*y - sy)**2) for x, y in cells)
+    nearest = min(distance.values())
+    forms = []
+    for ax, ay in cells:
+        if distance[(ax, ay)] != nearest: continue
+        shifted = [(x - ax, y - ay) for x, y in cells]
+        for turn in sim.ROTATIONS:
+            forms.append(tuple(sorted(turn(c) for c in shifted)))
+    return min(forms)
+
+def build(samples, seed, size):
+    rng = random.Random(seed)
+    counts = {}
+    for i in xrange(samples):
+        form = canonical(grow(rng, size))
+        counts[form] = counts.get(form, 0) + 1
+    # Commonest first
+    return sorted(((count, form) for form, count in counts.iteritems()),
+                  key=lambda (count, form): (-count, form))
+
+def write(f, table, size):
+    weights = array('I', [count for count, form in table])
+    cells = array('b', [v for count, form in table for cell in form for v in cell])
+    if sys.byteorder == 'big': weights.byteswap()
+    f.write('%s %d %d %d\n' % (sim.LIBRARY_MAGIC, sim.LIBRARY_VERSION, size, len(table)))
+    f.write(zlib.compress(weights.tostring() + cells.tostring(), 9))
+
+if __name__ == '__main__':
+    options, args = option_parser.parse_args()
+    table = build(options.samples, options.seed, options.size)
+    f = open(options.out, 'wb')
+    write(f, table, options.size)
+    f.close()
+    print '%d shapes from %d pieces; the commonest came up %d times, %d only once' % \
+        (len(table), options.samples, table[0][0], len([c for c, form in table if c == 1]))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Where does the frame go?  The main loop calls mark(phase) as it finishes
+# each part of a frame, which charges the time since the previous mark to
+# that phase, and end_frame() at the top of each frame, which adds up the
+# frame just finished.  Each phase gets a histogram of its time per frame,
+# and when the main loop has to drop a frame the blame goes to whichever
+# phase took longest in the frame before.
+#
+# Everything that calls mark() checks for a profiler first, so with
+# --profile off the only cost is that test.
+
+import bisect
+
+from net import monotonic
+
+# Upper edges of the histogram buckets, in ms; one more bucket for anything
+# longer.
+BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100]
+
+# In the order they happen.  idle is time spent waiting for the next frame,
+# so it isn't work and is never to blame for a dropped frame.
+PHASES = ['render', 'gc', 'idle', 'io', 'network', 'input', 'rollback',
+          'events', 'physics', 'send']
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.n += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    # The upper edge of the bucket the p'th fraction of samples fall in
+    def percentile(self, p):
+        seen = 0
+        for edge, count in zip(BUCKETS + [self.max], self.counts):
+            seen += count
+            if seen >= p * self.n: return edge
+        return self.max
+
+    def summary(self):
+        return {'frames': self.n, 'mean': round(self.total / max(self.n, 1), 3),
+                'max': round(self.max, 3), 'p50': self.percentile(.5),
+                'p90': self.percentile(.9), 'p99': self.percentile(.99),
+                'hist': self.counts}
+
+class Profiler:
+    def __init__(self, budget):
+        self.budget = budget * 1000.  # ms per frame
+        self.frame = dict((p, 0.) for p in PHASES)
+        self.last_frame = self.frame.copy()
+        self.recent = dict((p, Histogram()) for p in PHASES + ['work'])
+        self.overall = dict((p, Histogram()) for p in PHASES + ['work'])
+        self.recent_dropped = {}
+        self.overall_dropped = {}
+        self.last = monotonic()
+
+    def mark(self, phase):
+        now = monotonic()
+        self.frame[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        work = 0.
+        for phase, seconds in self.frame.iteritems():
+            ms = seconds * 1000.
+            if phase != 'idle': work += ms
+            self.recent[phase].add(ms)
+            self.overall[phase].add(ms)
+            self.last_frame[phase] = ms
+            self.frame[phase] = 0.
+        self.recent['work'].add(work)
+        self.overall['work'].add(work)
+
+    # The main loop is dropping a frame: blame the slowest phase of the
+    # last one.  Returns the phase.
+    def drop(self):
+        cause = max((ms, p) for p, ms in self.last_frame.iteritems() if p != 'idle')[1]
+        self.recent_dropped[cause] = self.recent_dropped.get(cause, 0) + 1
+        self.overall_dropped[cause] = self.overall_dropped.get(cause, 0) + 1
+        return cause
+
+    def log_histograms(self, log, label, histograms, dropped):
+        log.msg(3, label, 'Buckets', ms=BUCKETS, budget=self.budget)
+        for phase in PHASES + ['work']:
+            log.msg(3, label, phase, **histograms[phase].summary())
+        log.msg(3, label, 'Dropped', **dropped)
+
+    # The frames since the last report
+    def report(self, log):
+        self.log_histograms(log, 'Profile', self.recent, self.recent_dropped)
+        self.recent = dict((p, Histogram()) for p in PHASES + ['work'])
+        self.recent_dropped = {}
+
+    # The whole run, on exit
+    def dump(self, log):
+        self.log_histograms(log, 'ProfileTotal', self.overall, self.overall_dropped)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Wire formats for game events.
+#
+# Peers start out talking the original text protocol, one event per line:
+#     <frame> <name> <arg> <arg> ...\n
+# The clock sync pings carry the binary versions a peer understands as
+# extra words, which older peers ignore.  When the server sees one it
+# shares, it names it at the end of its synchronize line and switches to
+# it from then on; the client switches its input there and its output after
+# answering with a 'switch' line.
+#
+# The binary format sends every event for one frame as a single packet:
+#     length (uint16, bytes after this field)  frame (uint32)  count (uint8)
+# followed by count events, each a type id (uint8) and its packed fields.
+# A frame with more than MAX_EVENTS events goes as several packets, one
+# after another.
+
+import struct
+from collections import namedtuple
+
+BINARY_VERSION = 'binary1'
+
+ROLES = ['Server', 'Client']
+
+# Field types: struct code, text format, value -> wire, wire -> value,
+# text -> value
+FIELDS = {
+    'uint': ('I', '%d', int,        int,               int),
+    'int':  ('i', '%d', int,        int,               int),
+    'role': ('B', '%s', ROLES.index, ROLES.__getitem__, str),
+}
+
+# Event name -> (field name, type) pairs.  Type ids are positions in this
+# list, so only ever append to it.
+EVENTS = [
+    ('randomize', [('seed', 'uint')]),
+    ('reset',     []),
+    ('drop',      [('role', 'role'), ('col', 'int'), ('rot', 'int')]),
+    ('quit',      []),
+    ('clock',     [('sent', 'uint'), ('echo', 'uint'), ('held', 'uint'), ('delay', 'uint')]),
+    ('hash',      [('value', 'uint')]),
+]
+
+# An event is a tuple of its fields, already in their proper types.  Its
+# class carries everything the codecs need, worked out from the schema once
+# when this module loads.
+class Event(tuple):
+    __slots__ = ()
+
+def event_class(id, name, fields):
+    types = [FIELDS[t] for f, t in fields]
+    base = namedtuple(name.capitalize(), [f for f, t in fields])
+    return type(base.__name__, (base, Event), {
+        '__slots__': (),
+        '__module__': __name__,
+        'id': id,
+        'name': name,
+        'text': '%%d %s\n' % ' '.join([name] + [t[1] for t in types]),
+        'struct': struct.Struct('!B' + ''.join(t[0] for t in types)),
+        'encoders': [t[2] for t in types],
+        'decoders': [t[3] for t in types],
+        'parsers': [t[4] for t in types],
+    })
+
+event_classes = [event_class(i, name, fields) for i, (name, fields) in enumerate(EVENTS)]
+event_names = dict((c.name, c) for c in event_classes)
+Randomize, Reset, Drop, Quit, Clock, Hash = event_classes
+
+# Handlers for each event type, indexed by id: namespace's attribute named
+# prefix + the event's name, or None if it has none.  Built once, so that
+# dispatching an event is a list lookup.
+def dispatch_table(namespace, prefix='H_EVENT_'):
+    return [getattr(namespace, prefix + c.name, None) for c in event_classes]
+
+header = struct.Struct('!HIB')
+MAX_EVENTS = 255    # per packet
+
+# Both sides have to play on the same board.  Pings say which as another
+# extra word,
+#     board=<width>,<height>,<goal row>
+# and a peer that doesn't is on the standard one.
+def board_feature(board):
+    return 'board=%d,%d,%d' % tuple(board)
+
+def peer_board(words, standard):
+    for word in words:
+        if word.startswith('board='):
+            return tuple(int(n) for n in word[6:].split(','))
+    return standard
+
+# And deal from the same piece library (see sim.Library), named by its
+# checksum,
+#     pieces=<hex>
+# A peer that doesn't say grows its pieces the old way, so can't play.
+def pieces_feature(library_id):
+    return 'pieces=%08x' % library_id
+
+def peer_pieces(words):
+    for word in words:
+        if word.startswith('pieces='):
+            return int(word[7:], 16)
+    return None
+
+# A client rejoining a game says which state it has to go on from (see
+# EventManager.send_state),
+#     resume=<frame>
+def resume_feature(frame):
+    return 'resume=%d' % frame
+
+def peer_resume(words):
+    for word in words:
+        if word.startswith('resume='):
+            return int(word[7:])
+    return None
+
+
+class TextCodec:
+    name = 'text'
+
+    def encode(self, frame, events):
+        return ''.join(ev.text % ((frame, ) + ev) for ev in events)
+
+    # Decode one message from buf (a bytearray) starting at pos.  Returns
+    # (messages, pos): messages is a list of (frame, event), empty if buf
+    # doesn't hold a whole message yet, and pos is where the next message
+    # starts.  Lines that aren't events (the handshake: ping, synchronize,
+    # switch) come back as lists of words.
+    def decode(self, buf, pos=0):
+        while True:
+            end = buf.find('\n', pos)
+            if end < 0: return [], pos
+            line, pos = str(buf[pos:end]), end+1
+            if line.strip(): break
+        words = line.split()
+        cls = event_names.get(words[1])
+        if cls is None:
+            return [(int(words[0]), words[1:])], pos
+        return [(int(words[0]), cls(*[parse(w) for parse, w in zip(cls.parsers, words[2:])]))], pos
+
+
+class BinaryCodec:
+    name = BINARY_VERSION
+
+    def encode(self, frame, events):
+        if len(events) > MAX_EVENTS:
+            return ''.join(self.encode(frame, events[i:i+MAX_EVENTS])
+                           for i in xrange(0, len(events), MAX_EVENTS))
+        body = []
+        for ev in events:
+            body.append(ev.struct.pack(ev.id, *[enc(v) for enc, v in zip(ev.encoders, ev)]))
+        body = ''.join(body)
+        return header.pack(header.size - 2 + len(body), frame, len(events)) + body
+
+    def decode(self, buf, pos=0):
+        if len(buf) < pos + 2: return [], pos
+        length, = struct.unpack_from('!H', buf, pos)
+        if len(buf) < pos + length + 2: return [], pos
+        size, frame, count = header.unpack_from(buf, pos)
+        end = pos + length + 2
+        pos += header.size
+        messages = []
+        for x in xrange(count):
+            cls = event_classes[buf[pos]]
+            fields = cls.struct.unpack_from(buf, pos)
+            pos += cls.struct.size
+            messages.append((frame, cls(*[dec(v) for dec, v in zip(cls.decoders, fields[1:])])))
+        return messages, end
+
+codecs = {'text': TextCodec(), BINARY_VERSION: BinaryCodec()}
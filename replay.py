@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Game recordings, and a headless player for them.
+#
+# A recording is everything needed to run a game again: one header line
+#     towerwars-replay <version> <seed> <width> <height> <goal> <pieces>\n
+# with the seed the match started from, the size of its board and the
+# checksum of the piece library it was dealt from (see sim.Library), then
+# the events of every frame
+# that had any, in the order they were applied, as binary protocol packets
+# (see protocol.py).  The file is only ever appended to, so whatever was
+# written before a crash can still be played.
+#
+#     replay.py [--hashes FILE] [--frames N] RECORDING
+#
+# runs a recording through the simulation as fast as it will go and prints
+# the outcome; --hashes writes the state hash after every frame, for
+# finding the first frame where two runs of a game differ.
+#
+# Versions 1 and 2, from before the piece library, can't be played any
+# more: their pieces were grown at random, and the library deals others.
+
+import sys, time, zlib
+from optparse import OptionParser
+
+import sim, protocol
+
+VERSION = 3
+MAGIC = 'towerwars-replay'
+
+codec = protocol.codecs[protocol.BINARY_VERSION]
+
+class Recorder:
+    def __init__(self, stream, seed, board=sim.STANDARD):
+        self.stream = stream
+        self.stream.write('%s %d %d %d %d %d %08x\n' % ((MAGIC, VERSION, seed) + tuple(board) + (sim.library.id, )))
+
+    # events are protocol.Events, in the order they were applied
+    def record(self, frame, events):
+        if events:
+            self.stream.write(codec.encode(frame, events))
+
+# Returns (seed, {frame: [event, ...]}, (width, height, goal))
+def load(f):
+    buf = bytearray(f.read())
+    end = buf.find('\n')
+    header = str(buf[:end]).split()
+    if header[0] != MAGIC or int(header[1]) != VERSION:
+        raise ValueError('Not a version %d recording' % VERSION)
+    if int(header[6], 16) != sim.library.id:
+        raise ValueError('Recorded with a different piece library (%s)' % header[6])
+    seed = header[2]
+    board = tuple(int(x) for x in header[3:6])
+    frames = {}
+    pos = end + 1
+    while True:
+        messages, pos = codec.decode(buf, pos)
+        if not messages: break
+        for frame, ev in messages:
+            frames.setdefault(frame, []).append(ev)
+    return int(seed), frames, board
+
+# Run frames 1..last through a fresh match, as world.tick() would, calling
+# frame_done(frame, match) after each.
+def play(seed, frames, last=None, frame_done=None, board=sim.STANDARD):
+    match = sim.Match(seed, *board)
+    if last is None:
+        last = max(frames) if frames else 0
+    winners = []
+    for frame in xrange(1, last + 1):
+        for ev in frames.get(frame, ()):
+            winner = match.apply(ev)
+            if winner: winners.append((frame, winner))
+        match.frameno = frame
+        match.tick()
+        if frame_done: frame_done(frame, match)
+    return match, winners
+
+if __name__ == '__main__':
+    option_parser = OptionParser(usage='%prog [options] RECORDING')
+    option_parser.add_option('--hashes', action='store', type='string', dest='hashes', default=None, help="Write each frame's state hash to this file ('-' for stdout)")
+    option_parser.add_option('--frames', action='store', type='int', dest='frames', default=None, help='Run this many frames instead of stopping at the last event')
+    options, args = option_parser.parse_args()
+    if len(args) != 1:
+        option_parser.error('need a recording')
+
+    seed, frames, board = load(open(args[0], 'rb'))
+    if options.hashes == '-':
+        out = sys.stdout
+    elif options.hashes:
+        out = open(options.hashes, 'w')
+    else:
+        out = None
+
+    combined = [0]
+    def frame_done(frame, match):
+        h = match.state_hash()
+        combined[0] = zlib.crc32('%08x' % h, combined[0])
+        if out: out.write('%d %08x\n' % (frame, h))
+
+    start = time.time()
+    match, winners = play(seed, frames, options.frames, frame_done, board)
+    elapsed = time.time() - start
+
+    print 'seed      %d' % seed
+    print 'board     %dx%d, goal row %d' % board
+    print 'frames    %d (%d with events) in %.3fs, %.0f frames/s' % \
+        (match.frameno, len(frames), elapsed, match.frameno / max(elapsed, 1e-9))
+    for frame, winner in winners:
+        print 'winner    %s at frame %d' % (winner, frame)
+    print 'screen    %s' % match.screen
+    print 'score     %s' % ', '.join('%s %d' % kv for kv in sorted(match.score.items()))
+    print 'moves     %s' % ', '.join('%s %d' % kv for kv in sorted(match.movecount.items()))
+    print 'pieces    %d' % len(match.playfield.pieces)
+    print 'hash      %08x final, %08x all frames' % (match.state_hash(), combined[0] & 0xffffffff)
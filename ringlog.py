@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# The log, at as little cost to the game as possible, so that even
+# --trace can be left on.  Logging a message (see Log in towerwars.py and
+# server.py) only checks its level and puts a tuple in the next slot of a
+# ring; a background thread takes them out every DRAIN_INTERVAL, formats
+# them and writes them out.  The records are kept as the objects they were
+# logged with, as packing them into bytes on the game's side would cost
+# about as much as formatting them; lists, dicts and sets are copied, as
+# whoever logged them may well change them before they are written.  If the
+# writer ever falls so far behind that the ring is full, messages are
+# dropped rather than the game kept waiting, and how many is logged once
+# there is room.
+#
+# The log is written as text, one line per message, or with --binary-log
+# as a trace, which is smaller and cheaper to write, and which this turns
+# back into the same text:
+#
+#     ringlog.py [--times] TRACE
+#
+# A trace is 'towerwars-trace 1\n' and then records, little endian:
+#     'D'  layout (uint32)  source label message fields (string)
+#          keys (uint8), each a string
+#     'E'  layout (uint32)  level (uint8)  frame (int32)  time (double)
+#          then the values
+#     'X'  messages dropped (uint32)  frame (int32)  time (double)
+# A layout is a source (the worker, for server.py), label, message, set of
+# keys and the types of their values, defined by a 'D' record before the
+# first 'E' record that has it.  Time is time.time().  If every value is an
+# int, float or bool, fields has a struct format character for each ('q',
+# 'd' or '?'), and the values follow one after another as that says.
+# Otherwise fields is empty, and the values are either 'm' and a string of
+# them as a list in marshal's format, or, if marshal can't write one of
+# them, 't' and then each as a tag byte and
+#     'i' int64   'f' double   's' string   'u' unicode, as a UTF-8 string
+#     'n' None   'T' True   'F' False
+#     'l' list, 't' tuple: count (uint32), then each value
+#     'r' anything else, its repr as a string
+# where a string is its length (uint32) and bytes.  Tracing to a file that
+# already has one appends another header, and starts the layouts again.
+
+import os, sys, errno, copy, struct, time, threading, marshal, atexit
+from optparse import OptionParser
+
+LEVELS = {0: 'FATAL', 1: 'ERROR', 2: 'WARN', 3:'INFO', 4:'DEBUG', 5:'TRACE'}
+
+MAGIC = 'towerwars-trace'
+VERSION = 1
+
+RING_BITS = 16          # the ring holds 1 << RING_BITS messages
+DRAIN_INTERVAL = 0.05   # seconds
+CLOSE_TIMEOUT = 2       # seconds close() waits for the writer
+
+definition = struct.Struct('<cI')
+entry = struct.Struct('<cIBid')
+dropped = struct.Struct('<cIid')
+length = struct.Struct('<I')
+int64 = struct.Struct('<q')
+double = struct.Struct('<d')
+keys = struct.Struct('<B')
+
+FIELDS = {int: 'q', float: 'd', bool: '?'}
+
+MUTABLE = set([list, dict, set, bytearray])
+
+# A copy of a logged value that nothing else has hold of.  Going through
+# marshal copies all the way down, and much faster than copy.deepcopy, for
+# everything it can write (it would turn a bytearray into a string).
+def frozen(value):
+    if type(value) is bytearray: return bytearray(value)
+    try:
+        return marshal.loads(marshal.dumps(value))
+    except ValueError:
+        return copy.deepcopy(value)
+
+# A message as a line of text.  The keys and values are given separately,
+# in the order the dict of them had when it was logged, so that a message
+# read back from a trace comes out the same.
+def text(frame, level, source, label, message, keys, values):
+    if source: label = '%s %s' % (source, label)
+    kwargs = '{%s}' % ', '.join(['%r: %r' % kv for kv in zip(keys, values)])
+    return '%8d %5s %17s: %s\t%s\n' % (frame, LEVELS.get(level, level), label, message, kwargs)
+
+def pack_string(out, s):
+    out.append(length.pack(len(s)))
+    out.append(s)
+
+def pack_value(out, value):
+    t = type(value)
+    if t is bool:
+        out.append(value and 'T' or 'F')
+    elif (t is int or t is long) and -1 << 63 <= value < 1 << 63:
+        out.append('i')
+        out.append(int64.pack(value))
+    elif t is float:
+        out.append('f')
+        out.append(double.pack(value))
+    elif t is str:
+        out.append('s')
+        pack_string(out, value)
+    elif t is unicode:
+        out.append('u')
+        pack_string(out, value.encode('utf-8'))
+    elif value is None:
+        out.append('n')
+    elif t is list or t is tuple:
+        out.append(t is list and 'l' or 't')
+        out.append(length.pack(len(value)))
+        for v in value:
+            pack_value(out, v)
+    else:
+        out.append('r')
+        pack_string(out, repr(value))
+
+class Log:
+    def __init__(self, path, verbosity, source=None, binary=False, bits=RING_BITS):
+        if path == '-':
+            self.fd = sys.stdout.fileno()
+        else:
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self.verbosity = verbosity
+        self.source = source
+        self.binary = binary
+        self.ring = [None] * (1 << bits)
+        self.mask = (1 << bits) - 1
+        self.head = 0       # messages put in the ring
+        self.tail = 0       # and taken out
+        self.dropped = 0
+        # The writer's
+        self.reported = 0   # of dropped
+        self.layouts = {}   # (label, message, keys, types) -> (number, Struct if fixed)
+        if binary:
+            self.write('%s %d\n' % (MAGIC, VERSION))
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, frame, level, label, message, kwargs):
+        head = self.head
+        if head - self.tail > self.mask:
+            self.dropped += 1
+            return
+        for k, v in kwargs.iteritems():
+            if type(v) in MUTABLE: kwargs[k] = frozen(v)
+        self.ring[head & self.mask] = (frame, time.time(), level, label, message, kwargs)
+        self.head = head + 1
+
+    # Writes out everything logged so far, and stops the writer.  Called
+    # on exit if not before.  Gives up after CLOSE_TIMEOUT rather than hold
+    # up the exit, should the writer be stuck (a pipe nobody is reading).
+    def close(self):
+        self.running = False
+        self.thread.join(CLOSE_TIMEOUT)
+
+    # The writer thread
+    def run(self):
+        while self.running:
+            time.sleep(DRAIN_INTERVAL)
+            self.drain()
+        self.drain()
+
+    def drain(self):
+        out = []
+        frame = when = 0
+        while self.tail < self.head:
+            i = self.tail & self.mask
+            frame, when, level, label, message, kwargs = self.ring[i]
+            self.ring[i] = None
+            self.tail += 1
+            if self.binary:
+                self.pack(out, frame, when, level, label, message, kwargs)
+            else:
+                out.append(text(frame, level, self.source, label, message, kwargs.keys(), kwargs.values()))
+        missed = self.dropped - self.reported
+        if missed:
+            self.reported += missed
+            if self.binary:
+                out.append(dropped.pack('X', missed, frame, when))
+            else:
+                out.append(text(frame, 2, self.source, 'Logging', 'Dropped', ['messages'], [missed]))
+        if out:
+            self.write(''.join(out))
+
+    def pack(self, out, frame, when, level, label, message, kwargs):
+        values = kwargs.values()
+        key = (label, message, tuple(kwargs), tuple(map(type, values)))
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = self.layouts[key] = self.define(out, *key)
+        number, fixed = layout
+        if fixed:
+            out.append(fixed.pack('E', number, level, frame, when, *values))
+        else:
+            out.append(entry.pack('E', number, level, frame, when))
+            try:
+                data = marshal.dumps(values)
+            except ValueError:
+                out.append('t')
+                for v in values:
+                    pack_value(out, v)
+            else:
+                out.append('m')
+                pack_string(out, data)
+
+    def define(self, out, label, message, names, types):
+        number = len(self.layouts)
+        fields = ''
+        if all(t in FIELDS for t in types):
+            fields = ''.join(FIELDS[t] for t in types)
+        out.append(definition.pack('D', number))
+        for s in (self.source or '', label, message, fields):
+            pack_string(out, s)
+        out.append(keys.pack(len(names)))
+        for s in names:
+            pack_string(out, s)
+        return number, fields and struct.Struct(entry.format + fields) or None
+
+    def write(self, data):
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except OSError, e:
+                if e.errno == errno.EINTR: continue
+                if e.errno == errno.EAGAIN:
+                    time.sleep(DRAIN_INTERVAL)
+                    continue
+                raise
+
+# Reading a trace
+
+# A value logged as its repr
+class Repr(str):
+    def __repr__(self):
+        return self
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, s):
+        values = s.unpack_from(self.data, self.pos)
+        self.pos += s.size
+        return values
+
+    def string(self):
+        n, = self.unpack(length)
+        if self.pos + n > len(self.data): raise struct.error('string runs off the end')
+        self.pos += n
+        return self.data[self.pos - n:self.pos]
+
+    def tag(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def value(self):
+        tag = self.tag()
+        if tag == 'i': return self.unpack(int64)[0]
+        if tag == 'f': return self.unpack(double)[0]
+        if tag == 's': return self.string()
+        if tag == 'u': return self.string().decode('utf-8')
+        if tag == 'n': return None
+        if tag == 'T': return True
+        if tag == 'F': return False
+        if tag in 'lt':
+            n, = self.unpack(length)
+            values = [self.value() for i in xrange(n)]
+            return values if tag == 'l' else tuple(values)
+        if tag == 'r': return Repr(self.string())
+        raise ValueError('Unknown value tag %r at %d' % (tag, self.pos - 1))
+
+# Yields (time, text) for each message in a trace.  Stops at the first
+# record cut short (the program died while writing it).
+def decode(data):
+    r = Reader(data)
+    layouts = {}
+    try:
+        while r.pos < len(data):
+            if data.startswith(MAGIC, r.pos):
+                end = data.index('\n', r.pos)
+                version = int(data[r.pos:end].split()[1])
+                if version != VERSION:
+                    raise ValueError('Not a version %d trace' % VERSION)
+                r.pos = end + 1
+                layouts = {}
+                continue
+            tag = data[r.pos]
+            if tag == 'D':
+                tag, number = r.unpack(definition)
+                source, label, message, fields = r.string(), r.string(), r.string(), r.string()
+                n, = r.unpack(keys)
+                layouts[number] = (source, label, message, [r.string() for i in xrange(n)],
+                                   fields and struct.Struct('<' + fields))
+            elif tag == 'E':
+                tag, number, level, frame, when = r.unpack(entry)
+                source, label, message, names, fixed = layouts[number]
+                if fixed:
+                    values = r.unpack(fixed)
+                elif r.tag() == 'm':
+                    values = marshal.loads(r.string())
+                else:
+                    values = [r.value() for k in names]
+                yield when, text(frame, level, source, label, message, names, values)
+            elif tag == 'X':
+                tag, missed, frame, when = r.unpack(dropped)
+                yield when, text(frame, 2, '', 'Logging', 'Dropped', ['messages'], [missed])
+            else:
+                raise ValueError('Unknown record %r at %d' % (tag, r.pos))
+    except (struct.error, IndexError):
+        sys.stderr.write('Trace cut short at byte %d\n' % r.pos)
+
+if __name__ == '__main__':
+    option_parser = OptionParser(usage='%prog [--times] TRACE')
+    option_parser.add_option('--times', action='store_true', dest='times', default=False, help='Start each line with the time it was logged')
+    options, args = option_parser.parse_args()
+    if len(args) != 1:
+        option_parser.error('Which trace?')
+    for when, line in decode(open(args[0], 'rb').read()):
+        if options.times:
+            line = '%s.%03d %s' % (time.strftime('%H:%M:%S', time.localtime(when)), int(when * 1000) % 1000, line)
+        sys.stdout.write(line)
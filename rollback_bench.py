@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# How long does a rollback take?  Takes one of bench.py's loaded boards,
+# then repeatedly does what EventManager.roll_back does for a late event:
+# restore the snapshot from some frames ago and run those frames again,
+# snapshotting each one.  A rollback has to fit in a frame (50ms at 20 FPS)
+# alongside everything else.
+
+import sys, time
+from optparse import OptionParser
+
+import sim, protocol, bench
+
+option_parser = OptionParser()
+option_parser.add_option('--board', action='store', type='choice', choices=['half', 'tall'], dest='board', default='half', help='Which of bench.py\'s boards to roll back on (half or tall)')
+option_parser.add_option('--frames', action='store', type='int', dest='frames', default=8, help='Frames replayed per rollback')
+option_parser.add_option('--repeat', action='store', type='int', dest='repeat', default=200, help='Rollbacks to time')
+option_parser.add_option('--seed', action='store', type='int', dest='seed', default=1)
+options, args = option_parser.parse_args()
+
+FRAME_TIME = 1000. / 20
+
+match = bench.boards(options.seed)[options.board]
+print '%d pieces on the board' % len(match.playfield.pieces)
+
+# One drop per rollback window, like a late remote event would bring
+def events(frame):
+    if frame == 0:
+        role = 'Client'
+        return [protocol.Drop(role, match.next_piece[role].x, 0)]
+    return []
+
+def timed(func, n):
+    start = time.time()
+    for i in xrange(n):
+        func()
+    return (time.time() - start) * 1000. / n
+
+snapshot_ms = timed(match.snapshot, options.repeat * 10)
+
+def rollback():
+    state = match.snapshot()
+    for frame in xrange(options.frames):
+        snapshots.append(match.snapshot())
+        match.step(events(frame))
+    # The part that counts: go back and replay
+    start = time.time()
+    match.restore(snapshots[0])
+    del snapshots[:]
+    for frame in xrange(options.frames):
+        snapshots.append(match.snapshot())
+        match.step(events(frame))
+    elapsed.append(time.time() - start)
+    del snapshots[:]
+    match.restore(state)
+
+snapshots = []
+elapsed = []
+for i in xrange(options.repeat):
+    rollback()
+elapsed.sort()
+rollback_ms = 1000. * sum(elapsed) / len(elapsed)
+worst_ms = 1000. * elapsed[-1]
+frame_ms = rollback_ms / options.frames
+
+print 'snapshot          %8.3f ms' % snapshot_ms
+print 'replayed frame    %8.3f ms  (snapshot + events + physics)' % frame_ms
+print 'rollback of %3d   %8.3f ms  mean, %.3f ms worst' % (options.frames, rollback_ms, worst_ms)
+print 'frames replayable in one %dms tick: %d' % (FRAME_TIME, FRAME_TIME / frame_ms)
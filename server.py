@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Dedicated server: hosts many matches at once for ordinary clients
+# (towerwars.py -c HOST).
+#
+# The main process only accepts connections.  Every two clients make a
+# match, which it hands, sockets and all, to whichever worker process has
+# the fewest.  Each worker runs its own event loop at the game's frame rate
+# and, for each of its matches, does what the server end of a two-player
+# game does: synchronizes both clocks, tells each client which side it
+# plays, passes every event on to the other client, and runs the match
+# itself (a few frames behind, so that nothing arrives too late) to keep
+# score.  Each match reports how long its frames take.
+
+import sys, os, socket, random, traceback
+import multiprocessing
+from multiprocessing.reduction import send_handle, recv_handle
+from optparse import OptionParser
+
+import net, protocol, sim, ringlog
+
+FPS = 20
+frameno = 0
+log = None
+reactor = None
+options = None
+
+PROTOCOLS = [protocol.BINARY_VERSION]
+FEATURES = ['rollback', 'role', 'hash']
+ROLES = protocol.ROLES
+
+option_parser = OptionParser()
+option_parser.add_option('-q', '--quiet', action='store_const', const=2, dest='verbosity', default=3, help='Only output warnings and errors')
+option_parser.add_option('-v', '--verbose', action='store_const', const=4, dest='verbosity', help='Output debug information about game events')
+option_parser.add_option('-l', '--logfile', action='store', type='string', dest='logfile', default='-', help='Destination for log output')
+option_parser.add_option('--binary-log', action='store_true', dest='binary_log', default=False, help='Write the log as a binary trace (ringlog.py turns it into text)')
+option_parser.add_option('-p', '--port', action='store', dest='port', type='int', default='4242', help='Port number for TCP connections.')
+option_parser.add_option('-w', '--workers', action='store', dest='workers', type='int', default=multiprocessing.cpu_count(), help='Worker processes to run matches in')
+option_parser.add_option('--sim-lag', action='store', dest='sim_lag', type='int', default=32, help='Frames the server runs each match behind its clients')
+option_parser.add_option('--start-delay', action='store', dest='start_delay', type='int', default=20, help='Frames from synchronizing to the start of a match')
+option_parser.add_option('--report-interval', action='store', dest='report_interval', type='int', default=100, help='Frames between tick latency reports')
+option_parser.add_option('--board-width', action='store', type='int', dest='board_width', default=sim.WIDTH, help='Columns on the board (clients must agree)')
+option_parser.add_option('--board-height', action='store', type='int', dest='board_height', default=sim.HEIGHT, help='Rows on the board (clients must agree)')
+option_parser.add_option('--goal-row', action='store', type='int', dest='goal_row', default=sim.GOAL, help='Reaching this row from the top wins (clients must agree)')
+
+# Each process has its own, written out by a thread (see ringlog.py)
+class Log(ringlog.Log):
+    def __init__(self, name):
+        ringlog.Log.__init__(self, options.logfile, options.verbosity, name, options.binary_log)
+
+    def msg(self, level, label, message, **kwargs):
+        if level > self.verbosity: return
+        self.record(frameno, level, label, message, kwargs)
+
+
+# One client's connection, as seen from the server end
+class Client:
+    def __init__(self, game, role, sock):
+        self.game = game
+        self.role = role
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn = net.Connection(sock)
+        self.socket = sock
+        reactor.register(self.conn)
+        self.state = 'Connected'
+        self.remote_frame = 0
+        self.remote_frame_offset = None
+        self.remote_protocols = []
+        self.rtts = []
+        self.send_codec = self.recv_codec = protocol.codecs['text']
+
+    def close(self):
+        if self.conn.reactor:
+            reactor.unregister(self.conn)
+        self.socket.close()
+
+    def run(self):
+        while True:
+            messages = self.conn.read(self.recv_codec)
+            if not messages: break
+            for timestamp, args in messages:
+                self.message(timestamp, args)
+        if self.state == 'Connected':
+            self.conn.write('%d ping %d %s\n' % (frameno, self.remote_frame, ' '.join(PROTOCOLS + FEATURES)))
+
+    def message(self, timestamp, args):
+        if isinstance(args, protocol.Event):
+            # Clock messages are for peers; we keep our own time
+            if self.state == 'Synchronized' and type(args) is not protocol.Clock:
+                self.game.client_event(self, timestamp + self.remote_frame_offset, args)
+        elif self.state == 'Synchronized':
+            if args[0] == 'switch':
+                self.recv_codec = protocol.codecs[args[1]]
+        elif args[0] == 'ping':
+            self.remote_frame = timestamp
+            self.remote_protocols = args[2:]
+            if int(args[1]) != 0:
+                self.rtts.append(frameno - int(args[1]))
+
+    def ready(self):
+        return len(self.rtts) >= 30
+
+    def synchronize(self):
+        rtt = sum(self.rtts)/(2*len(self.rtts))
+        self.remote_frame_offset = frameno - self.remote_frame + rtt
+        shared = [p for p in PROTOCOLS if p in self.remote_protocols]
+        self.conn.write('%d synchronize %d %s %s\n' % \
+            (frameno, frameno-self.remote_frame_offset, (shared or ['text'])[0], self.role))
+        if shared:
+            self.send_codec = protocol.codecs[shared[0]]
+        self.state = 'Synchronized'
+        log.msg(3, 'Clock', 'Synchronized', match=self.game.id, role=self.role, rtt=rtt, frame_offset=self.remote_frame_offset)
+
+    def send(self, frame, events):
+        self.conn.write(self.send_codec.encode(frame, events))
+
+
+class Game:
+    def __init__(self, id, socks):
+        self.id = id
+        self.clients = [Client(self, role, sock) for role, sock in zip(ROLES, socks)]
+        self.match = sim.Match(None, options.board_width, options.board_height, options.goal_row)
+        self.cache = {}         # frame -> [(role, event)]; role None for ours
+        self.start = None
+        self.sim_frame = frameno
+        self.tick_times = []
+        self.over = False
+        log.msg(3, 'Match', 'Created', match=id, clients=[c.socket.getpeername() for c in self.clients])
+
+    def client_event(self, client, frame, event):
+        # Only for the other player to check against (see
+        # EventManager.check_hash); the match isn't affected
+        if type(event) is protocol.Hash:
+            for other in self.clients:
+                if other is not client and 'hash' in other.remote_protocols:
+                    other.send(frame, [event])
+            return
+        if frame <= self.sim_frame:
+            log.msg(1, 'Event', 'TooLate', match=self.id, role=client.role, frame=frame, args=event)
+            frame = self.sim_frame + 1
+        self.cache.setdefault(frame, []).append((client.role, event))
+        if type(event) is protocol.Quit:
+            self.over = True
+        for other in self.clients:
+            if other is not client:
+                other.send(frame, [event])
+
+    # Events of our own go to both clients, and have to be alone in their
+    # frame (see EventManager.add_delayed_event) for everyone to apply them
+    # in the same order.
+    def add_event(self, frame, event):
+        self.cache.setdefault(frame, []).append((None, event))
+        for client in self.clients:
+            client.send(frame, [event])
+
+    def run(self):
+        start = net.monotonic()
+        for client in self.clients:
+            client.run()
+            if not client.conn.rtr():
+                self.end('Disconnected', role=client.role)
+                return
+        if self.start is None:
+            if [c for c in self.clients if not c.ready()]: return
+            for client in self.clients:
+                if 'role' not in client.remote_protocols:
+                    log.msg(1, 'Match', 'ClientTooOld', match=self.id, role=client.role)
+                    self.end('Refused')
+                    return
+                board = protocol.peer_board(client.remote_protocols, sim.STANDARD)
+                if board != self.match.board:
+                    log.msg(1, 'Match', 'BoardMismatch', match=self.id, role=client.role, board=board)
+                    self.end('Refused')
+                    return
+                pieces = protocol.peer_pieces(client.remote_protocols)
+                if pieces != sim.library.id:
+                    log.msg(1, 'Match', 'PiecesMismatch', match=self.id, role=client.role, pieces=pieces)
+                    self.end('Refused')
+                    return
+                client.synchronize()
+            self.start = frameno + options.start_delay
+            self.sim_frame = self.start - 1
+            self.add_event(self.start, protocol.Randomize(random.getrandbits(32)))
+            self.add_event(self.start, protocol.Reset())
+
+        # Run the match as far as the clients can no longer change it
+        while self.sim_frame < frameno - options.sim_lag:
+            self.sim_frame += 1
+            self.step(self.sim_frame)
+        self.tick_times.append(net.monotonic() - start)
+        if len(self.tick_times) >= options.report_interval:
+            self.report()
+
+    def step(self, frame):
+        events = self.cache.pop(frame, [])
+        for role in (None, 'Server', 'Client'):
+            for ev in (e for r, e in events if r == role):
+                winner = self.match.apply(ev)
+                if winner:
+                    log.msg(3, 'Game', 'Winner', match=self.id, role=winner, score=self.match.score)
+        self.match.frameno = frame
+        self.match.tick()
+
+    def report(self):
+        times = sorted(self.tick_times)
+        log.msg(3, 'Match', 'TickLatency', match=self.id, frames=len(times),
+                mean_us=int(1e6 * sum(times) / len(times)),
+                p99_us=int(1e6 * times[min(len(times)-1, int(0.99*len(times)))]),
+                max_us=int(1e6 * times[-1]))
+        del self.tick_times[:]
+
+    def end(self, reason, **kwargs):
+        if self.over and reason == 'Disconnected': reason = 'Finished'
+        if self.start is not None:
+            while self.sim_frame < frameno:
+                self.sim_frame += 1
+                self.step(self.sim_frame)
+        log.msg(3, 'Match', reason, match=self.id, score=self.match.score, **kwargs)
+        if self.tick_times: self.report()
+        for client in self.clients:
+            client.close()
+        games.pop(self.id, None)
+        control.conn.send(('ended', self.id))
+
+
+games = {}
+control = None
+
+# The worker end of the pipe from the main process
+class Control:
+    def __init__(self, conn):
+        self.conn = conn
+        self.reactor = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def interest(self):
+        return net.READ
+
+    def on_readable(self):
+        try:
+            msg = self.conn.recv()
+        except EOFError:
+            sys.exit(0) # Main process has gone
+        if msg[0] == 'match':
+            fds = [recv_handle(self.conn) for r in ROLES]
+            socks = []
+            for fd in fds:
+                socks.append(socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM))
+                os.close(fd)
+            games[msg[1]] = Game(msg[1], socks)
+
+    def on_writable(self):
+        pass
+
+def worker(number, conn):
+    global log, reactor, control, frameno
+    reactor = net.Reactor()
+    log = Log('w%d' % number)
+    control = Control(conn)
+    reactor.register(control)
+    log.msg(3, 'Worker', 'Started', pid=os.getpid())
+
+    next_frame_time = net.monotonic()
+    try:
+        while True:
+            next_frame_time += 1./FPS
+            frameno += 1
+            for game in games.values():
+                try: game.run()
+                except Exception, e:
+                    log.msg(1, 'Match', traceback.format_exception_only(type(e),e)[-1].strip(), match=game.id)
+                    traceback.print_exc()
+                    game.end('Crashed')
+            wait = next_frame_time - net.monotonic()
+            if wait < 0:
+                log.msg(2, 'EventLoop', 'Dropping Frame', interval=int(wait*1000), matches=len(games))
+            while wait > 0:
+                reactor.wait(wait)
+                wait = next_frame_time - net.monotonic()
+    except BaseException, e:
+        log.close()
+
+
+# The main process: accept, pair up, hand out
+class Worker:
+    def __init__(self, number):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker, args=(number, child))
+        self.process.start()
+        child.close()
+        self.matches = set()
+        self.reactor = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def interest(self):
+        return net.READ
+
+    def on_readable(self):
+        try:
+            msg = self.conn.recv()
+        except EOFError:
+            log.msg(0, 'Worker', 'Died', pid=self.process.pid)
+            sys.exit(1)
+        if msg[0] == 'ended':
+            self.matches.discard(msg[1])
+
+    def on_writable(self):
+        pass
+
+    def hand_over(self, id, socks):
+        self.matches.add(id)
+        self.conn.send(('match', id))
+        for sock in socks:
+            send_handle(self.conn, sock.fileno(), self.process.pid)
+
+def main():
+    global options, log, reactor
+    options, args = option_parser.parse_args()
+    FEATURES.append(protocol.board_feature((options.board_width, options.board_height, options.goal_row)))
+    FEATURES.append(protocol.pieces_feature(sim.library.id))
+    reactor = net.Reactor()
+    # Before the log, so as not to fork while its thread is running
+    workers = [Worker(n) for n in xrange(max(1, options.workers))]
+    log = Log('main')
+    for w in workers:
+        reactor.register(w)
+
+    listen = socket.socket()
+    listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen.bind(('0.0.0.0', options.port))
+    listen.listen(-1)
+    log.msg(3, 'Network', 'Listening', port=options.port, workers=len(workers))
+
+    waiting = []
+    match_ids = iter(xrange(1, sys.maxint))
+    def accept(sock, addr):
+        log.msg(3, 'Network', 'Connected', ip=addr[0], port=addr[1])
+        waiting.append(sock)
+        if len(waiting) == len(ROLES):
+            w = min(workers, key=lambda w: len(w.matches))
+            w.hand_over(match_ids.next(), waiting)
+            for sock in waiting:
+                sock.close()
+            del waiting[:]
+    reactor.register(net.Listener(listen, accept))
+
+    try:
+        while True:
+            reactor.wait(1.)
+    except BaseException, e:
+        log.close()
+        for w in workers:
+            w.process.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Game simulation.  Nothing in here may touch pygame: a Match has to be
+# runnable on a machine without a display (batch simulation, replays, CI).
+
+import os, sys, random, heapq, copy, zlib
+from array import array
+
+import protocol
+
+# The standard board.  Others can be any size (see Playfield); the goal is
+# the last row counted as reaching the top.
+WIDTH = 64
+HEIGHT = 48
+GOAL = 5
+STANDARD = (WIDTH, HEIGHT, GOAL)
+
+# The grid is kept in square chunks of CHUNK x CHUNK cells, each an array of
+# piece ids one column after another, and only where there are pieces.
+CHUNK_BITS = 4
+CHUNK = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK - 1
+EMPTY_CHUNK = array('i', [0]) * (CHUNK*CHUNK)
+EMPTY_BYTES = EMPTY_CHUNK.tostring()
+
+# Zobrist hashing: each piece id in each cell has a pseudo-random 64 bit
+# key, and a board's hash is the XOR of the keys of its occupied cells, so
+# it can be kept up to date in O(cells changed).  The keys come from a
+# mixing function (splitmix64's) rather than a table, as the board can be
+# any size.
+MASK64 = (1 << 64) - 1
+
+def zobrist_key(x, y, id):
+    h = ((x << 40) ^ (y << 20) ^ id) * 0x9E3779B97F4A7C15 & MASK64
+    h = (h ^ (h >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+    h = (h ^ (h >> 27)) * 0x94D049BB133111EB & MASK64
+    return h ^ (h >> 31)
+
+# Physics is incremental.  The playfield remembers which pieces touch which
+# (the support graph) and only re-evaluates pieces whose load or support may
+# have changed since the last tick: a new piece landing on them, a neighbour
+# being destroyed, or a piece above passing down a different set of forces.
+# A board where nothing happens costs next to nothing per frame.
+#
+# Copies share their chunks until one of them writes to one (see set()),
+# so copying a board costs the same however big it is.
+class Playfield:
+    def __init__(self, width=WIDTH, height=HEIGHT, goal=GOAL):
+        self.width = width
+        self.height = height
+        self.goal = goal
+        self.pieces = {}    # id -> piece; id 0 is an empty cell
+        self.next_id = 1
+        self.chunks = {}    # (x, y) >> CHUNK_BITS -> array of piece ids
+        self.owned = set()  # chunks not shared with a copy
+        self.column_heights = [height]*width
+        self.streaks = [(height, 0)] * width
+        self.fading = set()
+        self.forces = {}    # piece -> {column: force} passed to what is below
+        self.links = {}     # piece -> (above(), below()), rebuilt on demand
+        self.order = {}     # piece -> (row, col) of its first cell in scan order
+        self.dirty = set()
+        self.collapsed = []
+        self.changes = 0    # pieces added and removed, for the display
+        self.zobrist = 0    # see zobrist_key()
+
+    # Pieces never change once they are on the board, and the values in
+    # forces and links are only ever replaced, so a shallow copy of each
+    # container is a complete, independent playfield.
+    def copy(self):
+        rtn = copy.copy(self)
+        rtn.chunks = self.chunks.copy()
+        rtn.owned = set()
+        self.owned = set()
+        rtn.pieces = self.pieces.copy()
+        rtn.column_heights = self.column_heights[:]
+        rtn.streaks = self.streaks[:]
+        rtn.fading = self.fading.copy()
+        rtn.forces = self.forces.copy()
+        rtn.links = self.links.copy()
+        rtn.order = self.order.copy()
+        rtn.dirty = self.dirty.copy()
+        rtn.collapsed = self.collapsed[:]
+        return rtn
+
+    def clear(self):
+        self.__init__(self.width, self.height, self.goal)
+
+    def at(self, x, y):
+        if 0 <= y < self.height:
+            chunk = self.chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+            if chunk is not None:
+                return self.pieces.get(chunk[(x & CHUNK_MASK) << CHUNK_BITS | (y & CHUNK_MASK)])
+
+    # Chunks left empty are only taken away by remove()
+    def set(self, x, y, id):
+        key = (x >> CHUNK_BITS, y >> CHUNK_BITS)
+        if key in self.owned:
+            chunk = self.chunks[key]
+        else:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                if not id: return
+                chunk = EMPTY_CHUNK
+            chunk = self.chunks[key] = chunk[:]
+            self.owned.add(key)
+        chunk[(x & CHUNK_MASK) << CHUNK_BITS | (y & CHUNK_MASK)] = id
+
+    # First occupied row in column x at or below start (height if none)
+    def column_top(self, x, start=0):
+        column = (x & CHUNK_MASK) << CHUNK_BITS
+        y = start
+        while y < self.height:
+            base = y & ~CHUNK_MASK
+            end = min(base + CHUNK, self.height)
+            chunk = self.chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+            if chunk is not None:
+                data = chunk[column + y - base:column + end - base].tostring()
+                y += (len(data) - len(data.lstrip('\0'))) / chunk.itemsize
+                if y < end: return y
+            y = end
+        return self.height
+
+    def recompute_column_heights(self):
+        self.column_heights = [self.column_top(x) for x in xrange(self.width)]
+
+    # Pieces with a cell in the rectangle of cells from (left, top) up to
+    # (right, bottom), and maybe some others in the same chunks
+    def pieces_in(self, left, top, right, bottom):
+        ids = set()
+        for cx in xrange(left >> CHUNK_BITS, ((right - 1) >> CHUNK_BITS) + 1):
+            for cy in xrange(top >> CHUNK_BITS, ((bottom - 1) >> CHUNK_BITS) + 1):
+                chunk = self.chunks.get((cx, cy))
+                if chunk is not None:
+                    ids.update(chunk)
+        ids.discard(0)
+        return [self.pieces[i] for i in ids]
+
+    def update_column_heights(self, col, row):
+        self.column_heights[col] = row
+        self.streaks[col] = (row, 255)
+        self.fading.add(col)
+
+    def neighbours(self, piece):
+        above, below = self.support(piece)
+        return [v for c, v in above] + [v for c, v in below if v is not True]
+
+    def support(self, piece):
+        links = self.links.get(piece)
+        if links is None:
+            links = self.links[piece] = (piece.above(self), piece.below(self))
+        return links
+
+    def add(self, piece):
+        piece.id = self.next_id
+        self.next_id += 1
+        self.changes += 1
+        self.place(piece)
+        self.forces[piece] = {}
+        for v in self.neighbours(piece):
+            self.links.pop(v, None)
+        self.dirty.add(piece)
+
+    def remove(self, piece):
+        self.changes += 1
+        neighbours = self.neighbours(piece)
+        self.unplace(piece)
+        del self.links[piece], self.forces[piece]
+        self.dirty.discard(piece)
+        for v in neighbours:
+            self.links.pop(v, None)
+            self.dirty.add(v)
+
+    # Putting a piece's cells on the board and taking them off again, and
+    # nothing else: add() and remove() see to the physics, and state.py
+    # sets that from what it is sent.
+    def place(self, piece):
+        self.pieces[piece.id] = piece
+        for x,y in piece.shape.cells:
+            self.zobrist ^= zobrist_key(x+piece.x, y+piece.y, piece.id)
+            if 0 <= y+piece.y < self.height:
+                self.set(x+piece.x, y+piece.y, piece.id)
+        self.order[piece] = min((y+piece.y, x+piece.x) for x,y in piece.shape.cells)
+
+    def unplace(self, piece):
+        del self.pieces[piece.id]
+        for x,y in piece.shape.cells:
+            self.zobrist ^= zobrist_key(x+piece.x, y+piece.y, piece.id)
+            if 0 <= y+piece.y < self.height:
+                self.set(x+piece.x, y+piece.y, 0)
+        # So that the same pieces are always kept in the same chunks
+        for key in set(((x+piece.x) >> CHUNK_BITS, (y+piece.y) >> CHUNK_BITS)
+                       for x,y in piece.shape.cells):
+            chunk = self.chunks.get(key)
+            if chunk is not None and chunk.tostring() == EMPTY_BYTES:
+                del self.chunks[key]
+                self.owned.discard(key)
+        del self.order[piece]
+
+    # Called every frame, so a board where nothing is happening gets
+    # through without allocating anything.
+    def tick(self):
+        if self.collapsed:
+            self.collapsed = []
+        if self.fading:
+            for col in list(self.fading):
+                h, c = self.streaks[col]
+                self.streaks[col] = (h, max(c-10,0))
+                if c <= 10: self.fading.remove(col)
+
+        # Resolve the whole chain reaction now rather than one collapse per
+        # frame.  The order the pieces went in is left in self.collapsed for
+        # the display to replay.
+        if self.dirty:
+            self.settle()
+
+    # Evaluate dirty pieces top-down: a piece waits until every dirty piece
+    # resting on it has been done, and runs at most once per pass.  A piece
+    # that fails is destroyed and a new pass starts, as pieces already done
+    # may have lost their support or load with it; only what is still dirty
+    # (its neighbours and what the last pass hadn't reached) is gone over
+    # again.  If only pieces waiting on each other are left (resting on each
+    # other in a loop), they are taken in order anyway, so nothing stays
+    # dirty because of it.
+    def settle(self):
+        done = set()
+        waiting = []
+        queue = [(self.order[p], p) for p in self.dirty]
+        heapq.heapify(queue)
+        while True:
+            if queue:
+                key, val = heapq.heappop(queue)
+                if val in done or val not in self.dirty: continue
+                above, below = self.support(val)
+                if [v for c, v in above if v in self.dirty and v not in done]:
+                    waiting.append((key, val))
+                    continue
+            else:
+                waiting = [(k, v) for k, v in waiting if v in self.dirty and v not in done]
+                if not waiting: break
+                waiting.sort()
+                key, val = waiting.pop(0)
+                above, below = self.support(val)
+            done.add(val)
+            forces = self.forces[val]
+            if val.do_physics(self):
+                neighbours = self.neighbours(val)
+                val.destroy(self)
+                self.collapsed.append(val)
+                done = set()
+                for v in neighbours:
+                    heapq.heappush(queue, (self.order[v], v))
+                for item in waiting:
+                    heapq.heappush(queue, item)
+                waiting = []
+                continue
+            self.dirty.remove(val)
+            changed = self.forces[val] != forces
+            for c, v in below:
+                if v is True or v in done: continue
+                if changed: self.dirty.add(v)
+                if v in self.dirty:
+                    heapq.heappush(queue, (self.order[v], v))
+
+ROTATIONS = [(lambda (x,y): ( x, y)),
+             (lambda (x,y): ( y,-x)),
+             (lambda (x,y): (-x,-y)),
+             (lambda (x,y): (-y, x))]
+
+# The geometry of one set of cells in one orientation.  Shapes are interned
+# (see shape()), so every piece with the same cells shares one instance and
+# everything about it is worked out once per process:
+#   bottom      (x, lowest y) for each column the shape covers
+#   extents     (left, right, top)
+#   cg          the column of its centre of gravity
+#   rotations   the shape turned by each entry of ROTATIONS
+class Shape(object):
+    __slots__ = ('id', 'cells', 'bottom', 'extents', 'cg', 'rotations')
+
+    def __init__(self, cells):
+        self.id = len(shape_table)
+        shape_table.append(self)
+        self.cells = cells
+        bottom = {}
+        for cx, cy in cells:
+            bottom[cx] = max(bottom.get(cx, cy), cy)
+        self.bottom = tuple(sorted(bottom.items()))
+        self.extents = (min(bottom), max(bottom), min(cy for cx, cy in cells))
+        self.cg = sum(cx for cx, cy in cells) / len(cells)
+        self.rotations = None
+
+    # Unpickle to the interned copy (see ai.py, which sends boards to other
+    # processes), so that shapes can still be compared with 'is'.
+    def __reduce__(self):
+        return (shape, (self.cells,))
+
+shapes = {}         # frozenset of cells -> Shape
+shape_table = []    # Shape.id -> Shape
+
+def shape(cells):
+    cells = frozenset(cells)
+    rtn = shapes.get(cells)
+    if rtn is None:
+        turned = [frozenset(f(c) for c in cells) for f in ROTATIONS]
+        turned[0] = cells
+        for t in turned:
+            if t not in shapes:
+                shapes[t] = Shape(t)
+        turned = [shapes[t] for t in turned]
+        for r, s in enumerate(turned):
+            s.rotations = tuple(turned[r:] + turned[:r])
+        rtn = shapes[cells]
+    return rtn
+
+# Every shape a piece can have, with weights for how often each comes up,
+# is in a table made ahead of time by pieces.py (which describes the file).
+# A piece takes exactly one draw from the match's rng, which picks its
+# shape, rotation and colour together, so that dealing one always takes the
+# same time and moves the rng on the same amount.
+#
+# The table is read the first time a piece is dealt.  Shapes are picked
+# with Vose's alias method, in whole numbers so that every machine makes
+# the same choice: each shape gets a column of height total weight, filled
+# to its own weight times the number of shapes and topped up from one
+# heavier shape.  Each shape's Shape is only made the first time it comes
+# up.
+PIECE_SIZE = 10
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pieces.dat')
+LIBRARY_MAGIC = 'towerwars-pieces'
+LIBRARY_VERSION = 1
+COLORS = [(r, g, b) for r in (0,127,255) for g in (0,127,255) for b in (0,127,255)
+          if (r, g, b) != (0,0,0)]
+VARIANTS = len(ROTATIONS) * len(COLORS)
+
+class Library:
+    def __init__(self, path):
+        self.path = path
+        self.shapes = None
+
+    # Checksum of the file, for comparing with peers
+    @property
+    def id(self):
+        if self.shapes is None: self.load()
+        return self._id
+
+    def load(self):
+        data = open(self.path, 'rb').read()
+        end = data.index('\n')
+        header = data[:end].split()
+        if header[0] != LIBRARY_MAGIC or int(header[1]) != LIBRARY_VERSION:
+            raise ValueError('%s is not a version %d piece library' % (self.path, LIBRARY_VERSION))
+        size, count = int(header[2]), int(header[3])
+        body = zlib.decompress(data[end+1:])
+        weights = array('I', body[:4*count])
+        if sys.byteorder == 'big': weights.byteswap()
+        self.cells = array('b', body[4*count:])
+        self.size = size
+        self._id = zlib.crc32(data) & 0xffffffff
+
+        total = sum(weights)
+        self.total = total
+        self.range = count * total * VARIANTS
+        assert self.range < 1 << 53 # one rng.random() per draw
+        self.threshold = [total] * count
+        self.alias = range(count)
+        height = [w * count for w in weights]
+        small = [i for i in xrange(count) if height[i] < total]
+        large = [i for i in xrange(count) if height[i] >= total]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.threshold[s], self.alias[s] = height[s], l
+            height[l] -= total - height[s]
+            if height[l] < total: small.append(l)
+            else: large.append(l)
+        self.shapes = [None] * count
+
+    def make(self, i):
+        start = 2 * self.size * i
+        c = self.cells[start:start + 2*self.size]
+        self.shapes[i] = shape(zip(c[0::2], c[1::2]))
+        return self.shapes[i]
+
+    # (Shape, colour) for a new piece
+    def pick(self, rng):
+        if self.shapes is None: self.load()
+        r, variant = divmod(rng.randrange(self.range), VARIANTS)
+        column, height = divmod(r, self.total)
+        i = column if height < self.threshold[column] else self.alias[column]
+        s = self.shapes[i] or self.make(i)
+        return s.rotations[variant % len(ROTATIONS)], COLORS[variant / len(ROTATIONS)]
+
+library = Library(LIBRARY_PATH)
+
+class Piece(object):
+    __slots__ = ('id', 'shape', 'x', 'y', 'rotation', '_color', 'opacity', 'dropFrame')
+
+    def __init__(self, x, rng=random):
+        self.id = None
+        self.shape, self._color = library.pick(rng)
+        self.x = x
+        self.y = -self.shape.extents[2]
+
+        self.rotation = 0
+
+        self.opacity = 0
+        self.dropFrame = None
+
+    def copy(self):
+        rtn = Piece.__new__(Piece)
+        for name in Piece.__slots__:
+            setattr(rtn, name, getattr(self, name))
+        return rtn
+
+    @property
+    def cells(self):
+        return self.shape.cells
+
+    def oriented(self):
+        return self.shape.rotations[self.rotation]
+
+    def xformed_cells(self):
+        return self.shape.rotations[self.rotation].cells
+
+    def move(self, offx, width=WIDTH):
+        if self.dropFrame: return
+        left, right, top = self.oriented().extents
+        new_x = self.x+offx
+        new_x = max(new_x, -left)
+        new_x = min(new_x, width-1-right)
+        self.x = new_x
+
+    def rotate(self, width=WIDTH):
+        if self.dropFrame: return
+        self.rotation += 1
+        if self.rotation >= len(ROTATIONS): self.rotation=0
+        left, right, top = self.oriented().extents
+        self.y = -top
+        self.x = max(self.x, -left)
+        self.x = min(self.x, width-1-right)
+
+    def drop(self, playfield, column, rotation):
+        # Once dropped the piece is fixed at this rotation, which becomes 0.
+        self.shape = self.shape.rotations[rotation]
+        self.rotation = 0
+        self.x = column
+        self.opacity = 5
+        heights = playfield.column_heights
+        self.y = min(heights[x+column] - y for x, y in self.shape.bottom) - 1
+
+        for x,y in self.shape.cells:
+            if y+self.y < playfield.column_heights[x+self.x]:
+                playfield.update_column_heights(x+self.x, y+self.y)
+        playfield.add(self)
+
+        for x,y in self.shape.cells:
+            if y+self.y <= playfield.goal and self.x < playfield.width/2:
+                return 'Server'
+            elif y+self.y <= playfield.goal:
+                return 'Client'
+            else: return ''
+
+    def destroy(self, playfield):
+        playfield.remove(self)
+        columns = set(x+self.x for x,y in self.shape.cells
+                      if y+self.y == playfield.column_heights[x+self.x])
+        for x in columns:
+            playfield.column_heights[x] = playfield.column_top(x, playfield.column_heights[x])
+            playfield.streaks[x] = (playfield.column_heights[x],0)
+
+    # These two are most of the work of landing a piece, so they read the
+    # chunks directly rather than through Playfield.at().
+    def above(self, playfield):
+        rtn = []
+        chunks = playfield.chunks
+        for x,y in self.shape.cells:
+            x += self.x
+            y += self.y-1
+            if 0 <= y < playfield.height:
+                chunk = chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+                if chunk is None: continue
+                val = chunk[(x & CHUNK_MASK) << CHUNK_BITS | (y & CHUNK_MASK)]
+                if val and val != self.id:
+                    rtn.append((x,playfield.pieces[val]))
+        return rtn
+
+    def below(self, playfield):
+        rtn = []
+        chunks = playfield.chunks
+        for x,y in self.shape.cells:
+            x += self.x
+            y += self.y+1
+            if y == playfield.height:
+                rtn.append((x,True))
+            elif 0 <= y < playfield.height:
+                chunk = chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+                if chunk is None: continue
+                val = chunk[(x & CHUNK_MASK) << CHUNK_BITS | (y & CHUNK_MASK)]
+                if val and val != self.id:
+                    rtn.append((x,playfield.pieces[val]))
+        return rtn
+
+    def do_physics(self, playfield):
+        above, below = playfield.support(self)
+        forces = dict((c, playfield.forces[v].get(c,0)) for c, v in above)
+        cg = self.shape.cg + self.x
+        forces[cg] = forces.get(cg,0) + 10*len(self.shape.cells)   # Each block is 10 ?N
+        force  = sum(forces.values())
+        below = [k for k,v in below]
+
+        ecg = sum([c*f for c,f in forces.iteritems()]) / force
+        if ecg in below:
+            playfield.forces[self] = {ecg: force}
+        elif not len(below) or ecg > max(below) or ecg < min(below):
+            return True
+        else:
+            playfield.forces[self] = {max(k for k in below if k < ecg): force/2,
+                                      min(k for k in below if k > ecg): force/2}
+
+        return False
+
+
+# A single game between the two roles.  Everything that decides the outcome
+# lives here (including the random number generator, so that two matches can
+# run side by side in one process); the pygame front end in world.py only
+# reads from it.
+class Match:
+    def __init__(self, seed=None, width=WIDTH, height=HEIGHT, goal=GOAL):
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed # Recorded with replays, see replay.py
+        self.board = (width, height, goal)
+        self.rng = random.Random(seed)
+        self.frameno = 0
+        self.score = {'Server': 0, 'Client': 0}
+        self.last_winner = None
+        self.H_EVENT_reset()
+
+    def spawn(self, role):
+        width = self.board[0]
+        return Piece({'Server': width/4, 'Client': 3*width/4}[role], self.rng)
+
+    def H_EVENT_reset(self):
+        self.playfield = Playfield(*self.board)
+        self.next_piece = {'Server': self.spawn('Server'), 'Client': self.spawn('Client')}
+        self.movecount = {'Server': 0, 'Client': 0}
+        self.screen = 'Game'
+
+    def H_EVENT_randomize(self, x):
+        self.rng.seed(x)
+
+    def H_EVENT_drop(self, role, col, rot):
+        winner = self.next_piece[role].drop(self.playfield, col, rot)
+        self.next_piece[role] = self.spawn(role)
+        self.movecount[role] += 1
+
+        if winner:
+            self.score[winner] += 1
+            self.screen = 'GameOver'
+            self.last_winner = winner
+        return winner
+
+    # Returns the pieces that collapsed this frame, in order.
+    def tick(self):
+        if self.screen != 'Game': return []
+        self.playfield.tick()
+        return self.playfield.collapsed
+
+    # Everything needed to put the match back the way it is now, for
+    # rolling back to an earlier frame.  Taken every frame, so it has to be
+    # cheap: see Playfield.copy().
+    def snapshot(self):
+        return (self.frameno, self.playfield.copy(),
+                dict((r, p.copy()) for r, p in self.next_piece.iteritems()),
+                self.movecount.copy(), self.score.copy(), self.screen,
+                self.last_winner, self.rng.getstate())
+
+    # The match takes over the objects in state, so a snapshot can only be
+    # restored once.
+    def restore(self, state):
+        (self.frameno, self.playfield, self.next_piece, self.movecount,
+         self.score, self.screen, self.last_winner, rng) = state
+        self.rng.setstate(rng)
+
+    # A checksum of everything that affects how the game goes from here,
+    # the same on any machine.  Doesn't include where the players have moved
+    # their next pieces to, which only matters once they are dropped (and
+    # then comes with the drop event).
+    def state_hash(self):
+        h = zlib.crc32(repr(self.board))
+        for key in sorted(self.playfield.chunks):
+            h = zlib.crc32(repr(key), h)
+            h = zlib.crc32(self.playfield.chunks[key].tostring(), h)
+        return self.hash_rest(h)
+
+    # The same, but with the board's Zobrist hash standing in for the board,
+    # so that it costs the same however big the board is.  For checking
+    # that peers agree (see EventManager.check_hash).
+    def sync_hash(self):
+        return self.hash_rest(zlib.crc32(repr((self.board, self.playfield.zobrist))))
+
+    def hash_rest(self, h):
+        h = zlib.crc32(repr((sorted(self.next_piece['Server'].shape.cells),
+                             sorted(self.next_piece['Client'].shape.cells),
+                             sorted(self.movecount.items()), sorted(self.score.items()),
+                             self.screen, self.last_winner)), h)
+        h = zlib.crc32(array('I', self.rng.getstate()[1]).tostring(), h)
+        return h & 0xffffffff
+
+    # Everything the hashes cover, readably, for comparing by hand with a
+    # peer's dump when they disagree
+    def dump(self, f):
+        f.write('frame %d\nboard %dx%d, goal row %d\n' % ((self.frameno, ) + self.board))
+        f.write('screen %s, last winner %s\n' % (self.screen, self.last_winner))
+        f.write('score %s\nmoves %s\n' % (sorted(self.score.items()), sorted(self.movecount.items())))
+        for role in ('Server', 'Client'):
+            f.write('next %s %s\n' % (role, sorted(self.next_piece[role].shape.cells)))
+        f.write('heights %s\n' % self.playfield.column_heights)
+        for id, piece in sorted(self.playfield.pieces.iteritems()):
+            f.write('piece %d at %d,%d %s\n' % (id, piece.x, piece.y, sorted(piece.shape.cells)))
+        f.write('rng %08x\n' % (zlib.crc32(array('I', self.rng.getstate()[1]).tostring()) & 0xffffffff))
+
+    # Apply one event (see protocol.py).  Returns the winner if it ended the
+    # game.
+    def apply(self, event):
+        handler = HANDLERS[event.id]
+        if handler:
+            return handler(self, *event)
+
+    # Advance one frame.  events are applied in order before the physics
+    # runs, just like EventManager.run_events.
+    def step(self, events=()):
+        self.frameno += 1
+        for event in events:
+            self.apply(event)
+        return self.tick()
+
+HANDLERS = protocol.dispatch_table(Match)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+# Match state transfer, for a peer that has to pick up a game already under
+# way (see EventManager.resume) rather than starting a new one.
+#
+# A state is everything Match.sync_hash covers, and the physics that hasn't
+# settled yet: the pieces on the board with the forces they pass down, the
+# column heights, the next pieces, scores, move counts, frame number and rng.
+# Which cells are filled isn't sent, as it follows from the pieces.  It can
+# be sent as a delta against an earlier state the other side also has, in
+# which case only the pieces that came and went, the forces and columns
+# that changed, and how far the rng moved on, are included.  As dealing a
+# piece takes exactly one draw (see sim.Library), the rng is usually a few
+# draws on from the base's and needs no more than the count.
+#
+# Layout, big endian:
+#     magic 'TWST'  version (uint8)  flags (uint8)  frame (uint32)
+#     hash (uint32)  base hash (uint32)
+# then the body, zlib compressed if flags has COMPRESSED.  hash is the
+# state's Match.sync_hash, which decode() checks its result against, and
+# base hash that of the state a delta is against (0 if not a delta).
+#
+# Body:
+#     width height goal (uint16)  score, moves (uint32, Server then Client)
+#     screen  last winner (uint8)  next piece id (uint32)
+#     rng, if flags has RNG: 625 uint32, then a gauss flag (uint8) and value (double)
+#         or if it has RNG_DRAWS: draws since the base's (uint32)
+#     the next pieces, Server then Client
+#     pieces removed: count (uint32), ids (uint32)
+#     pieces added: count (uint32), pieces
+#     forces: count (uint32), then for each piece id (uint32) count (uint8)
+#         and (column, force) pairs (int32)
+#     dirty pieces: count (uint32), ids (uint32)
+#     columns: count (uint32), then each column (uint32) height, streak row
+#         (uint16) and streak colour (uint8)
+#     fading columns: count (uint32), columns (uint32)
+# and each piece is
+#     id (uint32)  x y (int32)  rotation colour opacity (uint8)
+#     cells count (uint8), (x, y) for each (int8)
+
+import struct, zlib, random
+
+import sim
+
+MAGIC = 'TWST'
+VERSION = 1
+
+COMPRESSED = 1
+DELTA = 2
+RNG = 4
+RNG_DRAWS = 8
+
+MAX_DRAWS = 1000 # looked for before sending the whole rng
+
+header = struct.Struct('!4sBBIII')
+piece_header = struct.Struct('!IiiBBBB')
+column = struct.Struct('!IHHB')
+
+SCREENS = ['Game', 'GameOver']
+WINNERS = [None, 'Server', 'Client']
+ROLES = ['Server', 'Client']
+
+def pack_piece(out, piece):
+    cells = piece.shape.cells
+    out.append(piece_header.pack(piece.id or 0, piece.x, piece.y, piece.rotation,
+                                 sim.COLORS.index(piece._color), piece.opacity, len(cells)))
+    out.append(struct.pack('!%db' % (2*len(cells)), *[v for cell in cells for v in cell]))
+
+def pack_ids(out, ids):
+    out.append(struct.pack('!I%dI' % len(ids), len(ids), *ids))
+
+# Pieces on the board never change, so one with the same id in the same
+# place is the same piece (ids start again with each game).
+def same(a, b):
+    return b is not None and a.x == b.x and a.y == b.y and a.shape is b.shape
+
+# How many draws from rng get it to state, or None if not many
+def rng_draws(base, state):
+    rng = random.Random()
+    rng.setstate(base.getstate())
+    for draws in xrange(MAX_DRAWS + 1):
+        if rng.getstate() == state: return draws
+        rng.random()
+    return None
+
+# The state of match, as a string.  With base (an earlier state of the same
+# match, that the other side has), only what changed since.
+def encode(match, base=None, compress=True):
+    pf = match.playfield
+    flags = COMPRESSED if compress else 0
+    out = [struct.pack('!HHHIIIIBBI', *(match.board + (match.score['Server'], match.score['Client'],
+                       match.movecount['Server'], match.movecount['Client'],
+                       SCREENS.index(match.screen), WINNERS.index(match.last_winner), pf.next_id)))]
+    rng = match.rng.getstate()
+    draws = rng_draws(base.rng, rng) if base else None
+    if draws is not None:
+        flags |= RNG_DRAWS
+        out.append(struct.pack('!I', draws))
+    else:
+        flags |= RNG
+        out.append(struct.pack('!625IBd', *(rng[1] + (rng[2] is not None, rng[2] or 0.))))
+    for role in ROLES:
+        pack_piece(out, match.next_piece[role])
+
+    if base is None:
+        removed, added, columns = [], pf.pieces.values(), xrange(pf.width)
+        forces = pf.pieces.values()
+    else:
+        flags |= DELTA
+        old = base.playfield
+        removed = [id for id, p in old.pieces.iteritems() if not same(p, pf.pieces.get(id))]
+        added = [p for id, p in pf.pieces.iteritems() if not same(p, old.pieces.get(id))]
+        columns = [x for x in xrange(pf.width) if pf.column_heights[x] != old.column_heights[x] or
+                   pf.streaks[x] != old.streaks[x]]
+        forces = list(added)
+        for id, p in pf.pieces.iteritems():
+            q = old.pieces.get(id)
+            if same(p, q) and pf.forces[p] != old.forces[q]:
+                forces.append(p)
+    pack_ids(out, removed)
+    out.append(struct.pack('!I', len(added)))
+    for piece in added:
+        pack_piece(out, piece)
+    out.append(struct.pack('!I', len(forces)))
+    for piece in forces:
+        f = sorted(pf.forces[piece].items())
+        out.append(struct.pack('!IB%di' % (2*len(f)), piece.id, len(f), *[v for kv in f for v in kv]))
+    pack_ids(out, [p.id for p in pf.dirty])
+    out.append(struct.pack('!I', len(columns)))
+    for x in columns:
+        out.append(column.pack(x, pf.column_heights[x], pf.streaks[x][0], pf.streaks[x][1]))
+    pack_ids(out, sorted(pf.fading))
+
+    body = ''.join(out)
+    if compress:
+        body = zlib.compress(body)
+    return header.pack(MAGIC, VERSION, flags, match.frameno, match.sync_hash(),
+                       base.sync_hash() if base else 0) + body
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def ids(self):
+        count, = self.unpack('!I')
+        return self.unpack('!%dI' % count)
+
+    def piece(self):
+        rtn = sim.Piece.__new__(sim.Piece)
+        id, rtn.x, rtn.y, rtn.rotation, color, rtn.opacity, count = self.unpack(piece_header.format)
+        rtn.id = id or None
+        rtn._color = sim.COLORS[color]
+        rtn.dropFrame = None
+        cells = self.unpack('!%db' % (2*count))
+        rtn.shape = sim.shape(zip(cells[0::2], cells[1::2]))
+        return rtn
+
+# The match a string from encode() describes; base has to be the state it
+# was encoded against, if it was a delta.  Raises ValueError if the string
+# is garbled or is for some other base.
+def decode(data, base=None):
+    magic, version, flags, frame, hash, base_hash = header.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version %d match state' % VERSION)
+    if flags & DELTA and (base is None or base.sync_hash() != base_hash):
+        raise ValueError('Delta against a state we do not have')
+    body = data[header.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    r = Reader(body)
+
+    (width, height, goal, server, client, server_moves, client_moves, screen, winner,
+     next_id) = r.unpack('!HHHIIIIBBI')
+    match = sim.Match(0, width, height, goal)
+    match.frameno = frame
+    match.score = {'Server': server, 'Client': client}
+    match.movecount = {'Server': server_moves, 'Client': client_moves}
+    match.screen = SCREENS[screen]
+    match.last_winner = WINNERS[winner]
+    if flags & RNG:
+        values = r.unpack('!625IBd')
+        match.rng.setstate((3, values[:625], values[626] if values[625] else None))
+    else:
+        draws, = r.unpack('!I')
+        match.rng.setstate(base.rng.getstate())
+        for i in xrange(draws):
+            match.rng.random()
+    match.next_piece = dict((role, r.piece()) for role in ROLES)
+
+    if flags & DELTA:
+        pf = base.playfield.copy()
+        pf.links = {}
+        pf.collapsed = []
+    else:
+        pf = sim.Playfield(width, height, goal)
+    pf.next_id = next_id
+    for id in r.ids():
+        piece = pf.pieces[id]
+        pf.unplace(piece)
+        del pf.forces[piece]
+    count, = r.unpack('!I')
+    for i in xrange(count):
+        piece = r.piece()
+        pf.place(piece)
+        pf.forces[piece] = {}
+    count, = r.unpack('!I')
+    for i in xrange(count):
+        id, n = r.unpack('!IB')
+        values = r.unpack('!%di' % (2*n))
+        pf.forces[pf.pieces[id]] = dict(zip(values[0::2], values[1::2]))
+    pf.dirty = set(pf.pieces[id] for id in r.ids())
+    count, = r.unpack('!I')
+    for i in xrange(count):
+        x, h, row, color = r.unpack(column.format)
+        pf.column_heights[x] = h
+        pf.streaks[x] = (row, color)
+    pf.fading = set(r.ids())
+    match.playfield = pf
+
+    if match.sync_hash() != hash:
+        raise ValueError('Match state does not check out')
+    return match
+
+# A match in the state of a snapshot (see Match.snapshot).  Match.restore
+# would take over the snapshot's objects, and the snapshots this is used on
+# are kept (EventManager.acked), so it gets copies of them instead.
+def from_snapshot(snapshot, board):
+    frameno, playfield, next_piece, movecount, score, screen, last_winner, rng = snapshot
+    match = sim.Match(0, *board)
+    match.restore((frameno, playfield.copy(),
+                   dict((r, p.copy()) for r, p in next_piece.iteritems()),
+                   movecount.copy(), score.copy(), screen, last_winner, rng))
+    return match
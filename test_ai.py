@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Checks on the computer player: that a search out of time still comes
+# up with a move, and that closing the player stops its worker processes,
+# even once a signal to the whole process group has reached them, so that
+# the game can exit.
+
+import os, sys, signal, subprocess, time, unittest
+
+import sim, ai
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a process group of its own: the game's side of it, catching the
+# signal as pygame does, starting a search and closing the player
+PLAYER = '''
+import os, sys, signal, time
+import sim, ai
+caught = []
+for sig in (signal.SIGINT, signal.SIGTERM):
+    signal.signal(sig, lambda signum, frame: caught.append(signum))
+player = ai.Player('Server', processes=2)
+player.poll(sim.Match(1), 0)
+time.sleep(.2)
+os.killpg(0, int(sys.argv[1]))
+time.sleep(.2)
+player.close()
+'''
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.match = sim.Match(1)
+        self.moves = ai.placements(self.match.next_piece['Server'])
+
+    def test_first_ply(self):
+        playfield, piece = self.match.playfield, self.match.next_piece['Server']
+        scores, count = ai.first_ply(playfield, piece, 'Server', self.moves, 0)
+        self.assertEqual((len(scores), count), (1, 1))
+        scores, count = ai.first_ply(playfield, piece, 'Server', self.moves)
+        self.assertEqual((len(scores), count), (len(self.moves), len(self.moves)))
+
+    # With no time at all, the move comes from what the first ply got to
+    def test_out_of_time(self):
+        search = ai.Search(self.match, 'Server', 0, processes=4)
+        move = search.wait()
+        self.assertTrue(move in self.moves)
+        self.assertEqual(search.depth, 1)
+        self.assertTrue(search.evaluated < len(self.moves))
+
+class CloseTest(unittest.TestCase):
+    def run_player(self, signum, timeout=10):
+        child = subprocess.Popen([sys.executable, '-c', PLAYER, str(signum)],
+                                 cwd=HERE, preexec_fn=os.setsid)
+        end = time.time() + timeout
+        while child.poll() is None and time.time() < end:
+            time.sleep(.05)
+        if child.poll() is None:
+            os.killpg(child.pid, signal.SIGKILL)
+            child.wait()
+            self.fail('still running %d s after closing' % timeout)
+        self.assertEqual(child.returncode, 0)
+
+    def test_sigterm(self):
+        self.run_player(signal.SIGTERM)
+
+    def test_sigint(self):
+        self.run_player(signal.SIGINT)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Checks that every event comes back from both wire formats as it went in.
+# These and the other test_*.py run headless (no pygame) with
+#
+#     python -m unittest discover
+
+import unittest
+
+import protocol
+
+# One of each event, with fields at the edges of their ranges
+EVENTS = [
+    protocol.Randomize(0xffffffff),
+    protocol.Reset(),
+    protocol.Drop('Server', 0, 0),
+    protocol.Drop('Client', -3, 3),
+    protocol.Quit(),
+    protocol.Clock(1, 2, 3, 4),
+    protocol.Hash(0xdeadbeef),
+]
+
+# Everything in data, decoded one message at a time as net.Stream.read does
+def decode_all(codec, data):
+    buf = bytearray(data)
+    pos = 0
+    rtn = []
+    while pos < len(buf):
+        messages, pos = codec.decode(buf, pos)
+        if not messages: break
+        rtn.extend(messages)
+    return rtn, pos
+
+class CodecTest(unittest.TestCase):
+    def round_trip(self, codec):
+        data = ''.join(codec.encode(frame, [ev]) for frame, ev in enumerate(EVENTS))
+        messages, pos = decode_all(codec, data)
+        self.assertEqual(pos, len(data))
+        self.assertEqual(messages, list(enumerate(EVENTS)))
+        for (frame, ev), sent in zip(messages, EVENTS):
+            self.assertTrue(type(ev) is type(sent))
+
+    def test_text(self):
+        self.round_trip(protocol.codecs['text'])
+
+    def test_binary(self):
+        self.round_trip(protocol.codecs[protocol.BINARY_VERSION])
+
+    def test_binary_frame(self):
+        codec = protocol.codecs[protocol.BINARY_VERSION]
+        messages, pos = decode_all(codec, codec.encode(7, EVENTS))
+        self.assertEqual(messages, [(7, ev) for ev in EVENTS])
+
+    # More events than the count in a packet's header can hold
+    def test_binary_burst(self):
+        codec = protocol.codecs[protocol.BINARY_VERSION]
+        events = [protocol.Drop('Client', i % 20, i % 4) for i in xrange(3*protocol.MAX_EVENTS + 10)]
+        data = codec.encode(1234, events)
+        messages, pos = decode_all(codec, data)
+        self.assertEqual(pos, len(data))
+        self.assertEqual(messages, [(1234, ev) for ev in events])
+
+    # A message that hasn't all arrived yet is left in the buffer
+    def test_partial(self):
+        for codec in protocol.codecs.values():
+            data = codec.encode(5, [protocol.Clock(1, 2, 3, 4)])
+            for n in xrange(len(data)):
+                self.assertEqual(codec.decode(bytearray(data[:n])), ([], 0))
+            self.assertEqual(codec.decode(bytearray(data)), ([(5, protocol.Clock(1, 2, 3, 4))], len(data)))
+
+    # The handshake lines aren't events, and come back as their words
+    def test_text_handshake(self):
+        codec = protocol.codecs['text']
+        messages, pos = decode_all(codec, '12 ping 3 binary1 clock\n\n13 switch\n')
+        self.assertEqual(messages, [(12, ['ping', '3', 'binary1', 'clock']), (13, ['switch'])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Checks on the simulation: that copies of a board don't share what either
+# writes to, that the Zobrist hash always matches the board, that a
+# collapse runs its course in the tick it starts in, that a settled board
+# costs nothing to tick, and that rolling back and replaying frames with a
+# late event ends up where a straight run does.
+
+import random, unittest
+
+import sim, protocol, ai
+
+ROLES = ('Server', 'Client')
+
+# A game on the standard board with a drop every few frames, at random but
+# always the same for a seed, and a reset whenever someone wins.  Returns
+# the match and the events of every frame (1 to frames).
+def game(seed, frames, every=3):
+    rng = random.Random(seed)
+    match = sim.Match(seed)
+    events = {}
+    for frame in xrange(1, frames + 1):
+        evs = []
+        if match.screen != 'Game':
+            evs = [protocol.Reset()]
+        elif frame % every == 0:
+            role = rng.choice(ROLES)
+            evs = [protocol.Drop(role, *rng.choice(ai.placements(match.next_piece[role])))]
+        events[frame] = evs
+        match.step(evs)
+    return match, events
+
+# The Zobrist hash of a board, worked out from nothing
+def zobrist(playfield):
+    h = 0
+    for piece in playfield.pieces.itervalues():
+        for x, y in piece.shape.cells:
+            h ^= sim.zobrist_key(x + piece.x, y + piece.y, piece.id)
+    return h
+
+# The chunks of a board as bytes
+def contents(playfield):
+    return dict((key, chunk.tostring()) for key, chunk in playfield.chunks.iteritems())
+
+class CopyTest(unittest.TestCase):
+    def setUp(self):
+        self.match, events = game(1, 200)
+        self.assertEqual(self.match.screen, 'Game')
+        self.playfield = self.match.playfield
+
+    def drop(self, playfield, role):
+        piece = self.match.next_piece[role].copy()
+        column, rotation = ai.placements(piece)[0]
+        piece.drop(playfield, column, rotation)
+        return piece
+
+    def test_shared_until_written(self):
+        copy = self.playfield.copy()
+        for key, chunk in self.playfield.chunks.iteritems():
+            self.assertTrue(copy.chunks[key] is chunk)
+        before = contents(self.playfield)
+        piece = self.drop(copy, 'Server')
+        self.assertTrue(contents(self.playfield) == before)
+        self.assertTrue(contents(copy) != before)
+        touched = set(((x + piece.x) >> sim.CHUNK_BITS, (y + piece.y) >> sim.CHUNK_BITS)
+                      for x, y in piece.shape.cells)
+        for key, chunk in self.playfield.chunks.iteritems():
+            if key not in touched:
+                self.assertTrue(copy.chunks[key] is chunk)
+
+    # Writing to the original once it has been copied leaves the copy alone
+    def test_original_written(self):
+        copy = self.playfield.copy()
+        before = contents(copy)
+        self.drop(self.playfield, 'Client')
+        self.assertTrue(contents(copy) == before)
+        self.assertTrue(contents(self.playfield) != before)
+
+    # Kept up to date on both sides of a copy, through a drop and the tick
+    # after it
+    def test_zobrist(self):
+        copy = self.playfield.copy()
+        self.drop(copy, 'Server')
+        copy.tick()
+        for playfield in (self.playfield, copy):
+            self.assertEqual(playfield.zobrist, zobrist(playfield))
+
+class SettleTest(unittest.TestCase):
+    def setUp(self):
+        self.evaluated = []
+        do_physics = self.do_physics = sim.Piece.do_physics
+        def counted(piece, playfield):
+            self.evaluated.append(piece)
+            return do_physics(piece, playfield)
+        sim.Piece.do_physics = counted
+
+    def tearDown(self):
+        sim.Piece.do_physics = self.do_physics
+
+    # Every collapse is over by the end of the tick it starts in, and a
+    # piece is only done again after something has collapsed
+    def test_one_tick(self):
+        cascades = 0
+        for seed in xrange(3):
+            match, events = game(seed, 1, every=1)
+            rng = random.Random(seed)
+            for frame in xrange(1500):
+                evs = []
+                if match.screen != 'Game':
+                    evs = [protocol.Reset()]
+                elif frame % 2 == 0:
+                    role = rng.choice(ROLES)
+                    evs = [protocol.Drop(role, *rng.choice(ai.placements(match.next_piece[role])))]
+                del self.evaluated[:]
+                collapsed = len(match.step(evs))
+                if match.screen != 'Game': continue
+                self.assertEqual(match.playfield.dirty, set(), 'frame %d' % frame)
+                self.assertEqual(match.playfield.zobrist, zobrist(match.playfield))
+                for piece in set(self.evaluated):
+                    self.assertTrue(self.evaluated.count(piece) <= collapsed + 1)
+                if collapsed > 1: cascades += 1
+        self.assertTrue(cascades > 0)
+
+    # Once things have settled, a tick does nothing
+    def test_quiet(self):
+        match, events = game(5, 300)
+        for frame in xrange(20):
+            match.step()
+        self.assertEqual(match.playfield.dirty, set())
+        del self.evaluated[:]
+        match.step()
+        self.assertEqual(self.evaluated, [])
+
+class RollbackTest(unittest.TestCase):
+    # As EventManager does: every frame is snapshotted before it runs, and
+    # when an event turns up for a frame already run, the match goes back
+    # to that frame's snapshot and runs the frames since again.
+    def test_late_events(self):
+        frames = 600
+        straight = sim.Match(7)
+        match, events = game(7, frames)
+        hashes = {}
+        for frame in xrange(1, frames + 1):
+            straight.step(events[frame])
+            hashes[frame] = straight.sync_hash()
+
+        # Every other drop turns up a few frames late
+        rng = random.Random(7)
+        arrives = {}    # frame -> [(frame it is for, event)]
+        known = dict((frame, []) for frame in events)
+        for frame, evs in sorted(events.iteritems()):
+            for ev in evs:
+                if type(ev) is protocol.Drop and rng.random() < .5:
+                    arrives.setdefault(frame + rng.randint(1, 8), []).append((frame, ev))
+                else:
+                    known[frame].append(ev)
+
+        match = sim.Match(7)
+        snapshots = {}
+        rollbacks = 0
+        for frame in xrange(1, frames + 1):
+            late = arrives.get(frame, [])
+            for f, ev in late:
+                known[f].append(ev)
+            if late:
+                start = min(f for f, ev in late)
+                match.restore(snapshots[start])
+                for f in xrange(start, frame):
+                    snapshots[f] = match.snapshot()
+                    match.step(known[f])
+                rollbacks += 1
+            snapshots[frame] = match.snapshot()
+            match.step(known[frame])
+            # Once nothing is left outstanding, the two agree
+            if not [1 for f in arrives if f > frame and min(g for g, ev in arrives[f]) <= frame]:
+                self.assertEqual(match.sync_hash(), hashes[frame], 'frame %d' % frame)
+        self.assertTrue(rollbacks > 10)
+        self.assertEqual(match.state_hash(), straight.state_hash())
+        self.assertEqual(match.playfield.zobrist, zobrist(match.playfield))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Tower Wars, a game
+# Copyright 2009 Eric Sumner
+
+# This file is part of Tower Wars.
+#
+# Tower Wars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tower Wars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tower Wars.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Checks that a match sent with state.py, whole or as a delta against an
+# earlier state, comes out the same and carries on the same.
+
+import unittest
+
+import sim, state
+from test_sim import game
+
+# What the hashes don't cover: the physics still to settle, and the columns
+def physics(match):
+    pf = match.playfield
+    return (dict((p.id, pf.forces[p]) for p in pf.pieces.itervalues()),
+            sorted(p.id for p in pf.dirty), pf.column_heights[:], pf.streaks[:],
+            sorted(pf.fading), pf.next_id)
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.frames = 500
+        match, self.events = game(11, self.frames)
+        self.match = sim.Match(11)
+        self.run_to(self.match, 300)
+        self.base = self.match.snapshot()
+        self.base_state = self.match.state_hash(), physics(self.match)
+        self.run_to(self.match, 360)
+
+    def run_to(self, match, frame):
+        while match.frameno < frame:
+            match.step(self.events[match.frameno + 1])
+
+    # Whatever sent is and received was sent from, they agree from here on
+    def assertSame(self, received, sent):
+        self.assertEqual(received.frameno, sent.frameno)
+        self.assertEqual(received.state_hash(), sent.state_hash())
+        self.assertEqual(received.playfield.zobrist, sent.playfield.zobrist)
+        self.assertEqual(physics(received), physics(sent))
+        while sent.frameno < self.frames:
+            self.run_to(sent, sent.frameno + 1)
+            self.run_to(received, sent.frameno)
+            self.assertEqual(received.sync_hash(), sent.sync_hash(), 'frame %d' % sent.frameno)
+        self.assertEqual(received.state_hash(), sent.state_hash())
+        self.assertEqual(physics(received), physics(sent))
+
+    # Every one from the same snapshot, which has to stay as it was
+    def base_match(self):
+        return state.from_snapshot(self.base, self.match.board)
+
+    def test_full(self):
+        for compress in (True, False):
+            data = state.encode(self.match, compress=compress)
+            self.assertSame(state.decode(data), self.copy())
+
+    def test_delta(self):
+        data = state.encode(self.match, self.base_match())
+        full = state.encode(self.match)
+        self.assertTrue(len(data) < len(full))
+        self.assertSame(state.decode(data, self.base_match()), self.copy())
+
+    # A delta against the state it was made from is empty, bar the header
+    def test_delta_unchanged(self):
+        base = self.base_match()
+        data = state.encode(base, self.base_match())
+        self.assertSame(state.decode(data, self.base_match()), base)
+
+    # Running a match made from a snapshot leaves the snapshot alone
+    def test_from_snapshot(self):
+        self.run_to(self.base_match(), 400)
+        match = self.base_match()
+        self.assertEqual(match.frameno, 300)
+        self.assertEqual((match.state_hash(), physics(match)), self.base_state)
+
+    def test_wrong_base(self):
+        data = state.encode(self.match, self.base_match())
+        self.assertRaises(ValueError, state.decode, data)
+        self.assertRaises(ValueError, state.decode, data, self.copy())
+
+    def test_garbled(self):
+        data = state.encode(self.match)
+        self.assertRaises(ValueError, state.decode, 'XXXX' + data[4:])
+        hash = state.header.size - 8
+        self.assertRaises(ValueError, state.decode, data[:hash] + '\0\0\0\0' + data[hash+4:])
+
+    # The match as it stands, to run on beside what was received
+    def copy(self):
+        return state.from_snapshot(self.match.snapshot(), self.match.board)
+
+if __name__ == '__main__':
+    unittest.main()
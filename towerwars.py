@@ -20,17 +20,22 @@
 
 import pygame, sys, os, traceback
 from pygame.locals import *
-from select import select
 from optparse import OptionParser
-import random, socket
+import random, socket, base64
+from collections import deque
 
-import world
+import world, sim, protocol, net, replay, profiler, state, display, ringlog
 
-FPS = 20
-next_frame_time = 0
+FPS = 20 # simulation ticks per second
+max_catchup = 5 # ticks run in a row, when behind, before drawing again
 frameno = 0
-fds = set()
-event_delay = 5 #frames
+reactor = net.Reactor()
+event_delay = 5 #frames, for peers that can't roll back
+max_event_delay = 20
+clock_interval = 10 #frames between clock messages when nothing else is sent
+clock_window = 64 #samples kept for the latency statistics
+reconnect_interval = FPS #frames between attempts to reach a peer that has gone
+acked_kept = 4 #states both sides agreed on, kept to resume from
 world.FPS = FPS
 world.frameno = frameno
 
@@ -42,241 +47,699 @@ option_parser.add_option('-q', '--quiet', action='store_const', const=2, dest='v
 option_parser.add_option('-v', '--verbose', action='store_const', const=4, dest='verbosity', help='Output debug information about game events')
 option_parser.add_option('--trace', action='store_const', const=5, dest='verbosity', help='Output all system events as well as game events (lots of output)')
 option_parser.add_option('-l', '--logfile', action='store', type='string', dest='logfile', default='-', help='Destination for log output')
+option_parser.add_option('--binary-log', action='store_true', dest='binary_log', default=False, help='Write the log as a binary trace (ringlog.py turns it into text)')
+option_parser.add_option('--record', action='store', type='string', dest='record', default=None, help='Record the game to this file, for replay.py')
+option_parser.add_option('--profile', action='store_true', dest='profile', default=False, help='Time each part of every frame and log histograms (see profiler.py)')
+option_parser.add_option('--profile-interval', action='store', type='int', dest='profile_interval', default=200, help='Frames between profile reports (0: only on exit)')
 
 # Networking Options
 
 option_parser.add_option('-s', '--server', action='store_true', dest='server', default=False, help='Run as a server.')
 option_parser.add_option('-c', '--client', action='store', dest='ip', type='string', default='0.0.0.0', help='Run as a client, connecting to the server at IP.')
+option_parser.add_option('--text-protocol', action='store_true', dest='text_protocol', default=False, help='Only use the text network protocol')
+option_parser.add_option('--input-delay', action='store', dest='input_delay', type='int', default=0, help='Frames to hold back local input when rollback is in use')
+option_parser.add_option('--rollback-frames', action='store', dest='rollback_frames', type='int', default=32, help='How far back a late remote event can be taken into account')
+option_parser.add_option('--no-rollback', action='store_false', dest='rollback', default=True, help='Always delay input instead of predicting and rolling back')
 option_parser.add_option('-p', '--port', action='store', dest='port', type='int', default='4242', help='Port number for TCP connections.')
+option_parser.add_option('--hash-interval', action='store', dest='hash_interval', type='int', default=10, help='Frames between checks that both sides agree on the game state (0: never)')
+option_parser.add_option('--desync-dump', action='store', dest='desync_dump', type='string', default=None, help='If they ever disagree, write our side of the first frame they did to this file')
+
+# Display Options
+
+option_parser.add_option('--render-fps', action='store', type='float', dest='render_fps', default=60, help='How often to draw the screen (0: as often as possible)')
+option_parser.add_option('--render-process', action='store_true', dest='render_process', default=False, help='Draw the screen in a separate process (see display.py)')
 
 world.add_options(option_parser)
 
 options, args = option_parser.parse_args()
 
-pygame.init()
+renderer = None
+if options.render_process:
+    # Before pygame starts, so that only the render process opens a window
+    renderer = display.Renderer(options)
+else:
+    pygame.init()
+    world.init_display(options)
 world.init(options)
 
-class SelectSocket:
-    def __init__(self, file):
-        self.inbuf  = ''
-        self.outbuf = ''
-        self.open = True
-        self.fileobj = None
-        if isinstance(file, int):
-            self.fd = file
-        elif hasattr(file, 'fileno'):
-            self.fd = file.fileno()
-            self.fileobj = file
-        else:
-            self.fd = os.open(file, os.O_WRONLY | os.O_APPEND)
-
-    def fileno(self):
-        return self.fd
-
-    def send(self):
-        self.outbuf = self.outbuf[os.write(self.fd, self.outbuf):]
-
-    def flush(self):
-        while self.outbuf:
-            self.send()
-
-    def recv(self):
-        try:
-            data = os.read(self.fd, 4096)
-            self.inbuf += data
-            if not data: self.open = False # EOF
-        except OSError:
-            self.open = False
-
-    def rts(self):
-        return len(self.outbuf)
-
-    def rtr(self):
-        return self.open
-
-class Log(SelectSocket):
+# Written out by a thread of its own, see ringlog.py
+class Log(ringlog.Log):
     def __init__(self):
-        if options.logfile == '-':
-            SelectSocket.__init__(self, sys.stdout)
-        else:
-            SelectSocket.__init__(self, os.open(options.logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT))
-        self.verbosity = options.verbosity # Trace execution
-        self.desc = {0: 'FATAL', 1: 'ERROR', 2: 'WARN', 3:'INFO', 4:'DEBUG', 5:'TRACE'}
+        ringlog.Log.__init__(self, options.logfile, options.verbosity, binary=options.binary_log)
         self.msg(3, 'Logging', 'Log opened')
 
     def msg(self, level, label, message, **kwargs):
         if level > self.verbosity: return
-        self.outbuf += '%8d %5s %17s: %s\t%s\n' % (frameno, self.desc.get(level, level), label, message, kwargs)
+        self.record(frameno, level, label, message, kwargs)
 
 log = Log()
 world.log = log
 
-fds.add(log)
+prof = None
+if options.profile:
+    prof = profiler.Profiler(1./FPS)
+world.profiler = reactor.profiler = prof
 
 class EventManager:
     def __init__(self):
         self.cache = {}
         self.state = 'Standalone'
+        # Built once here rather than looked up by name for every event
+        self.handlers = protocol.dispatch_table(world)
+        self.pygame_handlers = {}
+        for type in xrange(pygame.NUMEVENTS):
+            handler = getattr(world, 'H_PYGAME_%s' % pygame.event.event_name(type), None)
+            if handler: self.pygame_handlers[type] = handler
+        self.protocols = [] if options.text_protocol else [protocol.BINARY_VERSION]
+        self.features = ['clock', 'role', protocol.board_feature(world.match.board),
+                         protocol.pieces_feature(sim.library.id)] + \
+                        (['rollback'] if options.rollback else []) + \
+                        (['hash'] if options.hash_interval > 0 else [])
+        self.snapshots = [None] * (options.rollback_frames + 1)
+        self.rollback_frame = None
+        self.barrier = None # Last frame the peer reset the game in
+        self.delay_lowered = 0
+        self.new_connection()
+        # Desync detection, see check_hash.  Frames are the server's.
+        self.hashing_from = None    # Frame both sides started the same game in
+        self.agreed = None          # Last frame both hashes matched
+        self.desynced = False
+        # Rejoining, see send_state
+        self.acked = {}             # frame -> snapshot both sides hashed the same
+        self.pending = None         # (frame, snapshot) to pick the game up from
+        self.last_attempt = 0       # Frame we last tried to reach the server in
+        self.connector = None       # That attempt, until it is over
+        self.recorder = None
+        if options.record:
+            stream = net.Writer(os.open(options.record, os.O_WRONLY | os.O_CREAT | os.O_TRUNC))
+            reactor.register(stream)
+            self.recorder = replay.Recorder(stream, world.match.seed, world.match.board)
+
+        if options.server:
+            self.listen()
+        elif options.ip != '0.0.0.0':
+            if not self.connect():
+                sys.exit(1)
+
+    # Everything about the peer and the link to it, which starts again if it
+    # goes away and comes back
+    def new_connection(self):
         self.remote_frame = 0
         self.remote_frame_offset = None
         self.rtts = []
-        self.handlers = {}
-
+        self.outgoing = {}
+        self.remote_protocols = []
+        # Local input is applied after self.delay frames.  Once connected to
+        # a peer that can't roll back, that has to cover the network delay.
+        self.delay = options.input_delay
+        self.rollback = options.rollback
+        self.send_codec = self.recv_codec = protocol.codecs['text']
+        # Ongoing clock measurements, once synchronized (see clock_message)
+        self.clock = False          # Peer sends clock messages
+        self.clock_echo = (0, 0)    # Peer's last send time, when we got it
+        self.last_clock = 0         # Frame we last sent a clock message in
+        self.rtt_samples = deque(maxlen=clock_window)       # ms
+        self.lateness = deque(maxlen=clock_window)          # frames
+        self.offset_samples = []
+        self.clock_reference = None
+        self.clock_estimate = 0.
+        self.drift = 0.
+        self.peer_delay = event_delay
+        self.frame_adjust = 0       # ms added to each frame, see main loop
+        # Hashes in flight, see check_hash
+        self.hash = False           # Peer sends hashes
+        self.local_hashes = {}      # frame -> our hash, until final
+        self.final_hashes = {}      # frame -> our hash, until compared
+        self.remote_hashes = {}     # frame -> peer's hash, until compared
+        self.hash_states = {}       # frame -> snapshot, until compared
+        self.resume = None          # State the server sent, until synchronized
+
+    def listen(self):
+        self.state = 'Listening'
+        listen = socket.socket()
+        listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen.bind(('0.0.0.0', options.port))
+        listen.listen(-1)
+        log.msg(3, 'Network', 'Listening', port=options.port)
+        self.listener = net.Listener(listen, self.accept)
+        reactor.register(self.listener)
+
+    # Returns whether it got through
+    def connect(self):
+        sock = socket.socket()
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect((options.ip, options.port))
+        except socket.error:
+            sock.close()
+            return False
+        self.connected(sock)
+        return True
+
+    # Trying to get back to the server, while the game goes on.  An
+    # attempt that hasn't got anywhere by the next one is given up.
+    def reconnect(self):
+        if self.connector:
+            self.connector.close()
+            self.connector = None
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connector = net.Connector(sock, (options.ip, options.port), self.connected, self.connect_failed)
+        if connector.error is None:
+            self.connector = connector
+            reactor.register(connector)
+        else:
+            connector.finish(connector.error)
+
+    def connected(self, sock):
+        self.connector = None
+        log.msg(3, 'Network', 'Connected', ip=sock.getpeername()[0], port=sock.getpeername()[1])
+        self.state = 'Connected'
+        self.socket = net.Connection(sock)
+        reactor.register(self.socket)
+
+    def connect_failed(self, error):
+        self.connector = None
+        log.msg(4, 'Network', 'ConnectFailed', error=os.strerror(error))
+
+    # The peer has gone.  The game carries on without it: the server
+    # listens for it again and the client keeps trying to get back, and
+    # when they meet the server sends the game as it stands (see
+    # send_state) rather than starting a new one.
+    def disconnected(self):
+        log.msg(2, 'Network', 'Disconnected')
+        reactor.unregister(self.socket)
+        self.socket.fileobj.close()
+        self.new_connection()
         if options.server:
-            self.state = 'Listening'
-            self.socket = socket.socket()
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self.socket.bind(('0.0.0.0', options.port))
-            self.socket.listen(-1)
-            log.msg(3, 'Network', 'Listening', port=options.port)
-            class ListenSocket:
-                def fileno(skt):
-                    return self.socket.fileno()
-                def rts(skt):
-                    return False
-                def rtr(skt):
-                    return True
-                def recv(skt):
-                    newSocket, remoteAddr = self.socket.accept()
-                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                    self.state = 'Connected'
-                    log.msg(3, 'Network', 'Connected', ip=remoteAddr[0], port=remoteAddr[1])
-                    fds.remove(skt)
-                    self.socket = SelectSocket(newSocket)
-                    fds.add(self.socket)
-            fds.add(ListenSocket())
-        elif options.ip != '0.0.0.0':
-            try:
-                self.socket = socket.socket()
-                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                self.socket.connect((options.ip, options.port))
-                log.msg(3, 'Network', 'Connected', ip=self.socket.getpeername()[0], port=self.socket.getpeername()[1])
-                self.state = 'Connected'
-            except:
-               sys.exit(1)
-            self.socket = SelectSocket(self.socket)
-            fds.add(self.socket)
+            self.listen()
+        else:
+            self.state = 'Reconnecting'
+            self.last_attempt = frameno
+            self.hashing_from = None # Until we are back in a game
+
+    def accept(self, sock, addr):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.state = 'Connected'
+        log.msg(3, 'Network', 'Connected', ip=addr[0], port=addr[1])
+        reactor.unregister(self.listener)
+        self.listener.socket.close()
+        self.socket = net.Connection(sock)
+        reactor.register(self.socket)
                 
     def run_events(self):
-        if (frameno - 1) in self.cache:
-            del self.cache[frameno - 1]
+        self.retire(frameno - len(self.snapshots))
+        self.send_hash(frameno - len(self.snapshots))
+        self.rollback_frame = None
         if self.state in ('Connected', 'Synchronized'):
-            remote_events = self.socket.inbuf.splitlines(True)
-            if remote_events and remote_events[-1][-1] not in '\r\n':
-                self.socket.inbuf = remote_events[-1]
-                remote_events = remote_events[:-1]
-            else:
-                self.socket.inbuf = ''
-            for ev in remote_events:
-                timestamp, args = ev.split(None, 1)
-                args = args.split()
-                timestamp = int(timestamp)
-                log.msg(5, 'RemoteEvent', args[0], remote=timestamp, args=args[1:])
-                if self.state == 'Synchronized':
-                    if args[0] not in ('ping', 'synchronize'):
-                        self.add_remote_event(args, timestamp)
-                elif self.state == 'Connected':
-                    assert args[0] in ('ping', 'synchronize')
-                    if args[0] == 'ping':
-                        self.remote_frame = timestamp
-                        if int(args[1]) != 0:
-                            self.rtts.append(frameno - int(args[1]))
-                            log.msg(5, 'Clock', 'AddedRTT', start=int(args[1]), value=self.rtts[-1], remote=timestamp)
-                            if options.server and len(self.rtts) >= 30:
-                                self.state = 'Synchronized'
-                                rtt = sum(self.rtts)/(2*len(self.rtts))
-                                self.remote_frame_offset = frameno - timestamp + rtt
-                                log.msg(3, 'Clock', 'Synchronized', rtt=rtt, frame_offset=self.remote_frame_offset)
-                                self.socket.outbuf += '%d synchronize %d\n' % \
-                                    (frameno, frameno-self.remote_frame_offset)
-                                self.add_event('randomize', random.getrandbits(32))
-                                self.add_event('reset')
-                    if args[0] == 'synchronize':
-                        rtt = sum(self.rtts)/(2*len(self.rtts))
-                        self.state = 'Synchronized'
-                        self.remote_frame_offset = int(args[1]) - timestamp
-                        log.msg(3, 'Clock', 'Synchronized', rtt=rtt, frame_offset=self.remote_frame_offset)
-            if self.state == 'Connected':
-                self.socket.outbuf += '%d ping %d\n' % (frameno, self.remote_frame)
-        for ev in pygame.event.get():
-            log.msg(5, 'PygameEvent', pygame.event.event_name(ev.type), **ev.dict)
-            func_name = 'H_PYGAME_%s' % pygame.event.event_name(ev.type)
-            if hasattr(world, func_name):
-                getattr(world, func_name)(**ev.dict)
-    
-        precedence = ['remote', 'local']
-        if options.server: precedence = ['local', 'remote']
+            while True:
+                messages = self.socket.read(self.recv_codec)
+                if not messages: break
+                for timestamp, args in messages:
+                    self.remote_message(timestamp, args)
+            if not self.socket.rtr():
+                self.disconnected()
+            elif self.state == 'Connected':
+                self.socket.write('%d ping %d %s\n' % (frameno, self.remote_frame,
+                                  ' '.join(self.protocols + self.features + self.resume_words())))
+        elif self.state == 'Reconnecting' and frameno - self.last_attempt >= reconnect_interval:
+            self.last_attempt = frameno
+            self.reconnect()
+        # The state the server sent, once it is due
+        if self.pending and self.pending[0] <= frameno:
+            frame, snapshot = self.pending
+            self.pending = None
+            self.snapshots[frame % len(self.snapshots)] = (frame, snapshot)
+            if self.rollback_frame is None or frame < self.rollback_frame:
+                self.rollback_frame = frame
+        if prof: prof.mark('network')
+
+        for ev in renderer.events() if renderer else pygame.event.get():
+            if log.verbosity >= 5:
+                log.msg(5, 'PygameEvent', pygame.event.event_name(ev.type), **ev.dict)
+            handler = self.pygame_handlers.get(ev.type)
+            if handler: handler(**ev.dict)
+        if prof: prof.mark('input')
 
         world.frameno = frameno
 
-        for p in precedence:
-            for ev in (e for e in self.cache.get(frameno, []) if e[0] == p):
-                log.msg(4, 'Event', ev[1], args=ev[2:])
-                func_name = 'H_EVENT_%s' % ev[1]
-                if hasattr(world, func_name):
-                    getattr(world, func_name)(*ev[2:])
-                else:
-                    log.msg(2, 'Event', 'UndefinedHandler', func=func_name, args=ev[2:])
-        world.tick()
-
-    def add_event(self, *event):
-        self.add_delayed_event(event_delay, *event)
-
-    def add_delayed_event(self, delay, *event):
-        delay = max(delay, event_delay)
+        if self.rollback_frame is not None:
+            self.roll_back(self.rollback_frame)
+            if prof: prof.mark('rollback')
+        self.run_frame(frameno)
+        if self.state == 'Synchronized' and self.clock and \
+           (self.outgoing or frameno - self.last_clock >= clock_interval):
+            self.send_clock()
+        if self.outgoing:
+            self.send_events()
+        if self.clock and frameno % 100 == 0:
+            log.msg(4, 'Clock', 'Stats', rtt=self.rtt(), jitter=self.jitter(),
+                    delay=self.delay, drift=round(self.drift, 2), adjust=round(self.frame_adjust, 1))
+        if prof: prof.mark('send')
+
+    # The events for frame, in the order both sides apply them.  The cache
+    # holds (source, event) pairs.
+    def frame_events(self, frame):
+        precedence = ['remote', 'local']
+        if world.role == 'Server': precedence = ['local', 'remote']
+        events = self.cache.get(frame, ())
+        return [ev for p in precedence for source, ev in events if source == p]
+
+    # Frames that are too old to roll back to can't change any more, so
+    # this is where they get recorded.
+    def retire(self, frame):
+        if frame not in self.cache: return
+        if self.recorder:
+            self.recorder.record(frame, self.frame_events(frame))
+        del self.cache[frame]
+
+    def close(self):
+        # A quit is applied straight away; make sure the peer hears of it.
+        if self.state == 'Synchronized' and self.outgoing:
+            self.send_events()
+        if self.state in ('Connected', 'Synchronized'):
+            self.socket.flush()
+        if self.recorder:
+            for frame in sorted(self.cache):
+                if frame <= frameno: self.retire(frame)
+            self.recorder.stream.flush()
+
+    def run_frame(self, frame, replaying=False):
+        # Only a peer's events can arrive late
+        if self.state == 'Synchronized' and self.rollback:
+            self.snapshots[frame % len(self.snapshots)] = (frame, world.snapshot())
+
+        for ev in self.frame_events(frame):
+            log.msg(4, replaying and 'Replay' or 'Event', ev.name, args=list(ev))
+            handler = self.handlers[ev.id]
+            if handler:
+                handler(*ev)
+            else:
+                log.msg(2, 'Event', 'UndefinedHandler', event=ev.name, args=list(ev))
+            # Sent with the reset that starts the first game after
+            # synchronizing
+            if type(ev) is protocol.Randomize and self.state == 'Synchronized' and self.hashing_from is None:
+                self.hashing_from = self.canonical(frame)
+        if replaying:
+            world.replay_tick(frame)
+        else:
+            if prof: prof.mark('events')
+            world.tick() # Marks physics
+        if self.hash and self.state == 'Synchronized' and self.hashing_from is not None and \
+           self.hash_frame(frame):
+            self.local_hashes[frame] = world.match.sync_hash()
+            self.hash_states[frame] = world.snapshot()
+
+    # Put the match back how it was at the start of frame and run every
+    # frame since again, now with the events that arrived late (or from a
+    # state the server sent, see resume_from).
+    def roll_back(self, frame):
+        snapshot = self.snapshots[frame % len(self.snapshots)]
+        if snapshot is None or snapshot[0] != frame:
+            log.msg(1, 'Rollback', 'NoSnapshot', frame=frame)
+            return
+        log.msg(4, 'Rollback', 'Replaying', start=frame, frames=frameno-frame)
+        saved = world.begin_rollback(snapshot[1])
+        for f in xrange(frame, frameno):
+            self.run_frame(f, replaying=True)
+        world.end_rollback(saved)
+
+    # Local events queued before the sync were never sent, so they mustn't
+    # happen.  (Those already applied stay, for rollbacks and recordings;
+    # the game is reset straight after.)
+    def drop_unsent(self):
+        for frame in [f for f in self.cache if f >= frameno]:
+            del self.cache[frame]
+
+    # event is one of the classes in protocol.py
+    def add_event(self, event):
+        self.add_delayed_event(self.delay, event)
+
+    def add_delayed_event(self, delay, event):
+        delay = max(delay, self.delay)
+        # Nothing of ours may share a frame with a reset from a dedicated
+        # server: we would apply it first and the other player after.
+        if self.barrier is not None and frameno + delay <= self.barrier:
+            delay = self.barrier + 1 - frameno
         if (frameno + delay) not in self.cache:
             self.cache[frameno + delay] = []
-        event = [str(e) for e in event]
-        self.cache[frameno + delay].append(['local']+event)
+        self.cache[frameno + delay].append(('local', event))
         if self.state == 'Synchronized':
-            self.socket.outbuf += '%d %s\n' % (frameno + delay, ' '.join(event))
+            self.outgoing.setdefault(frameno + delay, []).append(event)
+
+    # Everything sent this frame goes out together: one packet per target
+    # frame in the binary protocol.
+    def send_events(self):
+        for time in sorted(self.outgoing):
+            self.socket.write(self.send_codec.encode(time, self.outgoing[time]))
+        self.outgoing.clear()
 
     def add_remote_event(self, event, time):
         time += self.remote_frame_offset
-        assert time >= frameno
+        if type(event) is protocol.Reset:
+            self.barrier = max(self.barrier, time)
+        if time < frameno:
+            if not self.rollback or time <= frameno - len(self.snapshots):
+                # The games have diverged; the best we can do is carry on.
+                log.msg(1, 'Event', 'TooLate', frame=time, args=event)
+                time = frameno
+            elif self.rollback_frame is None or time < self.rollback_frame:
+                self.rollback_frame = time
         if time not in self.cache:
             self.cache[time] = []
-        self.cache[time].append(['remote']+event)
+        self.cache[time].append(('remote', event))
+
+    # Our frame numbers in the server's, which both sides agree on
+    def canonical(self, frame):
+        if options.server: return frame
+        return frame - self.remote_frame_offset
+
+    # Desync detection.  Every --hash-interval frames (counted in the
+    # server's frame numbers, so that both sides pick the same ones) each
+    # side hashes the game state after the frame (Match.sync_hash, which is
+    # cheap), and once the frame is too old to be rolled back, sends the
+    # hash to the other side.  The first frame they disagree on is logged,
+    # along with the last one they agreed on.  The last few states they
+    # agreed on are kept for the client to rejoin from.
+    def hash_frame(self, frame):
+        frame = self.canonical(frame)
+        return frame > self.hashing_from and frame % options.hash_interval == 0
+
+    def send_hash(self, frame):
+        h = self.local_hashes.pop(frame, None)
+        if h is None: return
+        self.outgoing.setdefault(frame, []).append(protocol.Hash(h))
+        self.final_hashes[frame] = h
+        self.check_hash(frame)
+
+    def check_hash(self, frame):
+        if frame not in self.final_hashes or frame not in self.remote_hashes: return
+        ours, theirs = self.final_hashes.pop(frame), self.remote_hashes.pop(frame)
+        snapshot = self.hash_states.pop(frame)
+        for hashes in (self.final_hashes, self.remote_hashes, self.hash_states):
+            for f in [f for f in hashes if f < frame]:
+                del hashes[f]
+        if ours == theirs:
+            self.agreed = frame
+            self.acked[self.canonical(frame)] = snapshot
+            for f in sorted(self.acked)[:-acked_kept]:
+                del self.acked[f]
+        elif not self.desynced:
+            self.desynced = True
+            log.msg(1, 'Sync', 'Desync', frame=frame, agreed=self.agreed,
+                    ours='%08x' % ours, theirs='%08x' % theirs)
+            if options.desync_dump:
+                match = state.from_snapshot(snapshot, world.match.board)
+                f = open(options.desync_dump, 'w')
+                match.dump(f)
+                f.close()
+                log.msg(1, 'Sync', 'Dumped', frame=frame, file=options.desync_dump)
+
+    # Clock messages carry the sender's time in ms, the last such time it
+    # received from us and how long it held on to it (for the round trip
+    # time), and the input delay it thinks we need.  They are sent with
+    # other traffic when there is some, and every clock_interval frames
+    # otherwise.
+    def send_clock(self):
+        now = clock_ms()
+        sent, received = self.clock_echo
+        self.outgoing.setdefault(frameno, []).append(
+            protocol.Clock(now, sent, sent and now - received, self.needed_delay()))
+        self.last_clock = frameno
+
+    def clock_message(self, timestamp, sent, echo, held, delay):
+        # When it arrived, rather than now: we only get to it at the start
+        # of a frame.
+        now = clock_ms(self.socket.last_read)
+        self.clock_echo = (sent, now)
+        if echo:
+            self.rtt_samples.append(now - echo - held)
+        # How late this would have been as an event with no delay
+        self.lateness.append(frameno - (timestamp + self.remote_frame_offset))
+        self.peer_delay = delay
+        if not self.rollback:
+            self.adapt_delay()
+
+        # The frame offset itself never changes once agreed, as both sides
+        # have to map events the same way.  Instead the client watches the
+        # two clocks drift apart and runs a little slower or faster to
+        # bring them back.
+        if not self.rtt_samples: return
+        sample = frameno - timestamp - self.rtt() / 2. * FPS / 1000.
+        if self.clock_reference is None:
+            self.offset_samples.append(sample)
+            if len(self.offset_samples) >= 16:
+                self.clock_reference = self.clock_estimate = sum(self.offset_samples) / len(self.offset_samples)
+            return
+        self.clock_estimate += (sample - self.clock_estimate) / 32.
+        self.drift = self.clock_estimate - self.clock_reference
+        if not options.server:
+            if abs(self.drift) < 0.25:
+                self.frame_adjust = 0
+            else:
+                limit = 1000 / FPS / 20.
+                self.frame_adjust = max(-limit, min(limit, self.drift * 1000 / FPS / 10.))
+
+    def rtt(self):
+        return percentile(self.rtt_samples, 0.5)
+
+    def jitter(self):
+        return percentile(self.rtt_samples, 0.9) - percentile(self.rtt_samples, 0.1)
+
+    # The delay the peer's events need to reach us in time, judged by how
+    # late its recent messages were.
+    def needed_delay(self):
+        if len(self.lateness) < 8: return event_delay
+        return max(1, min(max_event_delay, percentile(self.lateness, 0.99) + 1))
+
+    # Both sides use the larger of what each thinks the other needs.  Raise
+    # it straight away; lower it a frame at a time once the link has been
+    # good for a while.
+    def adapt_delay(self):
+        agreed = max(self.needed_delay(), self.peer_delay)
+        if agreed > self.delay or (agreed < self.delay and frameno - self.delay_lowered >= clock_window):
+            self.delay = agreed if agreed > self.delay else self.delay - 1
+            self.delay_lowered = frameno
+            log.msg(3, 'Clock', 'Delay', frames=self.delay, rtt=self.rtt(), jitter=self.jitter())
+
+    def remote_message(self, timestamp, args):
+        if log.verbosity >= 5:
+            if isinstance(args, protocol.Event):
+                log.msg(5, 'RemoteEvent', args.name, remote=timestamp, args=list(args))
+            else:
+                log.msg(5, 'RemoteEvent', args[0], remote=timestamp, args=args[1:])
+        if self.state == 'Synchronized':
+            if not isinstance(args, protocol.Event):
+                if args[0] == 'switch':
+                    self.recv_codec = protocol.codecs[args[1]]
+                    log.msg(3, 'Network', 'Protocol', recv=self.recv_codec.name)
+            elif type(args) is protocol.Clock:
+                self.clock_message(timestamp, *args)
+            elif type(args) is protocol.Hash:
+                self.remote_hashes[timestamp + self.remote_frame_offset] = args.value
+                self.check_hash(timestamp + self.remote_frame_offset)
+            else:
+                self.add_remote_event(args, timestamp)
+        elif self.state == 'Connected':
+            assert args[0] in ('ping', 'resume', 'synchronize')
+            if args[0] == 'ping':
+                self.remote_frame = timestamp
+                self.remote_protocols = args[2:]
+                self.rollback = options.rollback and 'rollback' in self.remote_protocols
+                self.clock = 'clock' in self.remote_protocols
+                self.hash = options.hash_interval > 0 and 'hash' in self.remote_protocols
+                board = protocol.peer_board(self.remote_protocols, sim.STANDARD)
+                if board != world.match.board:
+                    log.msg(0, 'Network', 'BoardMismatch', board=world.match.board, peer=board)
+                    sys.exit(1)
+                pieces = protocol.peer_pieces(self.remote_protocols)
+                if pieces != sim.library.id:
+                    log.msg(0, 'Network', 'PiecesMismatch', pieces=sim.library.id, peer=pieces)
+                    sys.exit(1)
+                if int(args[1]) != 0:
+                    self.rtts.append(frameno - int(args[1]))
+                    log.msg(5, 'Clock', 'AddedRTT', start=int(args[1]), value=self.rtts[-1], remote=timestamp)
+                    if options.server and len(self.rtts) >= 30:
+                        self.state = 'Synchronized'
+                        self.drop_unsent()
+                        rtt = sum(self.rtts)/(2*len(self.rtts))
+                        self.remote_frame_offset = frameno - timestamp + rtt
+                        log.msg(3, 'Clock', 'Synchronized', rtt=rtt, frame_offset=self.remote_frame_offset)
+                        # A game under way carries on, if the client can
+                        # pick it up
+                        resuming = self.hashing_from is not None and self.rollback
+                        if resuming:
+                            self.send_state(protocol.peer_resume(self.remote_protocols))
+                        shared = [p for p in self.protocols if p in self.remote_protocols]
+                        self.socket.write('%d synchronize %d %s\n' % \
+                            (frameno, frameno-self.remote_frame_offset, ' '.join(shared[:1])))
+                        if shared:
+                            self.send_codec = protocol.codecs[shared[0]]
+                            log.msg(3, 'Network', 'Protocol', send=self.send_codec.name)
+                        if not self.rollback:
+                            self.delay = event_delay
+                        if not resuming:
+                            self.hashing_from = None # Until the new game starts
+                            self.add_delayed_event(event_delay, protocol.Randomize(random.getrandbits(32)))
+                            self.add_delayed_event(event_delay, protocol.Reset())
+            if args[0] == 'resume':
+                self.resume = (timestamp, int(args[1]), args[2])
+            if args[0] == 'synchronize':
+                rtt = sum(self.rtts)/(2*len(self.rtts))
+                self.state = 'Synchronized'
+                self.drop_unsent()
+                if not self.rollback:
+                    self.delay = event_delay
+                self.remote_frame_offset = int(args[1]) - timestamp
+                log.msg(3, 'Clock', 'Synchronized', rtt=rtt, frame_offset=self.remote_frame_offset)
+                if args[2:] and args[2] in self.protocols:
+                    self.recv_codec = self.send_codec = protocol.codecs[args[2]]
+                    self.socket.write('%d switch %s\n' % (frameno, args[2]))
+                    log.msg(3, 'Network', 'Protocol', send=self.send_codec.name, recv=self.recv_codec.name)
+                # A dedicated server (server.py) tells us which side we play
+                if args[3:]:
+                    world.set_role(args[3])
+                    log.msg(3, 'Game', 'Role', role=args[3])
+                if self.resume:
+                    self.resume_from(*self.resume)
+
+    # Joining a game under way.  Instead of the randomize and reset that
+    # start a new game, the server sends the state of the match at the
+    # start of the frame it synchronizes in (see state.py), before the
+    # synchronize line:
+    #     <frame> resume <base frame> <state, base64>
+    # A client that has been in the game before says in its pings which
+    # state it has to go on from,
+    #     resume=<frame>
+    # being the last one the hashes showed both sides had (frames are the
+    # server's), and if the server still has it too the state is a delta
+    # against it (base frame), or else the whole thing (base frame -1).
+    def resume_words(self):
+        if options.server or not self.acked: return []
+        return [protocol.resume_feature(max(self.acked))]
+
+    def send_state(self, base_frame):
+        base = self.acked.get(base_frame)
+        if base is None:
+            base_frame = -1
+        else:
+            base = state.from_snapshot(base, world.match.board)
+        data = state.encode(world.match, base)
+        self.socket.write('%d resume %d %s\n' % (frameno, base_frame, base64.b64encode(data)))
+        log.msg(3, 'Network', 'SentState', frame=frameno, base=base_frame, bytes=len(data))
+
+    # Called once synchronized, so that frame can be put in our terms.
+    # The state goes in as the snapshot for that frame, and the frames
+    # since are run again from it as for a rollback.
+    def resume_from(self, frame, base_frame, data):
+        self.resume = None
+        base = self.acked.get(base_frame)
+        if base is not None:
+            base = state.from_snapshot(base, world.match.board)
+        try:
+            match = state.decode(base64.b64decode(data), base)
+        except ValueError, e:
+            log.msg(0, 'Network', 'BadState', frame=frame, base=base_frame, error=str(e))
+            sys.exit(1)
+        self.hashing_from = frame - 1
+        frame += self.remote_frame_offset
+        match.frameno = frame - 1
+        # Our input since then never reached the server
+        for f in [f for f in self.cache if f >= frame]:
+            del self.cache[f]
+        self.pending = (frame, match.snapshot())
+        log.msg(3, 'Network', 'Resumed', frame=frame, base=base_frame)
+        if self.recorder:
+            log.msg(2, 'Replay', 'Stopped', reason='resumed')
+            self.recorder.stream.flush()
+            self.recorder = None
+
+# ms since we started, as sent in clock messages
+start_time = net.monotonic()
+def clock_ms(when=None):
+    if when is None: when = net.monotonic()
+    return int(1000 * (when - start_time))
+
+def percentile(samples, p):
+    if not samples: return 0
+    samples = sorted(samples)
+    return samples[min(len(samples)-1, int(p*len(samples)))]
 
 event_manager = EventManager()
 world.event_manager = event_manager
 
 # Event Loop
-next_frame_time = pygame.time.get_ticks()
+#
+# The simulation runs at a fixed FPS ticks a second (stretched or squeezed
+# by frame_adjust to keep in step with the peer), whatever the display
+# does.  When it falls behind it runs up to max_catchup ticks in a row
+# before drawing again.  In between, the screen is drawn --render-fps
+# times a second, with the falling piece interpolated between the last
+# two ticks.  With --render-process the drawing happens elsewhere, and
+# each round of ticks only publishes the match for it.
+tick_length = 1./FPS
+render_interval = 1./options.render_fps if options.render_fps > 0 else 0
+next_tick = next_render = net.monotonic()
 try:
     while True:
-        next_frame_time += 1000/FPS
-        wait_interval = next_frame_time - pygame.time.get_ticks()
-        frameno += 1
-        if wait_interval<0:
-            log.msg(2, 'EventLoop', 'Dropping Frame', interval=wait_interval)
-        else:
-            try: world.render_frame()
+        now = net.monotonic()
+        ticks = 0
+        cause = None
+        while now >= next_tick and ticks < max_catchup:
+            next_tick += tick_length + event_manager.frame_adjust/1000.
+            frameno += 1
+            ticks += 1
+            if prof:
+                prof.end_frame()
+                # Falling behind is down to the frame that drew and
+                # collected last, not the catch-up ticks after it
+                if ticks == 1 and now >= next_tick: cause = prof.drop()
+                if options.profile_interval and frameno % options.profile_interval == 0:
+                    prof.report(log)
+            try: event_manager.run_events()
             except Exception, e:
-                log.msg(1, 'RenderFrame', traceback.format_exception_only(type(e),e)[-1].strip())
+                log.msg(1, 'RunEvents', traceback.format_exception_only(type(e),e)[-1].strip())
                 traceback.print_exc()
-        log.msg(5, 'EventLoop', 'Waiting', interval=wait_interval)
-        while wait_interval > 0:
-            try:
-                if [f.rtr() or f.rts() for f in fds]:
-                    rd,wr,ex = select( [f for f in fds if f.rtr()],
-                                       [f for f in fds if f.rts()],
-                                       [], wait_interval/1000.)
-                    for s in wr:
-                        s.send()
-                    for s in rd:
-                        s.recv()
-                else:
-                    pygame.time.wait(wait_interval)
+            now = net.monotonic()
+        if ticks > 1:
+            behind = int(1000 * (now - next_tick + tick_length))
+            if prof:
+                log.msg(2, 'EventLoop', 'Dropping Frame', ticks=ticks, behind=behind, cause=cause)
+            else:
+                log.msg(2, 'EventLoop', 'Dropping Frame', ticks=ticks, behind=behind)
+
+        if renderer:
+            if ticks:
+                try: renderer.publish(next_tick, tick_length)
+                except Exception, e:
+                    log.msg(1, 'Publish', traceback.format_exception_only(type(e),e)[-1].strip())
+                    traceback.print_exc()
+                if prof: prof.mark('render')
+                world.collect_garbage(next_tick - net.monotonic())
+                if prof: prof.mark('gc')
+            next_render = next_tick
+        elif now >= next_render:
+            # How far we are into the tick after the last one run
+            progress = min(max(1 - (next_tick - now) / tick_length, 0), 1)
+            try: world.render_frame(progress)
             except Exception, e:
-                log.msg(1, 'EventLoop', traceback.format_exception_only(type(e),e)[-1].strip())
+                log.msg(1, 'RenderFrame', traceback.format_exception_only(type(e),e)[-1].strip())
                 traceback.print_exc()
-            wait_interval = next_frame_time - pygame.time.get_ticks()
-    
-        #Game Logic
-        try: event_manager.run_events()
+            next_render = max(next_render + render_interval, now)
+            if prof: prof.mark('render')
+            world.collect_garbage(min(next_tick, next_render) - net.monotonic())
+            if prof: prof.mark('gc')
+
+        wait_interval = min(next_tick, next_render) - net.monotonic()
+        log.msg(5, 'EventLoop', 'Waiting', interval=round(1000*wait_interval, 1))
+        try:
+            reactor.wait(max(wait_interval, 0))
         except Exception, e:
-            log.msg(1, 'RunEvents', traceback.format_exception_only(type(e),e)[-1].strip())
+            log.msg(1, 'EventLoop', traceback.format_exception_only(type(e),e)[-1].strip())
             traceback.print_exc()
 except BaseException, e:
-    log.flush()
+    event_manager.close()
+    if world.ai_player: world.ai_player.close()
+    if renderer: renderer.close()
+    if prof: prof.dump(log)
+    log.close()
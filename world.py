@@ -20,315 +20,455 @@
 
 import pygame, sys, os, traceback
 from pygame.locals import *
-from select import select
-from optparse import OptionParser
-import random, socket
+from collections import OrderedDict
 
 import gc
 gc.disable()
 
-WIDTH = 64
-HEIGHT = 48
+import sim, ai, net, protocol
 
 role = 'Server'
-screen = 'Game'
-score = {'Server': 0, 'Client': 0}
-movecount = {'Server': 0, 'Client': 0}
+match = None
+animate_collapse = False
+debris = [] # Collapsed pieces still being shown, see tick()
+ai_player = None
 
 winmsg = ['Game Over', 'You have won.', "Press `r' to start a new game", "Press `q' or `Esc' to quit"]
 losemsg = ['Game Over', 'You have lost.', "Press `r' to start a new game", "Press `q' or `Esc' to quit"]
 
-lastWinner = None
-
 
 
 # extern FPS
 # extern frameno
 # extern log
 # extern event_manager
+# extern profiler (None unless --profile)
 
 def add_options(option_parser):
-    pass
+    option_parser.add_option('--animate-collapse', action='store_true', dest='animate_collapse', default=False, help='Show chain reactions one piece per frame')
+    option_parser.add_option('--ai', action='store_true', dest='ai', default=False, help='Let the computer play: against you on its own, or for you when networked')
+    option_parser.add_option('--ai-budget', action='store', type='int', dest='ai_budget', default=200, help='Time the computer may think about a move (ms)')
+    option_parser.add_option('--ai-interval', action='store', type='int', dest='ai_interval', default=40, help='Frames between computer moves')
+    option_parser.add_option('--ai-processes', action='store', type='int', dest='ai_processes', default=None, help='Processes the computer thinks with (default: one per CPU)')
+    option_parser.add_option('--board-width', action='store', type='int', dest='board_width', default=sim.WIDTH, help='Columns on the board (both players must agree)')
+    option_parser.add_option('--board-height', action='store', type='int', dest='board_height', default=sim.HEIGHT, help='Rows on the board (both players must agree)')
+    option_parser.add_option('--goal-row', action='store', type='int', dest='goal_row', default=sim.GOAL, help='Reaching this row from the top wins (both players must agree)')
 
 def init(options):
-    global role, winmsg, losemsg
-    pygame.display.set_mode((16*WIDTH, 16*HEIGHT), pygame.DOUBLEBUF)
+    global role, match, animate_collapse, ai_player
+    if options.ip != '0.0.0.0': role = 'Client'
+    animate_collapse = options.animate_collapse
+    match = sim.Match(None, options.board_width, options.board_height, options.goal_row)
+    logged_score.update(match.score)
+    if options.ai:
+        networked = options.server or options.ip != '0.0.0.0'
+        ai_player = ai.Player(networked and role or ai.OTHER[role], options.ai_budget / 1000.,
+                              options.ai_interval, options.ai_processes)
+        ai_player.networked = networked
+
+# The window, which with --render-process is only opened in the process
+# that draws (see display.py)
+def init_display(options):
+    global winmsg, losemsg, board, view
+    size = (min(16*options.board_width, MAX_VIEW[0]), min(16*options.board_height, MAX_VIEW[1]))
+    pygame.display.set_mode(size)
+    board = pygame.Surface(size).convert()
+    view = pygame.Rect((0, 0), size)
     font = pygame.font.SysFont('couriernew', 48)
     winmsg  = [font.render(t, True, (0,255,0), (0,0,0)).convert() for t in winmsg ]
     losemsg = [font.render(t, True, (255,0,0), (0,0,0)).convert() for t in losemsg]
-    if options.ip != '0.0.0.0': role = 'Client'
-    H_EVENT_reset()
 
 
-# Input events: H_PYGAME_%s(**kwargs)
-# Semantic events H_EVENT_%s(*args)
-
-class Playfield:
-    def __init__(self):
-        self.pieces = set()
-        self.column_heights = [HEIGHT]*WIDTH
-        self.streaks = [(HEIGHT, 0)] * WIDTH
-        self.occupancy = [[None]*WIDTH for x in xrange(HEIGHT)]
-
-    def render(self, offset):
-        for col, (h, c) in enumerate(self.streaks):
-            pygame.display.get_surface().fill((c,c,c),    pygame.Rect(offset[0]+16*col, offset[1], 16, 16*h))
-            if c <= 26:
-                pygame.display.get_surface().fill((26,26,26), pygame.Rect(offset[0]+16*col, offset[1],  1, 16*h))
-        if role == 'Server':
-            pygame.display.get_surface().fill((0,255,0), pygame.Rect(offset[0],         offset[1], 8*WIDTH, 5*16))
-            pygame.display.get_surface().fill((255,0,0), pygame.Rect(offset[0]+8*WIDTH, offset[1], 8*WIDTH, 5*16))
-        elif role == 'Client':
-            pygame.display.get_surface().fill((255,0,0), pygame.Rect(offset[0],         offset[1], 8*WIDTH, 5*16))
-            pygame.display.get_surface().fill((0,255,0), pygame.Rect(offset[0]+8*WIDTH, offset[1], 8*WIDTH, 5*16))
-        pygame.display.get_surface().fill((0,0,255), pygame.Rect(offset[0]+8*WIDTH - 2, offset[1], 3, 16*HEIGHT))
-        for p in self.pieces:
-            p.render(offset)
-
-    def update_column_heights(self, col, row):
-        self.column_heights[col] = row
-        self.streaks[col] = (row, 255)
-
-    def tick(self):
-        self.streaks = [(h, max(c-10,0)) for h,c in self.streaks]
-        queued_pieces = set()
-        for y, row in enumerate(self.occupancy):
-            for x, val in enumerate(row):
-                if not val: continue
-                if val.last_physics == frameno: continue
-                if val in queued_pieces: continue
-                if [v for c, v in val.above() if v.last_physics < frameno]:
-                    queued_pieces.add(val)
-                    continue
-                if val.do_physics():
-                    val.destroy()
-                    return
-            for val in queued_pieces.copy():
-                if not [v for c, v in val.above() if v.last_physics < frameno]:
-                    queued_pieces.remove(val)
-                    print >>sys.stderr, 'Secondary'
-                    if val.do_physics():
-                        val.destroy()
-                        return
-
-
-class Piece:
-    def __init__(self, x, size=10):
-        self.last_physics = 0
-        self.forces = {}
-        self.cells = set([(0,0)])
-        while len(self.cells) < size:
-            rx, ry = random.choice(list(self.cells))
-            candidate_cells = set([(rx, ry+1), (rx, ry-1), (rx+1, ry), (rx-1,ry)]) - self.cells
-            if len(candidate_cells) < 2: continue
-            self.cells.add(random.choice(list(candidate_cells)))
-        self.x = x
-        self.y = -min(y for x,y in self.cells)
-
-        self.rotation = 0
-
-        self.rotations = [(lambda (x,y): ( x, y)),
-                          (lambda (x,y): ( y,-x)),
-                          (lambda (x,y): (-x,-y)),
-                          (lambda (x,y): (-y, x))]
-
-        self._color = (0,0,0)
-        while self._color == (0,0,0):
-            self._color = tuple(random.choice((0,127,255)) for x in range(3))
-
-        self.opacity = 0
-        self.dropFrame = None
-#        for x,y in self.cells:
-#            playfield.occupancy[y+self.y][x+self.x] = self
-
-    def render(self, (gridy, gridx)):
-        surf = pygame.display.get_surface()
-        white = (255,255,255)
-        if self.rotation != 0:
-            xformed_cells = set(self.rotations[self.rotation](coord) for coord in self.cells)
-        else:
-            xformed_cells = self.cells
-        for x,y in xformed_cells:
-            cell = pygame.Rect(16*(x+self.x)+gridx, 16*(y+self.y)+gridy, 16, 16)
-            surf.fill(tuple((c*self.opacity) / 5 for c in self._color), cell)
-            if (x+1,y) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx+15, 16*(y+self.y)+gridy,     1, 16))
-            if (x-1,y) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx,    16*(y+self.y)+gridy,     1, 16))
-            if (x,y-1) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx,    16*(y+self.y)+gridy,    16,  1))
-            if (x,y+1) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx,    16*(y+self.y)+gridy+15, 16,  1))
-            if (x+1,y+1) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx+15, 16*(y+self.y)+gridy+15,  1,  1))
-            if (x-1,y-1) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx,    16*(y+self.y)+gridy,     1,  1))
-            if (x+1,y-1) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx+15, 16*(y+self.y)+gridy,     1,  1))
-            if (x-1,y+1) not in xformed_cells:
-                surf.fill(white, pygame.Rect(16*(x+self.x)+gridx,    16*(y+self.y)+gridy+15,  1,  1))
-
-    def render_guides(self, (gridx, gridy)):
-        surf = pygame.display.get_surface()
-        if self.rotation != 0:
-            xformed_cells = set(self.rotations[self.rotation](coord) for coord in self.cells)
-        else:
-            xformed_cells = self.cells
-        left = min(x for x,y in xformed_cells)
-        right = max(x for x,y in xformed_cells)
-        surf.fill((0,255,0), pygame.Rect(gridx+16*(left+self.x)    , gridy, 1, 16*HEIGHT))
-        surf.fill((0,255,0), pygame.Rect(gridx+16*(right+self.x)+15, gridy, 1, 16*HEIGHT))
-
-    def move(self, offx):
-        if self.dropFrame: return
-        new_x = self.x+offx
-        new_x = max(new_x, -min(       self.rotations[self.rotation](coord)[0] for coord in self.cells))
-        new_x = min(new_x, WIDTH-1-max(self.rotations[self.rotation](coord)[0] for coord in self.cells))
-        self.x = new_x
-
-    def rotate(self):
-        if self.dropFrame: return
-        self.rotation += 1
-        if self.rotation >= len(self.rotations): self.rotation=0
-        self.y = -min(self.rotations[self.rotation](coord)[1] for coord in self.cells)
-        self.x = max(self.x, -min(       self.rotations[self.rotation](coord)[0] for coord in self.cells))
-        self.x = min(self.x, WIDTH-1-max(self.rotations[self.rotation](coord)[0] for coord in self.cells))
-
-    def drop(self, column, rotation):
-        self.cells = set(self.rotations[rotation](c) for c in self.cells)
-        self.rotation = 0
-        self.x = column
-        self.opacity = 5
-        self.y = min( playfield.column_heights[x] - max([y for x2,y in self.cells if x2+self.x==x]+[-1000])
-                      for x in xrange(WIDTH)) - 1
-
-        for x,y in self.cells:
-            if y+self.y < playfield.column_heights[x+self.x]:
-                playfield.update_column_heights(x+self.x, y+self.y)
-            playfield.occupancy[y+self.y][x+self.x] = self
-        playfield.pieces.add(self)
-
-        for x,y in self.cells:
-            if y+self.y <= 5 and self.x < WIDTH/2:
-                return 'Server'
-            elif y+self.y <= 5:
-                return 'Client'
-            else: return ''
-
-    def destroy(self):
-        playfield.pieces.remove(self)
-        for x,y in self.cells:
-            playfield.occupancy[y+self.y][x+self.x] = None
-            if y+self.y == playfield.column_heights[x+self.x]:
-                try:
-                    playfield.column_heights[x+self.x] = min(idx for idx, row in enumerate(playfield.occupancy)
-                                                                 if row[x+self.x])
-                except ValueError:
-                    playfield.column_heights[x+self.x] = HEIGHT
-                playfield.streaks[x+self.x] = (playfield.column_heights[x+self.x],0)
-
-    def above(self):
-        rtn = []
-        for x,y in self.cells:
-            x += self.x
-            y += self.y-1
-            val = playfield.occupancy[y][x]
-            if val and val != self:
-                rtn.append((x,val))
-        return rtn
-
-    def below(self):
-        rtn = []
-        for x,y in self.cells:
-            x += self.x
-            y += self.y+1
-            if y == HEIGHT:
-                val = True
-            else:
-                val = playfield.occupancy[y][x]
-            if val and val != self:
-                rtn.append((x,val))
-        return rtn
-
-    def do_physics(self):
-        forces = dict((c, v.forces.get(c,0)) for c, v in self.above())
-        cg = sum(x for x,y in self.cells)/10 + self.x
-        forces[cg] = forces.get(cg,0) + 100   # Each block is 10 ?N
-        force  = sum(forces.values())
-        below = [k for k,v in self.below()]
-
-        ecg = sum([c*f for c,f in forces.iteritems()]) / force
-        if ecg in below:
-            self.forces = {}
-            self.forces[ecg] = force
-        elif not len(below) or ecg > max(below) or ecg < min(below):
-            return True
-        else:
-            self.forces = {}
-            self.forces[max(k for k in below if k < ecg)] = force/2
-            self.forces[min(k for k in below if k > ecg)] = force/2
+def set_role(new_role):
+    global role, shown_streaks
+    role = new_role
+    shown_streaks = [] # Redraw the board in the new colours
+    if ai_player and ai_player.networked:
+        ai_player.role = role
+        ai_player.search = None
 
-        self.last_physics = frameno
-        return False
+# Input events: H_PYGAME_%s(**kwargs)
+# Semantic events H_EVENT_%s(*fields), see protocol.py
+# The event manager finds both once, at startup.
+
+# The simulation itself lives in sim.py; this module only draws a sim.Match
+# and turns keypresses into events.
+
+# Drawing works from a cache of pre-rendered piece sprites and a persistent
+# board layer holding everything except the piece being placed.  Each frame
+# only the parts of the board that changed are redrawn, and only those
+# rectangles (plus wherever the falling piece was and is) reach the display.
+#
+# A board bigger than the window is seen through a view, which follows the
+# falling piece across and the top of the player's own tower up and down
+# (PageUp and PageDown look elsewhere, Home goes back to following).  The
+# board layer is only the size of the window, holds only what is in view,
+# and is redrawn in full whenever the view moves.
+
+SPRITE_CACHE_SIZE = 256
+COLORKEYS = [(255,8,255), (8,255,8), (8,8,8)] # Transparent sprite background
+
+MAX_VIEW = (1024, 768)
+VIEW_STEP = 16*8        # the view moves in steps of this many pixels
+
+sprites = OrderedDict() # (shape id, opacity, colour) -> Surface, oldest first
+board = None
+view = None             # Rect of the board in view, in board pixels
+follow = True
+shown = {}              # piece -> Rect, as currently drawn on board
+shown_streaks = []
+shown_pieces = None     # the playfield's pieces dict, as drawn
+shown_changes = 0       # and its count of changes
+shown_debris = False
+shown_screen = None
+newest_sprite = None    # key of the sprite last used
+
+# A frame where nothing happens shouldn't allocate anything, so these are
+# kept from one frame to the next and filled in place.  The falling piece
+# and its guides are drawn at one set of overlay rects while the other
+# still says where they were drawn last, for the display update.
+board_dirty = []        # see update_board()
+overlays = ([pygame.Rect(0, 0, 0, 0) for i in xrange(3)],
+            [pygame.Rect(0, 0, 0, 0) for i in xrange(3)])
+overlay_rects = ()      # where the falling piece and its guides were drawn
+piece_bottoms = {}      # Shape -> its lowest row
+
+def piece_sprite(shape, opacity, color):
+    global newest_sprite
+    key = (shape.id, opacity, color)
+    # Already at the end of the LRU order, as is the falling piece's
+    # sprite nearly every frame
+    if key == newest_sprite and key in sprites:
+        return sprites[key]
+    newest_sprite = key
+    sprite = sprites.pop(key, None)
+    if sprite is None:
+        if len(sprites) >= SPRITE_CACHE_SIZE:
+            sprites.popitem(last=False)
+        sprite = render_sprite(shape, tuple(int(c*opacity) / 5 for c in color))
+    sprites[key] = sprite
+    return sprite
+
+def render_sprite(shape, color):
+    left, right, top = shape.extents
+    bottom = max(y for x,y in shape.bottom)
+    surf = pygame.Surface((16*(right-left+1), 16*(bottom-top+1))).convert()
+    white = (255,255,255)
+    # At low colour depths the key may map to the same pixel value as the
+    # piece; pick one that doesn't.
+    used = (surf.map_rgb(color), surf.map_rgb(white))
+    colorkey = [c for c in COLORKEYS if surf.map_rgb(c) not in used][0]
+    surf.fill(colorkey)
+    surf.set_colorkey(colorkey)
+    cells = shape.cells
+    for x,y in cells:
+        px, py = 16*(x-left), 16*(y-top)
+        surf.fill(color, pygame.Rect(px, py, 16, 16))
+        if (x+1,y) not in cells:
+            surf.fill(white, pygame.Rect(px+15, py,     1, 16))
+        if (x-1,y) not in cells:
+            surf.fill(white, pygame.Rect(px,    py,     1, 16))
+        if (x,y-1) not in cells:
+            surf.fill(white, pygame.Rect(px,    py,    16,  1))
+        if (x,y+1) not in cells:
+            surf.fill(white, pygame.Rect(px,    py+15, 16,  1))
+        if (x+1,y+1) not in cells:
+            surf.fill(white, pygame.Rect(px+15, py+15,  1,  1))
+        if (x-1,y-1) not in cells:
+            surf.fill(white, pygame.Rect(px,    py,     1,  1))
+        if (x+1,y-1) not in cells:
+            surf.fill(white, pygame.Rect(px+15, py,     1,  1))
+        if (x-1,y+1) not in cells:
+            surf.fill(white, pygame.Rect(px,    py+15,  1,  1))
+    return surf
+
+# A new Rect, or rect set to it
+def piece_rect(piece, rect=None):
+    shape = piece.oriented()
+    left, right, top = shape.extents
+    bottom = piece_bottoms.get(shape)
+    if bottom is None:
+        bottom = piece_bottoms[shape] = max(y for x,y in shape.bottom)
+    if rect is None:
+        return pygame.Rect(16*(left+piece.x), 16*(top+piece.y), 16*(right-left+1), 16*(bottom-top+1))
+    set_rect(rect, 16*(left+piece.x), 16*(top+piece.y), 16*(right-left+1), 16*(bottom-top+1))
+    return rect
+
+def set_rect(rect, left, top, width, height):
+    rect.left = left
+    rect.top = top
+    rect.width = width
+    rect.height = height
+
+def render_piece(piece, surf, rect=None):
+    sprite = piece_sprite(piece.oriented(), piece.opacity, piece._color)
+    surf.blit(sprite, rect or piece_rect(piece))
+
+# Where piece is on the board layer, which is offset by the view
+def view_rect(piece):
+    return piece_rect(piece).move(-view.left, -view.top)
+
+# Draws the guides at rects[0] and rects[1], which are set to them
+def render_guides(piece, surf, rects, shift=0):
+    left, right, top = piece.oriented().extents
+    height = surf.get_height()
+    set_rect(rects[0], 16*(left+piece.x)+shift    , 0, 1, height)
+    set_rect(rects[1], 16*(right+piece.x)+15+shift, 0, 1, height)
+    surf.fill((0,255,0), rects[0])
+    surf.fill((0,255,0), rects[1])
+
+# Redraw the part of the board layer inside rect.  Fills are clipped here
+# as well: pygame moves a rect that starts above the surface down to the
+# top without making it any shorter.
+def render_board(rect, streaks, pieces, piece_rects):
+    width, height, goal = match.board
+    x, y = view.topleft
+    def fill(color, r):
+        board.fill(color, r.clip(rect))
+    board.set_clip(rect)
+    board.fill((0,0,0))
+    for col in xrange(max((rect.left+x)/16, 0), min((rect.right+x+15)/16, width)):
+        h, c = streaks[col]
+        fill((c,c,c),    pygame.Rect(16*col-x, -y, 16, 16*h))
+        if c <= 26:
+            fill((26,26,26), pygame.Rect(16*col-x, -y,  1, 16*h))
+    if role == 'Server':
+        fill((0,255,0), pygame.Rect(-x,         -y, 8*width, goal*16))
+        fill((255,0,0), pygame.Rect(8*width-x,  -y, 8*width, goal*16))
+    elif role == 'Client':
+        fill((255,0,0), pygame.Rect(-x,         -y, 8*width, goal*16))
+        fill((0,255,0), pygame.Rect(8*width-x,  -y, 8*width, goal*16))
+    fill((0,0,255), pygame.Rect(8*width-x - 2, -y, 3, 16*height))
+    for idx in rect.collidelistall(piece_rects):
+        render_piece(pieces[idx], board, piece_rects[idx])
+    board.set_clip(None)
+
+# The pieces to draw: those on the board in view, and the debris
+def visible_pieces(playfield):
+    if view.size == (16*playfield.width, 16*playfield.height):
+        rtn = set(playfield.pieces.itervalues())
+    else:
+        rtn = set(playfield.pieces_in(view.left/16, view.top/16,
+                                      (view.right+15)/16, (view.bottom+15)/16))
+    rtn.update(debris)
+    return rtn
+
+# Bring the board layer up to date; returns the rectangles that changed,
+# in a list that is only good until the next call.
+def update_board():
+    global shown_streaks, shown_pieces, shown_changes, shown_debris
+    # Compared piece by piece rather than by playfield, as a rollback swaps
+    # in a copy of the playfield that is mostly the same.  That is only
+    # needed when something could have changed: pieces only come and go
+    # through add() and remove(), which count them in changes, and a
+    # rollback brings its own pieces dict.
+    playfield = match.playfield
+    pieces_changed = (playfield.pieces is not shown_pieces or
+                      playfield.changes != shown_changes or debris or shown_debris)
+    dirty = board_dirty
+    del dirty[:]
+    if not shown_streaks:
+        dirty.append(board.get_rect())
+        shown.clear()
+        for p in visible_pieces(playfield):
+            shown[p] = view_rect(p)
+        shown_streaks = list(playfield.streaks)
+    else:
+        if pieces_changed:
+            visible = visible_pieces(playfield)
+            for p in shown.keys():
+                if p not in visible:
+                    dirty.append(shown.pop(p))
+            for p in visible:
+                if p not in shown:
+                    shown[p] = view_rect(p)
+                    dirty.append(shown[p])
+        if playfield.streaks != shown_streaks:
+            x, y = view.topleft
+            for col in xrange(view.left/16, (view.right+15)/16):
+                streak, old = playfield.streaks[col], shown_streaks[col]
+                if streak != old:
+                    dirty.append(pygame.Rect(16*col-x, -y, 16, 16*max(streak[0], old[0])))
+            shown_streaks[:] = playfield.streaks
+    shown_pieces = playfield.pieces
+    shown_changes = playfield.changes
+    shown_debris = bool(debris)
+    if dirty:
+        pieces = shown.keys()
+        piece_rects = [shown[p] for p in pieces]
+        dirty = [r.clip(board.get_rect()) for r in dirty]
+        dirty = [r for r in dirty if r]
+        if len(dirty) > 64:
+            dirty = [board.get_rect()]
+        for rect in dirty:
+            render_board(rect, shown_streaks, pieces, piece_rects)
+    return dirty
 
 moveDirection = 0
 moveStart = 0
+last_position = (None, 0, 0) # next piece, x and opacity before the last tick
 
 def H_EVENT_reset():
-    global playfield, next_piece, movecount, screen
-    playfield = Playfield()
-    next_piece = {'Server': Piece(WIDTH/4), 'Client': Piece(3*WIDTH/4)}
-    movecount = {'Server': 0, 'Client': 0}
-    screen = 'Game'
     global moveDirection
+    match.H_EVENT_reset()
     moveDirection = 0
+    del debris[:]
 
 def H_EVENT_randomize(x):
-    random.seed(int(x))
+    match.H_EVENT_randomize(x)
 
 def H_EVENT_drop(role, col, rot):
-    global next_piece, screen, last_winner
-    winner = next_piece[role].drop(int(col), int(rot))
-    next_piece[role] = Piece({'Server': WIDTH/4, 'Client': 3*WIDTH/4}[role])
-    movecount[role] += 1
-
-    if winner:
-        score[winner] += 1
-        log.msg(3, 'Game', 'Winner', role=winner)
-        log.msg(3, 'Game', 'MoveCount', **movecount)
-        log.msg(3, 'Game', 'Score', **score)
-        screen = 'GameOver'
-        last_winner = winner
+    match.H_EVENT_drop(role, col, rot)
+
+# Rollback: the event manager snapshots the match at the start of every
+# frame and, when a remote event turns up for a frame that has already been
+# run, restores the snapshot and replays the frames since with replay_tick().
+def snapshot():
+    return match.snapshot()
+
+def begin_rollback(state):
+    saved = (match.next_piece[role], match.movecount[role])
+    match.restore(state)
+    return saved
+
+def end_rollback(saved):
+    # If the player is still placing the same piece, give it back so the
+    # position and rotation they have moved it to survive the replay.
+    piece, moves = saved
+    if match.movecount[role] == moves and match.next_piece[role].shape is piece.shape:
+        match.next_piece[role] = piece
+
+def replay_tick(frame):
+    match.frameno = frame
+    match.tick()
+
+logged_score = {}
 
 def tick():
-    if screen == 'Game':
-        playfield.tick()
-        if next_piece[role].dropFrame:
-            next_piece[role].opacity += 1
-            next_piece[role].opacity = min(5,next_piece[role].opacity)
+    global logged_score, last_position
+    match.frameno = frameno
+    collapsed = match.tick()
+    # Reported here rather than in H_EVENT_drop so a win isn't reported
+    # again when a rollback replays the frame it happened in.
+    if match.score != logged_score:
+        if sum(match.score.values()) >= sum(logged_score.values()):
+            log.msg(3, 'Game', 'Winner', role=match.last_winner)
+            log.msg(3, 'Game', 'MoveCount', **match.movecount)
+            log.msg(3, 'Game', 'Score', **match.score)
+        logged_score = match.score.copy()
+    # The simulation settles a whole chain reaction in one tick; optionally
+    # keep the collapsed pieces on screen and take them away one per frame.
+    if debris: del debris[0]
+    if animate_collapse: debris.extend(collapsed)
+    if match.screen == 'Game':
+        next_piece = match.next_piece[role]
+        # Only replaced when it changes, as this runs every tick
+        if (last_position[0] is not next_piece or last_position[1] != next_piece.x or
+            last_position[2] != next_piece.opacity):
+            last_position = (next_piece, next_piece.x, next_piece.opacity)
+        if next_piece.dropFrame:
+            next_piece.opacity += 1
+            next_piece.opacity = min(5,next_piece.opacity)
         if moveDirection:
-            next_piece[role].move(moveDirection)
-    gc.collect()
+            next_piece.move(moveDirection, match.playfield.width)
+        if ai_player:
+            move = ai_player.poll(match, frameno)
+            # This frame has already had its events
+            if move: event_manager.add_delayed_event(1, protocol.Drop(ai_player.role, *move))
+    if profiler: profiler.mark('physics')
+
+# Automatic garbage collection is off: a full collection can land in the
+# middle of any frame, and takes longer the bigger the heap.  Instead the
+# main loop offers the time left before the next frame, and this does one
+# collection of whichever generation is due (by the usual thresholds), the
+# oldest only if the last one that size would fit.  Reference counting
+# frees almost everything anyway; this is for cycles.
+full_gc_time = 0.005 # seconds the last full collection took
+
+def collect_garbage(time_left):
+    global full_gc_time
+    count = gc.get_count()
+    threshold = gc.get_threshold()
+    if count[2] >= threshold[2] and (time_left > 2*full_gc_time or count[2] >= 10*threshold[2]):
+        start = net.monotonic()
+        gc.collect()
+        full_gc_time = net.monotonic() - start
+    elif count[1] >= threshold[1]:
+        gc.collect(1)
+    elif count[0] >= threshold[0]:
+        gc.collect(0)
 
 # Game Display
-def render_frame():
-    pygame.display.get_surface().fill((0,0,0))
-    playfield.render((0,0))
-    if screen == 'Game':
-        next_piece[role].render_guides((0,0))
-        next_piece[role].render((0,0))
-    elif screen == 'GameOver':
-        if last_winner == role:
+
+# Where the view should be when following: unchanged while the falling
+# piece and the top of the player's tower are well inside it, otherwise
+# centred on them, in steps of VIEW_STEP.
+def follow_view():
+    width, height, goal = match.board
+    heights = match.playfield.column_heights
+    if role == 'Server': top = 16*min(heights[:width/2])
+    else: top = 16*min(heights[width/2:])
+    x, y = view.topleft
+    px = 16*match.next_piece[role].x
+    if not view.left + view.width/4 <= px < view.right - view.width/4:
+        x = (px - view.width/2) / VIEW_STEP * VIEW_STEP
+    if not view.top + view.height/4 <= top < view.bottom - view.height/4:
+        y = (top - view.height/2) / VIEW_STEP * VIEW_STEP
+    return pygame.Rect((x, y), view.size).clamp(pygame.Rect(0, 0, 16*width, 16*height))
+
+def move_view(new_view):
+    global view, shown_streaks
+    if new_view != view:
+        view = new_view
+        shown_streaks = [] # Redraw everything
+
+# The screen is drawn more often than the game ticks (see the event loop in
+# towerwars.py); progress is how far it is from the last tick to the next,
+# and the falling piece is drawn that far from where it was before the
+# last tick to where it is now.  It is drawn at the top of the view however
+# far down the board that is.
+def render_frame(progress=1.):
+    global shown_screen, overlay_rects
+    surf = pygame.display.get_surface()
+    if follow and match.screen == 'Game':
+        move_view(follow_view())
+    dirty = update_board()
+    dirty.extend(overlay_rects)
+    spare = overlays[overlay_rects is overlays[0]]
+    if shown_screen != match.screen:
+        shown_screen = match.screen
+        dirty = [surf.get_rect()]
+    for rect in dirty:
+        surf.blit(board, rect, rect)
+    overlay_rects = ()
+    if match.screen == 'Game':
+        next_piece = match.next_piece[role]
+        piece, x, opacity = last_position
+        if piece is next_piece and progress < 1:
+            shift = int(round(16 * (x - next_piece.x) * (1 - progress)))
+            opacity = round(4 * (opacity + (next_piece.opacity - opacity) * progress)) / 4
+        else:
+            shift = 0
+            opacity = next_piece.opacity
+        shift -= view.left
+        overlay_rects = spare
+        render_guides(next_piece, surf, spare, shift)
+        piece_rect(next_piece, spare[2]).move_ip(shift, 0)
+        sprite = piece_sprite(next_piece.oriented(), opacity, next_piece._color)
+        surf.blit(sprite, spare[2])
+    elif match.screen == 'GameOver' and dirty:
+        if match.last_winner == role:
             msg = winmsg
         else:
             msg = losemsg
-        vdist = 768/(len(msg)+2)
-        x = 512
+        vdist = surf.get_height()/(len(msg)+2)
+        x = surf.get_width()/2
         y = vdist
-        for surf in msg:
-            pygame.display.get_surface().blit(surf, (x-surf.get_width()/2, y-surf.get_height()/2))
+        for text in msg:
+            dirty.append(surf.blit(text, (x-text.get_width()/2, y-text.get_height()/2)))
             y += vdist
-    pygame.display.flip()
+    dirty.extend(overlay_rects)
+    pygame.display.update(dirty)
 
 # Input Handlers
 #def H_PYGAME_MouseButtonDown(pos, **kwargs):
@@ -337,10 +477,10 @@ def render_frame():
 def H_PYGAME_KeyDown(key, **kwargs):
     global moveDirection, moveStart
     if key in (pygame.K_q, pygame.K_ESCAPE):
-        event_manager.add_event('quit')
+        event_manager.add_event(protocol.Quit())
     if key == pygame.K_r:
-        event_manager.add_event('reset')
-    if screen == 'Game':
+        event_manager.add_event(protocol.Reset())
+    if match.screen == 'Game':
         if key == pygame.K_LEFT:
             moveStart = frameno
             moveDirection = -1
@@ -348,18 +488,35 @@ def H_PYGAME_KeyDown(key, **kwargs):
             moveStart = frameno
             moveDirection =  1
         elif key == pygame.K_DOWN:
-            next_piece[role].dropFrame = frameno+5
-            event_manager.add_event('drop', role, next_piece[role].x, next_piece[role].rotation)
+            next_piece = match.next_piece[role]
+            next_piece.dropFrame = frameno+5
+            event_manager.add_event(protocol.Drop(role, next_piece.x, next_piece.rotation))
         elif key == pygame.K_UP:
-            next_piece[role].rotate()
-    
+            match.next_piece[role].rotate(match.playfield.width)
+    if view is not None: # Otherwise the render process sees to it
+        view_key(key)
+
+def view_key(key):
+    global follow
+    if key in (pygame.K_PAGEUP, pygame.K_PAGEDOWN):
+        follow = False
+        width, height, goal = match.board
+        step = view.height/2 * (1 if key == pygame.K_PAGEDOWN else -1)
+        move_view(view.move(0, step).clamp(pygame.Rect(0, 0, 16*width, 16*height)))
+    elif key == pygame.K_HOME:
+        follow = True
+
 def H_PYGAME_KeyUp(key, **kwargs):
     global moveDirection
-    if screen == 'Game':
+    if match.screen == 'Game':
         if key == pygame.K_RIGHT:
             moveDirection = 0
         if key == pygame.K_LEFT:
             moveDirection = 0
 
+# Closing the window (or, with --render-process, the render process going)
+def H_PYGAME_Quit(**kwargs):
+    event_manager.add_event(protocol.Quit())
+
 def H_EVENT_quit():
     sys.exit(0)